@@ -0,0 +1,83 @@
+# gateway_benchmark.py
+# Compares the Flask gateway (gateway/app.py, port 5001) with the asyncio gateway (gateway/async_app.py, port 5003)
+# running the same locust scenario (locustfile.py) against both of them, one after the other.
+#
+# uso (con tutto il sistema avviato con docker compose, dalla cartella root):
+# python docs/gateway_benchmark.py --users 500 --spawn-rate 50 --run-time 2m
+import argparse
+import csv
+import os
+import subprocess
+import sys
+import tempfile
+
+LOCUSTFILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'locustfile.py')
+
+GATEWAYS = {
+    'flask': 'https://localhost:5001',
+    'asyncio': 'https://localhost:5003',
+}
+
+# columns of the "Aggregated" row of the locust <prefix>_stats.csv file
+METRICS = [
+    ('Request Count', 'requests'),
+    ('Failure Count', 'failures'),
+    ('Requests/s', 'req/s'),
+    ('Median Response Time', 'median (ms)'),
+    ('95%', 'p95 (ms)'),
+    ('99%', 'p99 (ms)'),
+    ('Max Response Time', 'max (ms)'),
+]
+
+
+def run_locust(host, users, spawn_rate, run_time, csv_prefix):
+    command = [
+        sys.executable, '-m', 'locust',
+        '-f', LOCUSTFILE,
+        '--headless',
+        '--host', host,
+        '--users', str(users),
+        '--spawn-rate', str(spawn_rate),
+        '--run-time', run_time,
+        '--csv', csv_prefix,
+        '--only-summary',
+    ]
+    print(f"Running: {' '.join(command)}")
+    subprocess.run(command, check=False)
+
+
+def read_aggregated_stats(csv_prefix):
+    with open(f"{csv_prefix}_stats.csv", newline='') as f:
+        for row in csv.DictReader(f):
+            if row['Name'] == 'Aggregated':
+                return row
+    raise ValueError(f"No aggregated stats found in {csv_prefix}_stats.csv")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the Flask gateway against the asyncio gateway.')
+    parser.add_argument('--users', type=int, default=200, help='number of concurrent locust users')
+    parser.add_argument('--spawn-rate', type=int, default=20, help='locust users started per second')
+    parser.add_argument('--run-time', default='1m', help='duration of each run, e.g. 30s, 2m')
+    parser.add_argument('--output-dir', default=None, help='where to keep the locust csv files')
+    args = parser.parse_args()
+
+    output_dir = args.output_dir or tempfile.mkdtemp(prefix='gateway_benchmark_')
+    os.makedirs(output_dir, exist_ok=True)
+
+    results = {}
+    for name, host in GATEWAYS.items():
+        csv_prefix = os.path.join(output_dir, name)
+        run_locust(host, args.users, args.spawn_rate, args.run_time, csv_prefix)
+        results[name] = read_aggregated_stats(csv_prefix)
+
+    print(f"\n=== Gateway benchmark ({args.users} users, {args.run_time}) ===")
+    print(f"{'metric':<14}" + ''.join(f"{name:>14}" for name in GATEWAYS))
+    for column, label in METRICS:
+        values = ''.join(f"{float(results[name][column]):>14.1f}" for name in GATEWAYS)
+        print(f"{label:<14}{values}")
+    print(f"\nlocust csv files saved in {output_dir}")
+
+
+if __name__ == '__main__':
+    main()
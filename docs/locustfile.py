@@ -123,6 +123,15 @@ class GachaUser(FastHttpUser):
         else:
             logger.error(f"Failed to retrieve inventory for {self.username}: {response.status_code} - {response.text}")
 
+    @task(1)
+    def view_hydrated_inventory(self):
+        """View user inventory with the details of every gatcha (one request instead of one per gatcha)."""
+        response = self.client.get("/user/collection?format=hydrated", headers=self.headers, verify=False, name="/user/collection?format=hydrated")
+        if response.status_code == 200:
+            logger.info(f"{self.username} viewed the details of {len(response.json())} gatchas of their inventory.")
+        else:
+            logger.error(f"Failed to retrieve the hydrated inventory for {self.username}: {response.status_code} - {response.text}")
+
     # --- Gatcha Microservice Tasks ---
 
     @task(2)
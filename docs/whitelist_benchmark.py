@@ -0,0 +1,87 @@
+# whitelist_benchmark.py
+# Micro-benchmark of the whitelist matcher of the user gateway.
+# Compares the old linear scan of WHITELIST with the compiled segment trie of gateway/routing.py
+# while the whitelist grows to hundreds of rules.
+#
+# uso (dalla cartella root):
+# python docs/whitelist_benchmark.py
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'gateway'))
+from routing import compile_whitelist, _match_node  # noqa: E402
+
+SERVICES = ['auth', 'gatcha', 'market', 'user', 'storage']
+METHODS = ['GET', 'POST', 'PUT', 'DELETE']
+WHITELIST_SIZES = [10, 50, 100, 250, 500, 1000]
+LOOKUPS = 2000
+
+
+def linear_is_request_allowed(whitelist, service_name, method, subpath):
+    """The matcher used by the gateway before the whitelist was compiled."""
+    normalized_subpath = subpath.strip('/')
+    for rule in whitelist:
+        if rule['service'] == service_name and method == rule['method']:
+            rule_path_parts = rule['path'].strip('/').split('/')
+            subpath_parts = normalized_subpath.split('/')
+            if len(rule_path_parts) == len(subpath_parts):
+                match = True
+                for rule_part, subpath_part in zip(rule_path_parts, subpath_parts):
+                    if rule_part != subpath_part and not (rule_part.startswith('<') and rule_part.endswith('>')):
+                        match = False
+                        break
+                if match:
+                    return True
+    return False
+
+
+def compiled_is_request_allowed(index, service_name, method, subpath):
+    root = index.get((service_name, method))
+    return root is not None and _match_node(root, subpath.strip('/').split('/'), 0) is not None
+
+
+def generate_whitelist(size, rng):
+    whitelist = []
+    for i in range(size):
+        parts = [f"resource{i}"]
+        for depth in range(rng.randint(0, 2)):
+            parts.append('<param>' if rng.random() < 0.5 else f"sub{depth}")
+        whitelist.append({'service': rng.choice(SERVICES), 'method': rng.choice(METHODS), 'path': '/'.join(parts)})
+    return whitelist
+
+
+def generate_requests(whitelist, rng):
+    requests = []
+    for _ in range(LOOKUPS):
+        if rng.random() < 0.8:
+            # allowed request: an existing rule with its parameters filled
+            rule = rng.choice(whitelist)
+            subpath = '/'.join('value' if part.startswith('<') else part for part in rule['path'].split('/'))
+            requests.append((rule['service'], rule['method'], subpath))
+        else:
+            # blocked request: the worst case for the linear scan
+            requests.append((rng.choice(SERVICES), rng.choice(METHODS), 'not/in/the/whitelist'))
+    return requests
+
+
+def main():
+    rng = random.Random(42)
+    print(f"{'rules':>6}{'linear (us/lookup)':>22}{'compiled (us/lookup)':>24}{'speedup':>10}")
+    for size in WHITELIST_SIZES:
+        whitelist = generate_whitelist(size, rng)
+        index = compile_whitelist(whitelist)
+        requests = generate_requests(whitelist, rng)
+
+        # both matchers must agree
+        for request in requests:
+            assert linear_is_request_allowed(whitelist, *request) == compiled_is_request_allowed(index, *request)
+
+        linear = min(timeit.repeat(lambda: [linear_is_request_allowed(whitelist, *r) for r in requests], number=1, repeat=5))
+        compiled = min(timeit.repeat(lambda: [compiled_is_request_allowed(index, *r) for r in requests], number=1, repeat=5))
+        print(f"{size:>6}{linear / LOOKUPS * 1e6:>22.2f}{compiled / LOOKUPS * 1e6:>24.2f}{linear / compiled:>9.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,7 @@
 import os
 import logging
 from typing import Optional, Dict, Any
-import requests
+import service_client
 from flask import Flask, request, jsonify, Response
 from requests.exceptions import ConnectionError, HTTPError, RequestException
 from werkzeug.exceptions import BadRequest, MethodNotAllowed
@@ -26,6 +26,62 @@ SERVICE_URLS = {
     'auth': os.getenv('AUTH_URL')
 }
 
+# Streaming proxy: request and response bodies are piped in chunks between the client and the service,
+# so the gateway never holds a whole payload (e.g. a gatcha image) in memory.
+# Set STREAMING_PROXY to False to go back to buffering the whole bodies.
+STREAMING_PROXY = os.getenv('STREAMING_PROXY', 'True') == 'True'
+STREAM_CHUNK_SIZE = int(os.getenv('STREAM_CHUNK_SIZE', str(64 * 1024)))
+
+class RequestBodyStream:
+    """
+    Iterable over the body of the incoming request, read in chunks of STREAM_CHUNK_SIZE bytes.
+    It exposes the length of the body, so the request to the service is sent with the same
+    Content-Length of the original one instead of switching to chunked encoding.
+    """
+    def __init__(self, stream, length):
+        self.stream = stream
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        while True:
+            chunk = self.stream.read(STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+def get_request_body():
+    """Return the body of the incoming request, as a stream if STREAMING_PROXY is enabled."""
+    if not STREAMING_PROXY:
+        return request.get_data()
+    if request.content_length:
+        return RequestBodyStream(request.stream, request.content_length)
+    if request.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+        # unknown length: the body is forwarded with chunked encoding
+        return iter(lambda: request.stream.read(STREAM_CHUNK_SIZE), b'')
+    return None
+
+def build_response(response) -> Response:
+    """Build the response for the client from the response of the service."""
+    if not STREAMING_PROXY:
+        # Remove unnecessary headers in the response
+        excluded_headers = ['content-encoding', 'transfer-encoding', 'connection']
+        headers = [(name, value) for name, value in response.raw.headers.items()
+                   if name.lower() not in excluded_headers]
+        return Response(response.content, response.status_code, headers)
+
+    # the body is passed through as it is (not decoded), so content-encoding and content-length stay valid
+    excluded_headers = ['transfer-encoding', 'connection']
+    headers = [(name, value) for name, value in response.raw.headers.items()
+               if name.lower() not in excluded_headers]
+    body = response.raw.stream(STREAM_CHUNK_SIZE, decode_content=False)
+    proxied_response = Response(body, response.status_code, headers, direct_passthrough=True)
+    # give the connection back to the pool once the whole body has been sent to the client
+    proxied_response.call_on_close(response.close)
+    return proxied_response
+
 def forward_request(service_name: str, subpath: str) -> Response:
     """
     Forwards the incoming request to the specified service with the given subpath.
@@ -54,24 +110,20 @@ def forward_request(service_name: str, subpath: str) -> Response:
         headers = {key: value for key, value in request.headers if key.lower() != 'host'}
 
         # Forward the request based on its method
-        response = requests.request(
+        response = service_client.request(
             method=request.method,
             url=target_url,
             params=request.args,
-            data=request.get_data(),
+            data=get_request_body(),
             headers=headers,
             cookies=request.cookies,
             allow_redirects=False,
             timeout=10,  # you can adjust the timeout as needed
-            verify=False
+            verify=False,
+            stream=STREAMING_PROXY
         )
 
-        # Prepare the response to return to the client
-        excluded_headers = ['content-encoding', 'transfer-encoding', 'connection']
-        headers = [(name, value) for name, value in response.raw.headers.items()
-                   if name.lower() not in excluded_headers]
-
-        return Response(response.content, response.status_code, headers)
+        return build_response(response)
 
     except ConnectionError as ce:
         logger.error(f"Connection error while accessing {target_url}: {ce}")
@@ -10,7 +10,7 @@ import jwt
 from auth_utils import role_required, get_userID_from_jwt
 import bcrypt
 import os
-import requests
+import service_client
 import redis
 
 import urllib3
@@ -27,6 +27,7 @@ TOKEN_EXPIRATION_MINUTES = 30
 AUTH_DB_URL = os.getenv("AUTH_DB_URL")
 AUTH_DB_NAME = os.getenv("AUTH_DB_NAME")
 USER_URL = os.getenv("USER_URL")
+TOKEN_REVOCATION_CHANNEL = os.getenv("TOKEN_REVOCATION_CHANNEL", "revoked_tokens")
 JWT_SECRET = open('/run/secrets/JWT_SECRET').read().strip()
 
 # Initializations
@@ -114,7 +115,7 @@ def register_user():
             return make_response(jsonify({"error": "Invalid email"}), 400)
         
 
-        response = requests.post(USER_URL+"/init-user", json={"userID": user["userID"]}, timeout=10, verify=False)
+        response = service_client.post(USER_URL+"/init-user", json={"userID": user["userID"]}, timeout=10, verify=False)
         if response.status_code != 201:
             return make_response(jsonify({"error": "Could not initialize user, problem with the user microservice"}), 502)
                     
@@ -235,7 +236,7 @@ def delete_user():
         auth_db.users.delete_one({"userID": userID})
         
         # invoke the user microservice to delete the user
-        response = requests.post(USER_URL+"/user/delete_user", json={"userID": userID}, timeout=10, verify=False)
+        response = service_client.post(USER_URL+"/user/delete_user", json={"userID": userID}, timeout=10, verify=False)
         if response.status_code != 200:
             return make_response(jsonify({"error": "Could not delete user, problem with the user microservice "+ response.text}), 502)
         
@@ -347,6 +348,8 @@ def revoke_token():
 def revoke(token_id, exp):
     expiration_time = datetime.fromtimestamp(exp) - datetime.now()
     redis_client.setex(token_id, expiration_time, 'revoked')
+    # notify the microservices, so they can remove the token from their introspection cache (see auth_utils.py)
+    redis_client.publish(TOKEN_REVOCATION_CHANNEL, token_id)
 
 def is_token_revoked(token_id):
     return redis_client.exists(token_id) == 1
@@ -55,6 +55,8 @@ def start_mocking_http_requests():
     
     methods_to_patch = ['get', 'post', 'put', 'delete', 'patch', 'head', 'options']
     patchers = [patch(f'requests.{method}', lambda url, **kwargs: mock_request(method.upper(), url, **kwargs)) for method in methods_to_patch]
+    # the calls made with service_client.py go through a pooled requests.Session
+    patchers.append(patch('requests.Session.request', lambda self, method, url, **kwargs: mock_request(method.upper(), url, **kwargs)))
     
     for patcher in patchers:
         patcher.start()
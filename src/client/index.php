@@ -281,7 +281,7 @@ if (isset($_SESSION['token'])) {
                     <article class="card">
                         <header>
                             <?php if (in_array($gatcha['_id'], $user_gatcha_ids)): ?>
-                                <img src="proxy.php?url=<?php echo urlencode($GATEWAY_URL_INSIDE_CONTAINER . $gatcha['image']); ?>" alt="<?php echo htmlspecialchars($gatcha['name']); ?>">
+                                <img src="proxy.php?url=<?php echo urlencode($GATEWAY_URL_INSIDE_CONTAINER . ($gatcha['variants']['thumbnail'] ?? $gatcha['image'])); ?>" alt="<?php echo htmlspecialchars($gatcha['name']); ?>">
                             <?php else: ?>
                                 <img src="/mistery.webp" alt="Mistery Gatcha">
                             <?php endif; ?>
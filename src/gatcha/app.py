@@ -7,18 +7,25 @@ from pymongo.errors import ServerSelectionTimeoutError
 import bson.json_util as json_util
 import bson
 import uuid
+import io
+import hashlib
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
-import requests
-from auth_utils import role_required, get_userID_from_jwt
+from catalogue_index import CatalogueIndex
+from roll_stats import RollStatsAggregator, ROLL_MARKS_FIELD
+from image_variants import generate_variants, object_name, HashingReader, InvalidImageError, IMAGE_VARIANTS
+from outbox import Outbox, post_idempotent, new_idempotency_key
+from auth_utils import role_required, get_userID_from_jwt, get_introspection_cache_stats, get_redis_client
 
 import urllib3
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 
 # for handling image uploads to MinIO
-from werkzeug.utils import secure_filename
 from minio import Minio
 from minio.error import S3Error
+from minio.commonconfig import CopySource
 
 # for better error messages
 from rich.traceback import install
@@ -34,6 +41,22 @@ USERL_URL = os.getenv('USER_URL')
 
 ROLL_PRICE = 10
 
+# numero massimo di gatcha che si possono rollare con una sola richiesta a /roll/batch
+ROLL_BATCH_MAX_COUNT = int(os.getenv('ROLL_BATCH_MAX_COUNT', '10'))
+
+# finestra di default e massima (in ore) delle statistiche di /stats/rolls
+ROLL_STATS_DEFAULT_HOURS = 24
+ROLL_STATS_MAX_HOURS = 24 * 30
+
+# numero massimo di gatcha che si possono aggiungere con una sola richiesta a /gatchas/bulk, e upload in parallelo
+GATCHAS_BULK_MAX_RECORDS = int(os.getenv('GATCHAS_BULK_MAX_RECORDS', '100'))
+GATCHAS_BULK_UPLOAD_WORKERS = int(os.getenv('GATCHAS_BULK_UPLOAD_WORKERS', '4'))
+# le immagini originali vengono caricate su MinIO direttamente dalla richiesta, a parti di IMAGE_UPLOAD_PART_SIZE byte (minimo 5 MiB)
+IMAGE_UPLOAD_PART_SIZE = int(os.getenv('IMAGE_UPLOAD_PART_SIZE', str(5 * 1024 * 1024)))
+
+# numero massimo di ID che si possono chiedere con una sola richiesta a /gatchas/batch
+GATCHAS_BATCH_MAX_IDS = int(os.getenv('GATCHAS_BATCH_MAX_IDS', '1000'))
+
 RARITY_PROBABILITIES = {
     'comune': 0.5,       # 50%
     'raro': 0.3,         # 30%
@@ -53,6 +76,9 @@ MINIO_STORAGE_ACCESS_KEY = os.getenv("MINIO_STORAGE_ACCESS_KEY")
 MINIO_STORAGE_SECRET_KEY = os.getenv("MINIO_STORAGE_SECRET_KEY")
 MINIO_STORAGE_BUCKET_NAME = os.getenv("MINIO_STORAGE_BUCKET_NAME")
 
+# canale redis su cui chiediamo ai gateway di svuotare la cache delle risposte (vedi gateway/response_cache.py)
+GATEWAY_CACHE_PURGE_CHANNEL = os.getenv('GATEWAY_CACHE_PURGE_CHANNEL', 'gateway_cache_purge')
+
 def validate_env_vars(**vars):
     for name, value in vars.items():
         if not value or not isinstance(value, str):
@@ -147,6 +173,21 @@ GATCHA_COLLECTION_NAME = 'gatchas'
 
 mongo_client = MongoClient(GATCHA_DATABASE_URL, 27017, maxPoolSize=50)
 db = mongo_client[DATABASE_NAME]
+
+# indice in memoria dei gatcha divisi per rarità, usato da /roll al posto di una query per ogni roll
+catalogue = CatalogueIndex()
+catalogue.start(db[GATCHA_COLLECTION_NAME])
+
+# i roll non aggiornano più NTot direttamente: gli eventi passano da uno stream redis e vengono sommati
+# da un aggregatore, che aggiorna NTot e le statistiche dei roll con pochi bulk_write (vedi roll_stats.py)
+roll_stats = RollStatsAggregator(db[GATCHA_COLLECTION_NAME], db['roll_stats'], db['roll_flushes'], get_redis_client)
+# i campi di servizio dell'aggregatore non vengono restituiti dalle API
+GATCHA_PROJECTION = {ROLL_MARKS_FIELD: 0}
+roll_stats.start()
+
+# chiamate al user service che devono andare a buon fine prima o poi (gatcha già pagati, rimborsi), vedi outbox.py
+outbox = Outbox(db['outbox'])
+outbox.start()
 # endregion database connection
 
 
@@ -155,15 +196,164 @@ db = mongo_client[DATABASE_NAME]
 # region utility functions
 def weighted_random_choice(rarities):
     # Selects a rarity based on the predefined probabilities.
+    return weighted_random_choices(rarities, 1)[0]
+
+def weighted_random_choices(rarities, count):
+    # Selects count rarities (with replacement) based on the predefined probabilities, in a single draw.
     rarity_list = list(rarities.keys())
     probability_list = list(rarities.values())
-    return random.choices(rarity_list, probability_list, k=1)[0]
+    return random.choices(rarity_list, probability_list, k=count)
+
+def purge_gateway_cache(subpath_prefix='gatchas'):
+    # Asks the gateways to drop their cached responses of the gatcha service under subpath_prefix.
+    # A failure is only logged: the cached responses expire anyway after their TTL.
+    try:
+        get_redis_client().publish(GATEWAY_CACHE_PURGE_CHANNEL, f"gatcha/{subpath_prefix}")
+    except Exception as e:
+        app.logger.error(f"Failed to purge the gateway cache: {str(e)}")
+
+def buy_gatchas(userID, amount, gatcha_payload):
+    """
+    Charges amount to the user, then adds to the collection the gatchas of gatcha_payload (the body of /add_gatcha).
+    Every call has its own idempotency key, so it is retried on timeouts without charging or adding twice.
+    Returns None if the gatchas are bought, otherwise the error response.
+    """
+    purchase_key = new_idempotency_key()
+    response = post_idempotent(USER_URL + "/decrease_balance", {"userID": userID, "amount": amount}, f"{purchase_key}-charge")
+    if response is None:
+        # the charge may or may not have been applied: nothing to compensate, the user can retry
+        app.logger.error(f"Unknown outcome of the charge {purchase_key}-charge of {userID}")
+        return make_response(jsonify({"error": "User service unavailable"}), 503)
+    if response.status_code != 200:
+        return make_response(jsonify({"error": "Failed to decrease balance", "details": response.text}), response.status_code)
+
+    add_key = f"{purchase_key}-add"
+    response = post_idempotent(USER_URL + "/add_gatcha", gatcha_payload, add_key)
+    if response is None:
+        # the user already paid and the gatchas may have been added or not (e.g. a 409 of a call still in progress):
+        # the outbox keeps adding them (with the same key, so only once) until the user service answers
+        outbox.enqueue(USER_URL + "/add_gatcha", gatcha_payload, add_key)
+        return None
+    if response.status_code != 200:
+        # the gatchas can not be added: give the credit back
+        outbox.deliver(USER_URL + "/refund", {"userID": userID, "amount": amount}, f"{purchase_key}-refund")
+        return make_response(jsonify({"error": "Failed to add gatcha", "details": response.text}), response.status_code)
+    return None
 # endregion utility functions
 
 
 
 
 
+# region image upload
+def validate_gatcha_data(data):
+    # Returns the error of the JSON data of a new gatcha, or None if it is valid.
+    if not isinstance(data, dict) or data.get('name') is None or data.get('rarity') is None:
+        return "Invalid JSON format provided"
+    return None
+
+def image_stored(name):
+    try:
+        minio_client.stat_object(MINIO_STORAGE_BUCKET_NAME, name)
+        return True
+    except S3Error as e:
+        if e.code != 'NoSuchKey':
+            raise
+        return False
+
+def image_url(name):
+    return f"/storage/{MINIO_STORAGE_BUCKET_NAME}/{name}"
+
+def store_image(data, extension, content_type):
+    """Stores an image in the MinIO bucket under the hash of its content, unless it is already there. Returns its URL."""
+    name = object_name(hashlib.sha256(data).hexdigest(), extension)
+    if image_stored(name):
+        print(f"Image '{name}' already in bucket '{MINIO_STORAGE_BUCKET_NAME}', not uploaded again")
+        return image_url(name)
+    minio_client.put_object(
+        bucket_name=MINIO_STORAGE_BUCKET_NAME,
+        object_name=name,
+        data=io.BytesIO(data),
+        length=len(data),
+        content_type=content_type
+    )
+    print(f"Image successfully uploaded as '{name}' to bucket '{MINIO_STORAGE_BUCKET_NAME}'")
+    return image_url(name)
+
+def store_image_stream(stream, extension, content_type):
+    """
+    Streams an image to the MinIO bucket under a temporary name, hashing it on the way,
+    then copies it under the hash of its content (unless it is already there). Returns its URL.
+    """
+    reader = HashingReader(stream)
+    temporary_name = f"tmp/{uuid.uuid4().hex}.{extension}"
+    minio_client.put_object(
+        bucket_name=MINIO_STORAGE_BUCKET_NAME,
+        object_name=temporary_name,
+        data=reader,
+        length=-1, # unknown length: MinIO uploads the stream in parts of IMAGE_UPLOAD_PART_SIZE bytes
+        part_size=IMAGE_UPLOAD_PART_SIZE,
+        content_type=content_type
+    )
+    try:
+        name = object_name(reader.hexdigest(), extension)
+        if image_stored(name):
+            print(f"Image '{name}' already in bucket '{MINIO_STORAGE_BUCKET_NAME}', not uploaded again")
+        else:
+            minio_client.copy_object(MINIO_STORAGE_BUCKET_NAME, name, CopySource(MINIO_STORAGE_BUCKET_NAME, temporary_name))
+            print(f"Image successfully uploaded as '{name}' to bucket '{MINIO_STORAGE_BUCKET_NAME}'")
+    finally:
+        minio_client.remove_object(MINIO_STORAGE_BUCKET_NAME, temporary_name)
+    return image_url(name)
+
+def upload_image(file):
+    """
+    Generates the variants of an uploaded image (see image_variants.py), stores the original and the variants
+    and returns their URLs. Raises InvalidImageError if the file is not a supported image.
+    """
+    (extension, content_type), variants = generate_variants(file.stream)
+    urls = {}
+    try:
+        urls['original'] = store_image_stream(file.stream, extension, content_type)
+        for variant, content in variants.items():
+            urls[variant] = store_image(*content)
+    except Exception:
+        # the variants already stored would stay in the bucket without a gatcha
+        try:
+            delete_unreferenced_images(set(urls.values()))
+        except Exception as e:
+            app.logger.error(f"Failed to delete the variants of a failed upload: {str(e)}")
+        raise
+    return urls
+
+def image_urls(gatcha):
+    urls = set((gatcha.get('variants') or {}).values())
+    if gatcha.get('image'):
+        urls.add(gatcha['image'])
+    return urls
+
+def delete_unreferenced_images(urls, excluded_gatcha_id=None):
+    """
+    Deletes from the MinIO bucket the images of urls that no gatcha uses (apart from excluded_gatcha_id):
+    the images are content-addressed, so the same object can be shared by more gatchas.
+    """
+    for url in urls:
+        query = {"$or": [{"image": url}] + [{f"variants.{variant}": url} for variant in IMAGE_VARIANTS]}
+        if excluded_gatcha_id is not None:
+            query["_id"] = {"$ne": excluded_gatcha_id}
+        if db[GATCHA_COLLECTION_NAME].find_one(query, {"_id": 1}) is None:
+            minio_client.remove_object(MINIO_STORAGE_BUCKET_NAME, url.replace(f"/storage/{MINIO_STORAGE_BUCKET_NAME}/", ""))
+
+def new_gatcha(data, file):
+    # Uploads the image of a new gatcha and returns its document, ready to be inserted.
+    data['variants'] = upload_image(file)
+    data['image'] = data['variants']['original'] # the field read by the clients before the variants
+    data["_id"] = uuid.uuid4().hex
+    data["NTot"] = 0
+    return data
+# endregion image upload
+
+
 # Endpoint per aggiungere dati nel database gacha_db
 @app.route('/gatchas', methods=['POST'])
 def add_gatcha_data():
@@ -185,66 +375,109 @@ def add_gatcha_data():
 
     if file.filename == '':
         return make_response(json_util.dumps({"error": "No image file uploaded"}), 400)
-    
-    gatcha_uuid = uuid.uuid4().hex
 
-    filename = secure_filename(file.filename)
-    filename = f"{gatcha_uuid}_{filename}" # create a unique filename
-    destination_file_path = f"images/{filename}"
+    # take the JSON from the request, the image URL is added to it after the upload
+    try:
+        data = json_util.loads(request.form.get('json'))
+    except Exception as e:
+        return make_response(json_util.dumps({"error": "Invalid JSON format provided"}), 400)
 
-    # Upload the file to MinIO bucket and get the image_url
+    error = validate_gatcha_data(data)
+    if error:
+        return make_response(json_util.dumps({"error": error}), 400)
+
+    # Upload the image and its variants to MinIO bucket and get their URLs
     try:
-        # Save the file to a temporary location
-        temp_file_path = os.path.join('/tmp', filename)
-        file.save(temp_file_path)
-
-        # Upload the file to MinIO
-        minio_client.fput_object(
-            bucket_name=MINIO_STORAGE_BUCKET_NAME, 
-            object_name=destination_file_path, 
-            file_path=temp_file_path,
-            content_type=file.content_type
-        )
-        print(
-            f"File '{file.filename}' successfully uploaded as '{destination_file_path}' to bucket '{MINIO_STORAGE_BUCKET_NAME}'"
-        )
-        image_url = f"/storage/{MINIO_STORAGE_BUCKET_NAME}/images/{filename}"
+        data = new_gatcha(data, file)
+    except InvalidImageError as e:
+        return make_response(json_util.dumps({"error": str(e)}), 400)
     except Exception as e:
         app.logger.error(f"Failed to upload image: {str(e)}")
         return make_response(json_util.dumps({"error": "Failed to upload image"}), 500)
-    finally:
-        # Clean up the temporary file
-        if os.path.exists(temp_file_path):
-            os.remove(temp_file_path)
 
-    # take the JSON from the request, and add the image URL we just defined to it
+    # insert the data into the database
     try:
-        data = json_util.loads(request.form.get('json'))
+        db[GATCHA_COLLECTION_NAME].insert_one(data)
+        catalogue.upsert(dict(data))
+        purge_gateway_cache()
+        
+        response = make_response(json_util.dumps({"message": "Data with image added to gatcha_db", "data": data}), 200)
+        response.headers['Content-Type'] = 'application/json'
+        return response
     except Exception as e:
-        return make_response(json_util.dumps({"error": "Invalid JSON format provided"}), 400)
+        return make_response(json_util.dumps({"error": f"Database insert failed: {str(e)}"}), 500)
 
-    if data is None:
-        return make_response(json_util.dumps({"error": "Invalid JSON format provided"}), 400)
-    
-    if data.get('name') is None:
-        return make_response(json_util.dumps({"error": "Invalid JSON format provided"}), 400)
 
-    if data.get('rarity') is None:
-        return make_response(json_util.dumps({"error": "Invalid JSON format provided"}), 400)
+# Endpoint per aggiungere tanti gatcha con una sola richiesta (usato da bootstrap.py e per importare cataloghi)
+@app.route('/gatchas/bulk', methods=['POST'])
+@role_required('adminUser')
+def add_gatchas_bulk():
+    """
+    Admins can use this endpoint to add many gatchas at once.
 
-    data['image'] = image_url
-    data["_id"] = gatcha_uuid
-    data["NTot"] = 0
+    Request format. A multipart request with:
+    - 'json': a JSON list of gatchas, each one with a "file" field: the name of the multipart part with its image.
+    - one file part for each gatcha, e.g. 'file0', 'file1', ...
+
+    The images (with their variants) are uploaded to MinIO in parallel and all the gatchas are inserted with a single insert_many.
+    Either all the gatchas are added or none of them: if an upload fails, the images already uploaded are deleted.
+    """
+    try:
+        records = json_util.loads(request.form.get('json') or 'null')
+    except Exception as e:
+        return make_response(json_util.dumps({"error": "Invalid JSON format provided"}), 400)
+    if not isinstance(records, list) or not records:
+        return make_response(json_util.dumps({"error": "json must be a non-empty list of gatchas"}), 400)
+    if len(records) > GATCHAS_BULK_MAX_RECORDS:
+        return make_response(json_util.dumps({"error": f"At most {GATCHAS_BULK_MAX_RECORDS} gatchas can be added at once"}), 400)
+
+    files = []
+    for index, data in enumerate(records):
+        error = validate_gatcha_data(data)
+        if error:
+            return make_response(json_util.dumps({"error": f"Gatcha {index}: {error}"}), 400)
+        file = request.files.get(data.pop('file', None) or '')
+        if file is None or file.filename == '':
+            return make_response(json_util.dumps({"error": f"Gatcha {index}: no image file uploaded"}), 400)
+        files.append(file)
+
+    # Upload all the images to the MinIO bucket
+    with ThreadPoolExecutor(max_workers=GATCHAS_BULK_UPLOAD_WORKERS) as executor:
+        futures = [executor.submit(new_gatcha, data, file) for data, file in zip(records, files)]
+    failed = [(index, future.exception()) for index, future in enumerate(futures) if future.exception() is not None]
+    gatchas = [future.result() for future in futures if future.exception() is None]
+    if failed:
+        index, error = failed[0]
+        app.logger.error(f"Failed to upload {len(failed)} of {len(records)} images: {str(error)}")
+        try:
+            delete_unreferenced_images(set().union(*(image_urls(gatcha) for gatcha in gatchas)))
+        except Exception as e:
+            app.logger.error(f"Failed to delete the images of a failed bulk import: {str(e)}")
+        if isinstance(error, InvalidImageError):
+            return make_response(json_util.dumps({"error": f"Gatcha {index}: {str(error)}"}), 400)
+        return make_response(json_util.dumps({"error": "Failed to upload images"}), 500)
 
     # insert the data into the database
     try:
-        db[GATCHA_COLLECTION_NAME].insert_one(data)
-        
-        response = make_response(json_util.dumps({"message": "Data with image added to gatcha_db", "data": data}), 200)
+        db[GATCHA_COLLECTION_NAME].insert_many(gatchas)
+    except Exception as e:
+        # all or nothing: remove the gatchas inserted before the failure, then their images
+        try:
+            db[GATCHA_COLLECTION_NAME].delete_many({"_id": {"$in": [gatcha["_id"] for gatcha in gatchas]}})
+            delete_unreferenced_images(set().union(*(image_urls(gatcha) for gatcha in gatchas)))
+        except Exception as cleanup_error:
+            app.logger.error(f"Failed to clean up a failed bulk import: {str(cleanup_error)}")
+        return make_response(json_util.dumps({"error": f"Database insert failed: {str(e)}"}), 500)
+    try:
+        for gatcha in gatchas:
+            catalogue.upsert(dict(gatcha))
+        purge_gateway_cache()
+
+        response = make_response(json_util.dumps({"message": f"{len(gatchas)} gatchas with images added to gatcha_db", "data": gatchas}), 200)
         response.headers['Content-Type'] = 'application/json'
         return response
     except Exception as e:
-        return make_response(json_util.dumps({"error": f"Database insert failed: {str(e)}"}), 500)
+        return make_response(json_util.dumps({"error": str(e)}), 500)
 
 
 @app.route('/gatchas/<gatcha_id>', methods=['DELETE'])
@@ -263,16 +496,15 @@ def delete_gatcha(gatcha_id):
             return make_response(json_util.dumps({"error": "Gatcha ID is required"}), 400)
 
         # Find the gatcha in the database
-        gatcha = db[GATCHA_COLLECTION_NAME].find_one({'_id': gatcha_id})
+        gatcha = db[GATCHA_COLLECTION_NAME].find_one({'_id': gatcha_id}, GATCHA_PROJECTION)
 
         if not gatcha:
             return make_response(json_util.dumps({"error": "Gatcha not found"}), 404)
 
-        # Delete the image from the MinIO bucket
+        # Delete the image and its variants from the MinIO bucket, unless another gatcha uses the same content
         if 'image' in gatcha:
-            image_path = gatcha['image'].replace(f"/storage/{MINIO_STORAGE_BUCKET_NAME}/", "")
             try:
-                minio_client.remove_object(MINIO_STORAGE_BUCKET_NAME, image_path)
+                delete_unreferenced_images(image_urls(gatcha), excluded_gatcha_id=gatcha_id)
             except S3Error as e:
                 return make_response(json_util.dumps({"error": f"Failed to delete image from MinIO: {str(e)}"}), 500)
 
@@ -282,6 +514,8 @@ def delete_gatcha(gatcha_id):
         if result.deleted_count == 0:
             return make_response(json_util.dumps({"error": "Gatcha not found"}), 404)
 
+        catalogue.remove(gatcha_id)
+        purge_gateway_cache()
         return make_response(json_util.dumps({"message": "Gatcha deleted successfully"}), 200)
     except Exception as e:
         return make_response(json_util.dumps({"error": f"Failed to delete gatcha: {str(e)}"}), 500)
@@ -302,40 +536,79 @@ def roll_gatcha():
         # Estrai la rarità in base alle probabilità definite
         selected_rarity = weighted_random_choice(RARITY_PROBABILITIES)
         
-        # Query al database per ottenere un gatcha della rarità selezionata
-        gachas = list(db[GATCHA_COLLECTION_NAME].find({"rarity": selected_rarity}))
-
-        if not gachas:
-            return make_response(f"No gatcha found for rarity {selected_rarity}\n", 404)
-        # Estrai un gatcha randomico dalla lista dei personaggi della rarità selezionata
-        gatcha = random.choice(gachas) if gachas else None
+        # Estrai un gatcha randomico della rarità selezionata dall'indice in memoria (nessuna query al database)
+        gatcha = catalogue.random_gatcha(selected_rarity)
         
         # Gestisci l'eventualità che non ci sia un gatcha di quella rarità
         if not gatcha:
             return make_response(f"No gatcha found for rarity {selected_rarity}\n", 404)
         
-        response = requests.post(USERL_URL + "/decrease_balance", json={"userID": userID, "amount": ROLL_PRICE}, verify=False, timeout=10)
-        if response.status_code != 200:
-            return make_response(jsonify({"error": "Failed to decrease balance", "details": response.text}), response.status_code)
-        
-        response = requests.post(USER_URL + "/add_gatcha", json={"userID": userID, "gatcha_ID": gatcha['_id']}, verify=False, timeout=10)
-        if response.status_code != 200:
-            return make_response(jsonify({"error": "Failed to add gatcha", "details": response.text}), response.status_code)
+        error = buy_gatchas(userID, ROLL_PRICE, {"userID": userID, "gatcha_ID": gatcha['_id']})
+        if error is not None:
+            return error
         
         response = make_response(json_util.dumps({"message": "Gatcha rolled successfully", "gatcha": gatcha}), 200)
         response.headers['Content-Type'] = 'application/json'
         
-        # Increment NTot for the selected gatcha
-        db[GATCHA_COLLECTION_NAME].update_one(
-            {'_id': gatcha['_id']},  # Trova il gatcha tramite il suo ID
-            {'$inc': {'NTot': 1}}       # Incrementa il campo NTot di 1
-        )
+        # NTot of the selected gatcha is incremented by the roll stats aggregator
+        roll_stats.record_rolls([gatcha])
+        catalogue.increment_ntot(gatcha['_id'])
         return response
     except Exception as e:
         return make_response(str(e), 500)
     
 
 
+# Endpoint per rollare più gatcha con una sola richiesta
+@app.route('/roll/batch', methods=['POST'])
+@role_required('normalUser')
+def roll_gatcha_batch():
+    """
+    Rolls count gatchas at once (e.g. a 10-pull).
+
+    Request format. JSON payload: {"count": <number of rolls, from 1 to ROLL_BATCH_MAX_COUNT>}
+
+    The user is charged count * ROLL_PRICE with a single call to the user service,
+    the gatchas are added to the collection with a single call and all the rolls are recorded with a single roll event.
+    """
+    try:
+        try:
+            userID = get_userID_from_jwt()
+        except Exception as e:
+            return make_response(json_util.dumps({"error": str(e)}), 401)
+
+        data = request.get_json(silent=True) or {}
+        count = data.get("count")
+        if not isinstance(count, int) or isinstance(count, bool) or count < 1 or count > ROLL_BATCH_MAX_COUNT:
+            return make_response(jsonify({"error": f"count must be an integer between 1 and {ROLL_BATCH_MAX_COUNT}"}), 400)
+
+        # Estrai tutte le rarità insieme, poi un gatcha per ogni rarità dall'indice in memoria
+        gatchas = []
+        for selected_rarity in weighted_random_choices(RARITY_PROBABILITIES, count):
+            gatcha = catalogue.random_gatcha(selected_rarity)
+            if not gatcha:
+                return make_response(f"No gatcha found for rarity {selected_rarity}\n", 404)
+            gatchas.append(gatcha)
+        gatcha_IDs = [gatcha['_id'] for gatcha in gatchas]
+
+        amount = count * ROLL_PRICE
+        error = buy_gatchas(userID, amount, {"userID": userID, "gatcha_IDs": gatcha_IDs})
+        if error is not None:
+            return error
+
+        # NTot of every rolled gatcha is incremented by the roll stats aggregator
+        roll_stats.record_rolls(gatchas)
+        for gatcha_id, rolls in Counter(gatcha_IDs).items():
+            catalogue.increment_ntot(gatcha_id, rolls)
+
+        response = make_response(json_util.dumps({"message": "Gatchas rolled successfully", "gatchas": gatchas}), 200)
+        response.headers['Content-Type'] = 'application/json'
+        return response
+    except Exception as e:
+        return make_response(str(e), 500)
+
+
+
 @app.route('/gatchas', methods=['GET'])
 @role_required('adminUser', 'normalUser')
 def get_all_gatcha():
@@ -347,7 +620,7 @@ def get_all_gatcha():
     - AS AN administrator I WANT TO check all the gacha collection SO THAT I can check all the collection
     """
     try:
-        all_gatcha = list(db[GATCHA_COLLECTION_NAME].find({}))
+        all_gatcha = list(db[GATCHA_COLLECTION_NAME].find({}, GATCHA_PROJECTION))
         response = make_response(json_util.dumps(all_gatcha), 200)
         response.headers['Content-Type'] = 'application/json'
         return response
@@ -355,6 +628,33 @@ def get_all_gatcha():
         return make_response(str(e), 500)
 
 
+@app.route('/gatchas/batch', methods=['POST'])
+@role_required('adminUser', 'normalUser')
+def get_gatchas_batch():
+    """
+    Endpoint to get many gatcha characters by ID with a single request (and a single $in query).
+
+    Request format. JSON payload: {"gatcha_IDs": [<gatcha ID>, ...]}, at most GATCHAS_BATCH_MAX_IDS IDs.
+    The response is the list of the gatchas found, in no particular order: the unknown IDs are skipped.
+
+    Used by the user service to return the collection of a user together with the gatcha details.
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        gatcha_IDs = data.get("gatcha_IDs")
+        if not isinstance(gatcha_IDs, list) or not all(isinstance(gatcha_ID, str) for gatcha_ID in gatcha_IDs):
+            return make_response(json_util.dumps({"error": "gatcha_IDs must be a list of gatcha IDs"}), 400)
+        if len(gatcha_IDs) > GATCHAS_BATCH_MAX_IDS:
+            return make_response(json_util.dumps({"error": f"At most {GATCHAS_BATCH_MAX_IDS} gatcha IDs can be requested at once"}), 400)
+
+        gatchas = list(db[GATCHA_COLLECTION_NAME].find({'_id': {'$in': gatcha_IDs}}, GATCHA_PROJECTION))
+        response = make_response(json_util.dumps(gatchas), 200)
+        response.headers['Content-Type'] = 'application/json'
+        return response
+    except Exception as e:
+        return make_response(str(e), 500)
+
+
 @app.route('/gatchas/<gatcha_id>', methods=['GET'])
 @role_required('adminUser', 'normalUser')
 def get_gatcha(gatcha_id):
@@ -366,7 +666,7 @@ def get_gatcha(gatcha_id):
     - AS AN administrator I WANT TO check a specific gacha SO THAT I can check the status of a gacha
     """
     try:
-        gatcha = db[GATCHA_COLLECTION_NAME].find_one({'_id': gatcha_id})
+        gatcha = db[GATCHA_COLLECTION_NAME].find_one({'_id': gatcha_id}, GATCHA_PROJECTION)
         if not gatcha:
             return make_response(json_util.dumps({"error": "Gatcha not found"}), 404)
         
@@ -403,7 +703,7 @@ def update_gatcha(gatcha_id):
             return make_response(json_util.dumps({"error": "You cannot update the _id field"}), 400)
 
         # Find the gatcha character in the database
-        gatcha = db[GATCHA_COLLECTION_NAME].find_one({'_id': gatcha_id})
+        gatcha = db[GATCHA_COLLECTION_NAME].find_one({'_id': gatcha_id}, GATCHA_PROJECTION)
         if not gatcha:
             return make_response(json_util.dumps({"error": "Gatcha not found"}), 404)
 
@@ -413,9 +713,35 @@ def update_gatcha(gatcha_id):
         if result.matched_count == 0:
             return make_response(json_util.dumps({"error": "Gatcha not found"}), 404)
 
-        updated_gatcha = db[GATCHA_COLLECTION_NAME].find_one({'_id': gatcha_id})
+        purge_gateway_cache()
+        updated_gatcha = db[GATCHA_COLLECTION_NAME].find_one({'_id': gatcha_id}, GATCHA_PROJECTION)
+        if updated_gatcha:
+            catalogue.upsert(updated_gatcha)
         response = make_response(json_util.dumps({"message": "Gatcha updated successfully", "data": updated_gatcha}), 200)
         response.headers['Content-Type'] = 'application/json'
         return response
     except Exception as e:
-        return make_response(json_util.dumps({"error": f"Failed to update gatcha: {str(e)}"}), 500)
\ No newline at end of file
+        return make_response(json_util.dumps({"error": f"Failed to update gatcha: {str(e)}"}), 500)
+
+
+# Endpoint to check the counters of the token introspection cache (see auth_utils.py)
+@app.route('/introspection-cache/stats', methods=['GET'])
+@role_required('adminUser')
+def introspection_cache_stats():
+    return make_response(jsonify(get_introspection_cache_stats()), 200)
+
+
+# Endpoint per le statistiche dei roll delle ultime ore, per rarità e per ora (aggregate da roll_stats.py)
+@app.route('/stats/rolls', methods=['GET'])
+@role_required('adminUser')
+def get_roll_stats():
+    try:
+        hours = int(request.args.get('hours', ROLL_STATS_DEFAULT_HOURS))
+    except ValueError:
+        return make_response(jsonify({"error": "hours must be an integer"}), 400)
+    if hours < 1 or hours > ROLL_STATS_MAX_HOURS:
+        return make_response(jsonify({"error": f"hours must be between 1 and {ROLL_STATS_MAX_HOURS}"}), 400)
+    try:
+        return make_response(jsonify(roll_stats.stats(hours)), 200)
+    except Exception as e:
+        return make_response(jsonify({"error": f"Failed to get the roll stats: {str(e)}"}), 500)
@@ -1,35 +1,68 @@
 import requests
 import json
 import os
+import uuid
+from datetime import datetime, timedelta
+
+import jwt
 
 import urllib3
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 STATE_FILE = './already_bootstrapped.txt'
+JWT_SECRET_FILE = os.getenv("JWT_SECRET_FILE", "/run/secrets/JWT_SECRET")
+JWT_ISSUER = os.getenv("JWT_ISSUER", "https://auth.ladygatcha.com")
+
+def admin_headers():
+    # /gatchas/bulk is for admins only: a short-lived admin token, signed with the shared JWT secret like the ones of auth
+    if not os.path.exists(JWT_SECRET_FILE):
+        return {} # e.g. the isolated tests, where the roles are not checked
+    with open(JWT_SECRET_FILE) as f:
+        secret = f.read().strip()
+    token = jwt.encode(
+        {
+            "sub": "gatcha-bootstrap",
+            "role": "adminUser",
+            "iat": datetime.now(),
+            "exp": datetime.now() + timedelta(minutes=5),
+            "iss": JWT_ISSUER,
+            "jti": str(uuid.uuid4())
+        },
+        secret,
+        algorithm="HS256"
+    )
+    return {"Authorization": f"Bearer {token}"}
 
-def send_request(url, name, rarity, file_path):
-    payload = {'json': json.dumps({
-        "name": name,
-        "rarity": rarity
-    })}
+def send_request(url, objects):
+    # all the gatchas in a single request to /gatchas/bulk: each record names the multipart part with its image
+    payload = {'json': json.dumps([
+        {"name": obj["name"], "rarity": obj["rarity"], "file": f"file{index}"}
+        for index, obj in enumerate(objects)
+    ])}
 
     files = [
-        ('file', (file_path.split('/')[-1], open(file_path, 'rb'), 'application/octet-stream'))
+        (f"file{index}", (obj["file_path"].split('/')[-1], open(obj["file_path"], 'rb'), 'application/octet-stream'))
+        for index, obj in enumerate(objects)
     ]
 
-    response = requests.request("POST", url, data=payload, files=files, verify=False)
+    try:
+        response = requests.request("POST", url, data=payload, files=files, headers=admin_headers(), verify=False)
+    finally:
+        for _, (_, file, _) in files:
+            file.close()
 
     if response.status_code == 200:
-        print(f"Successfully inserted images from {file_path}.")
-    else:
-        print(f"Failed to insert images from {file_path}. Status code: {response.status_code}, Response: {response.text}")
+        print(f"Successfully inserted {len(objects)} gatchas.")
+        return True
+    print(f"Failed to insert the gatchas. Status code: {response.status_code}, Response: {response.text}")
+    return False
 
 def main():
     if os.path.exists(STATE_FILE):
         print("Bootstrap has already been executed. Exiting.")
         return
 
-    url = "https://127.0.0.1:5000/gatchas"
+    url = "https://127.0.0.1:5000/gatchas/bulk"
     
     objects = [
         {"name": "ARTPOP - 2019 Reissue", "rarity": "comune", "file_path": './testimg/common/artpop-vinyl-reissue-4_orig.png'},
@@ -48,8 +81,9 @@ def main():
         {"name": "The Fame + The Fame Monster Box Set: The Fame Monster Silver Vinyl", "rarity": "leggendario", "file_path": './testimg/legendary/the-fame-monster-deluxe-edition-vinyl-6_orig.png'}
     ]
     
-    for obj in objects:
-        send_request(url, obj["name"], obj["rarity"], obj["file_path"])
+    if not send_request(url, objects):
+        # nothing was inserted (the bulk import is all or nothing): try again at the next start
+        return
 
     # Create the state file to indicate that the script has been executed
     with open(STATE_FILE, 'w') as f:
@@ -0,0 +1,162 @@
+import os
+import random
+import logging
+import threading
+import time
+from typing import Optional, Dict, Any, List, Tuple
+
+from pymongo.errors import PyMongoError, OperationFailure
+
+from roll_stats import ROLL_MARKS_FIELD
+
+logger = logging.getLogger(__name__)
+
+# In-process index of the gatcha catalogue, grouped by rarity, used by /roll.
+# A roll picks a random gatcha of the selected rarity in O(1), without reading the database.
+#
+# The index is kept up to date:
+# - directly by the admin endpoints (POST/PUT/DELETE /gatchas) of this process;
+# - by a MongoDB change stream, for the changes made by other processes;
+# - if change streams are not available (they need a replica set), by a full reload every CATALOGUE_REFRESH_SECONDS.
+
+CATALOGUE_REFRESH_SECONDS = int(os.getenv('CATALOGUE_REFRESH_SECONDS', '60'))
+CATALOGUE_CHANGE_STREAM_ENABLED = os.getenv('CATALOGUE_CHANGE_STREAM_ENABLED', 'True') == 'True'
+
+# the NTot counter is incremented at every roll: those updates are not worth a change event
+CHANGE_STREAM_PIPELINE = [
+    {'$match': {'$or': [
+        {'operationType': {'$in': ['insert', 'replace', 'delete', 'drop', 'invalidate']}},
+        {'operationType': 'update', 'updateDescription.updatedFields.NTot': {'$exists': False}},
+    ]}}
+]
+
+
+class CatalogueIndex:
+    """
+    Gatcha documents grouped by rarity.
+    Each rarity is a list (random.choice is O(1)) and the position of every gatcha is tracked,
+    so a gatcha is removed in O(1) by swapping it with the last one of its list.
+    """
+
+    def __init__(self):
+        self._buckets: Dict[str, List[Dict[str, Any]]] = {}
+        self._positions: Dict[str, Tuple[str, int]] = {} # gatcha _id -> (rarity, position in the bucket)
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._collection = None
+        self._refresher_started = False
+        self._change_stream_available = CATALOGUE_CHANGE_STREAM_ENABLED
+
+    def load(self, collection):
+        """Reloads the whole catalogue from the collection."""
+        buckets = {}
+        positions = {}
+        for gatcha in collection.find({}, {ROLL_MARKS_FIELD: 0}):
+            bucket = buckets.setdefault(gatcha.get('rarity'), [])
+            positions[gatcha['_id']] = (gatcha.get('rarity'), len(bucket))
+            bucket.append(gatcha)
+        with self._lock:
+            self._buckets = buckets
+            self._positions = positions
+            self._loaded = True
+        logger.info(f"Catalogue index loaded: {len(positions)} gatchas")
+
+    def ensure_loaded(self):
+        if not self._loaded:
+            self.load(self._collection)
+
+    def upsert(self, gatcha: Dict[str, Any]):
+        """Adds a gatcha to the index, or replaces it (also moving it to a different rarity)."""
+        gatcha.pop(ROLL_MARKS_FIELD, None) # bookkeeping of the roll aggregator, not returned by /roll
+        with self._lock:
+            self._remove(gatcha['_id'])
+            bucket = self._buckets.setdefault(gatcha.get('rarity'), [])
+            self._positions[gatcha['_id']] = (gatcha.get('rarity'), len(bucket))
+            bucket.append(gatcha)
+
+    def remove(self, gatcha_id: str):
+        with self._lock:
+            self._remove(gatcha_id)
+
+    def _remove(self, gatcha_id: str):
+        position = self._positions.pop(gatcha_id, None)
+        if position is None:
+            return
+        rarity, index = position
+        bucket = self._buckets[rarity]
+        last = bucket.pop()
+        if index < len(bucket):
+            # the removed gatcha was not the last one: the last one takes its place
+            bucket[index] = last
+            self._positions[last['_id']] = (rarity, index)
+
+    def random_gatcha(self, rarity: str) -> Optional[Dict[str, Any]]:
+        """Returns a copy of a random gatcha of the given rarity, or None if there are none."""
+        self.ensure_loaded()
+        with self._lock:
+            bucket = self._buckets.get(rarity)
+            if not bucket:
+                return None
+            return dict(random.choice(bucket))
+
+    def increment_ntot(self, gatcha_id: str, amount: int = 1):
+        """Keeps the NTot counter of the index in line with the $inc done on the database after a roll."""
+        with self._lock:
+            position = self._positions.get(gatcha_id)
+            if position is not None:
+                gatcha = self._buckets[position[0]][position[1]]
+                gatcha['NTot'] = gatcha.get('NTot', 0) + amount
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {rarity: len(bucket) for rarity, bucket in self._buckets.items()}
+
+    def start(self, collection):
+        """Starts (only once) the background thread that loads the catalogue and keeps it up to date."""
+        self._collection = collection
+        with self._lock:
+            if self._refresher_started:
+                return
+            self._refresher_started = True
+        threading.Thread(target=self._refresh, name='catalogue-index-refresher', daemon=True).start()
+
+    def _refresh(self):
+        try:
+            self.load(self._collection)
+        except PyMongoError as e:
+            # if it is still not loaded, the index is loaded by the first roll
+            logger.error(f"Failed to load the catalogue index: {e}")
+        while True:
+            if self._change_stream_available:
+                try:
+                    self._watch()
+                except OperationFailure as e:
+                    # e.g. a standalone mongod: change streams will never work, keep only the periodic reload
+                    logger.warning(f"Catalogue change stream not supported, reloading every {CATALOGUE_REFRESH_SECONDS}s: {e}")
+                    self._change_stream_available = False
+                except PyMongoError as e:
+                    logger.error(f"Catalogue change stream interrupted: {e}")
+            time.sleep(CATALOGUE_REFRESH_SECONDS)
+            try:
+                self.load(self._collection)
+            except PyMongoError as e:
+                logger.error(f"Failed to reload the catalogue index: {e}")
+
+    def _watch(self):
+        with self._collection.watch(CHANGE_STREAM_PIPELINE, full_document='updateLookup') as stream:
+            # the changes made before the stream was opened are not in the index yet
+            self.load(self._collection)
+            for change in stream:
+                operation = change['operationType']
+                if operation in ('insert', 'replace', 'update'):
+                    if change.get('fullDocument'):
+                        self.upsert(change['fullDocument'])
+                    else:
+                        # updated and then deleted before the lookup
+                        self.remove(change['documentKey']['_id'])
+                elif operation == 'delete':
+                    self.remove(change['documentKey']['_id'])
+                else:
+                    # drop / invalidate: the stream is closed, start again from a full reload
+                    logger.info(f"Catalogue change stream closed by a {operation} event")
+                    return
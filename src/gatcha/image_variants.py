@@ -0,0 +1,101 @@
+import os
+import io
+import hashlib
+from typing import BinaryIO, Dict, Tuple
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+# Variants of the gatcha images, generated once at upload time.
+# - original: the uploaded file, unchanged
+# - webp: the same image in WebP, usually a fraction of the size of the PNG/JPEG originals
+# - thumbnail: a WebP at most IMAGE_THUMBNAIL_SIZE pixels wide or high, for the listings
+# Every variant is stored under the SHA-256 of its content, so the same image uploaded twice is stored once.
+# The original is never read whole in memory: Pillow decodes it from the request stream, then it is streamed to the bucket
+# while its hash is computed (HashingReader).
+
+IMAGE_THUMBNAIL_SIZE = int(os.getenv('IMAGE_THUMBNAIL_SIZE', '256'))
+IMAGE_WEBP_QUALITY = int(os.getenv('IMAGE_WEBP_QUALITY', '80'))
+IMAGE_MAX_BYTES = int(os.getenv('IMAGE_MAX_BYTES', str(10 * 1024 * 1024)))
+# images with more pixels are rejected before being decoded (decompression bombs)
+IMAGE_MAX_PIXELS = int(os.getenv('IMAGE_MAX_PIXELS', str(50 * 1000 * 1000)))
+
+IMAGE_VARIANTS = ['original', 'webp', 'thumbnail']
+
+# Pillow format -> (extension, content type) of the originals
+ORIGINAL_FORMATS = {
+    'PNG': ('png', 'image/png'),
+    'JPEG': ('jpg', 'image/jpeg'),
+    'GIF': ('gif', 'image/gif'),
+    'WEBP': ('webp', 'image/webp'),
+}
+
+Image.MAX_IMAGE_PIXELS = IMAGE_MAX_PIXELS
+
+
+class InvalidImageError(ValueError):
+    pass
+
+
+class HashingReader:
+    """File-like wrapper of a stream that computes the SHA-256 of what is read through it."""
+
+    def __init__(self, stream: BinaryIO):
+        self.stream = stream
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size: int = -1) -> bytes:
+        chunk = self.stream.read(size)
+        self.sha256.update(chunk)
+        return chunk
+
+    def hexdigest(self) -> str:
+        return self.sha256.hexdigest()
+
+
+def object_name(digest: str, extension: str) -> str:
+    """Content-addressed name of an image in the bucket, from the SHA-256 hex digest of its content."""
+    return f"images/{digest}.{extension}"
+
+def stream_size(stream: BinaryIO) -> int:
+    # the uploaded files are seekable (werkzeug spools the large ones to a temporary file)
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell()
+    stream.seek(0)
+    return size
+
+def to_webp(image: Image.Image) -> bytes:
+    if image.mode not in ('RGB', 'RGBA'):
+        # e.g. palette or CMYK images: keep the transparency, if there is one
+        image = image.convert('RGBA' if 'transparency' in image.info or image.mode in ('P', 'LA', 'PA') else 'RGB')
+    output = io.BytesIO()
+    image.save(output, format='WEBP', quality=IMAGE_WEBP_QUALITY, method=4)
+    return output.getvalue()
+
+def generate_variants(original: BinaryIO) -> Tuple[Tuple[str, str], Dict[str, Tuple[bytes, str, str]]]:
+    """
+    Returns the (extension, content type) of an uploaded image and its generated variants:
+    {variant name: (content, extension, content type)}. The stream is left at its start, to be stored as the original.
+    Raises InvalidImageError if the file is not a supported image.
+    """
+    if stream_size(original) > IMAGE_MAX_BYTES:
+        raise InvalidImageError(f"The image is larger than {IMAGE_MAX_BYTES} bytes")
+    try:
+        image = Image.open(original)
+        image_format = image.format
+        image.load()
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError) as e:
+        raise InvalidImageError(f"Invalid image: {e}")
+    if image_format not in ORIGINAL_FORMATS:
+        raise InvalidImageError(f"Unsupported image format {image_format}")
+
+    # the photos can be stored rotated, with the orientation in the EXIF data
+    image = ImageOps.exif_transpose(image)
+    thumbnail = image.copy()
+    thumbnail.thumbnail((IMAGE_THUMBNAIL_SIZE, IMAGE_THUMBNAIL_SIZE), Image.Resampling.LANCZOS)
+
+    variants = {
+        'webp': (to_webp(image), 'webp', 'image/webp'),
+        'thumbnail': (to_webp(thumbnail), 'webp', 'image/webp'),
+    }
+    original.seek(0)
+    return ORIGINAL_FORMATS[image_format], variants
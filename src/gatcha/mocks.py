@@ -62,6 +62,10 @@ def start_mocking_http_requests():
     patcher = patch('requests.request', mock_request)
     patcher.start()
 
+    # the calls made with service_client.py go through a pooled requests.Session
+    session_patcher = patch('requests.Session.request', lambda self, method, url, *args, **kwargs: mock_request(method.upper(), url, *args, **kwargs))
+    session_patcher.start()
+
 
 
 
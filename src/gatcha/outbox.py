@@ -0,0 +1,160 @@
+from os import getenv
+from datetime import datetime, timedelta
+import threading
+import logging
+import time
+import uuid
+
+import requests
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+import service_client
+
+logger = logging.getLogger(__name__)
+
+# SHARED FILE (gatcha, market)
+# Calls that move money or gatchas to the user service, made safe to retry.
+# Every call carries an Idempotency-Key header: the user service applies it only once, however many times it is sent.
+# So the calls can have short timeouts and be retried right away (post_idempotent), and the calls that must
+# eventually happen (refunds, gatchas already paid for) go through an outbox: a MongoDB collection
+# of pending calls, retried with exponential backoff by a background worker until the user service answers.
+
+# ATTENZIONE: OGNI VOLTA CHE SI MODIFICA, LA NUOVA VERSIONE VA COPIATA IN TUTTI I MICROSERVIZI CHE LA USANO
+# per farlo, usare il file /shared/sync.py
+
+IDEMPOTENCY_KEY_HEADER = "Idempotency-Key"
+# timeout of a single attempt, and number of attempts made while the client is waiting
+OUTBOX_CALL_TIMEOUT = float(getenv("OUTBOX_CALL_TIMEOUT", "2"))
+OUTBOX_CALL_ATTEMPTS = int(getenv("OUTBOX_CALL_ATTEMPTS", "3"))
+OUTBOX_RETRY_INTERVAL_SECONDS = float(getenv("OUTBOX_RETRY_INTERVAL_SECONDS", "2"))
+OUTBOX_MAX_BACKOFF_SECONDS = float(getenv("OUTBOX_MAX_BACKOFF_SECONDS", "300"))
+OUTBOX_BATCH_SIZE = int(getenv("OUTBOX_BATCH_SIZE", "100"))
+# a message being sent is hidden from the other workers for this long
+OUTBOX_LEASE_SECONDS = float(getenv("OUTBOX_LEASE_SECONDS", "30"))
+
+# 409: the same key is still being processed by the user service
+RETRYABLE_STATUS_CODES = {409, 429}
+
+
+def new_idempotency_key():
+    return uuid.uuid4().hex
+
+def is_retryable(response):
+    # no answer (timeout, connection error) or a temporary error: the same call can be sent again
+    return response is None or response.status_code >= 500 or response.status_code in RETRYABLE_STATUS_CODES
+
+def post_idempotent(url, payload, idempotency_key, attempts=OUTBOX_CALL_ATTEMPTS):
+    """
+    POSTs payload with the idempotency key, retrying with the same key the timeouts, the connection errors,
+    the 5xx and the 409 (the same key still in progress).
+    Returns the definitive response, or None if the outcome is unknown: the call may or may not have been applied,
+    so it must not be compensated, only sent again with the same key.
+    """
+    response = None
+    for attempt in range(attempts):
+        if attempt > 0:
+            time.sleep(min(0.1 * 2 ** attempt, 1))
+        try:
+            response = service_client.post(url, json=payload, headers={IDEMPOTENCY_KEY_HEADER: idempotency_key}, timeout=OUTBOX_CALL_TIMEOUT)
+        except requests.RequestException as e:
+            logger.warning(f"Attempt {attempt + 1} of POST {url} ({idempotency_key}) failed: {e}")
+            response = None
+        if not is_retryable(response):
+            return response
+    if response is not None:
+        logger.warning(f"POST {url} ({idempotency_key}) still failing after {attempts} attempts: {response.status_code}")
+    return None
+
+
+class Outbox:
+    """Pending calls, one document for each: {_id: idempotency key, url, payload, attempts, next_attempt, created_at}."""
+
+    def __init__(self, collection):
+        self.collection = collection
+        self._started = False
+        self._lock = threading.Lock()
+
+    def create_indexes(self):
+        self.collection.create_index([("next_attempt", ASCENDING)])
+
+    def enqueue(self, url, payload, idempotency_key=None, delay=0):
+        """Stores a call, sent by the worker after delay seconds. Returns the stored message."""
+        now = datetime.now()
+        message = {
+            "_id": idempotency_key or new_idempotency_key(),
+            "url": url,
+            "payload": payload,
+            "attempts": 0,
+            "next_attempt": now + timedelta(seconds=delay),
+            "created_at": now
+        }
+        try:
+            self.collection.insert_one(message)
+        except DuplicateKeyError:
+            logger.info(f"Call {message['_id']} to {url} is already in the outbox")
+        return message
+
+    def deliver(self, url, payload, idempotency_key=None):
+        """
+        Stores a call in the outbox and sends it right away.
+        Returns True if it was delivered, otherwise the worker keeps retrying it.
+        """
+        # until the lease expires the worker leaves the message to this attempt
+        message = self.enqueue(url, payload, idempotency_key, delay=OUTBOX_LEASE_SECONDS)
+        return self._attempt(message)
+
+    def _attempt(self, message):
+        response = post_idempotent(message["url"], message["payload"], message["_id"], attempts=1)
+        if response is not None:
+            if response.status_code >= 400:
+                # a rejected call will never succeed: it is dropped, and only logged
+                logger.error(f"Call {message['_id']} to {message['url']} rejected, dropping it: {response.status_code} {response.text}")
+            self.collection.delete_one({"_id": message["_id"]})
+            return response.status_code < 400
+        attempts = message["attempts"] + 1
+        backoff = min(OUTBOX_RETRY_INTERVAL_SECONDS * 2 ** attempts, OUTBOX_MAX_BACKOFF_SECONDS)
+        self.collection.update_one(
+            {"_id": message["_id"]},
+            {"$set": {"attempts": attempts, "next_attempt": datetime.now() + timedelta(seconds=backoff)}}
+        )
+        return False
+
+    def retry_due(self):
+        """Sends again up to OUTBOX_BATCH_SIZE due calls. Returns how many were sent."""
+        sent = 0
+        while sent < OUTBOX_BATCH_SIZE:
+            now = datetime.now()
+            # the claim moves next_attempt forward, so the workers of the other replicas skip the message
+            message = self.collection.find_one_and_update(
+                {"next_attempt": {"$lte": now}},
+                {"$set": {"next_attempt": now + timedelta(seconds=OUTBOX_LEASE_SECONDS)}},
+                sort=[("next_attempt", ASCENDING)],
+                return_document=ReturnDocument.AFTER
+            )
+            if message is None:
+                break
+            self._attempt(message)
+            sent += 1
+        return sent
+
+    def start(self):
+        """Starts (only once) the background thread that retries the pending calls."""
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        threading.Thread(target=self._run, name='outbox-worker', daemon=True).start()
+
+    def _run(self):
+        try:
+            self.create_indexes()
+        except Exception as e:
+            logger.error(f"Error creating the outbox index: {e}")
+        while True:
+            try:
+                if self.retry_due() == OUTBOX_BATCH_SIZE:
+                    continue
+            except Exception as e:
+                logger.error(f"Error retrying the outbox calls: {e}")
+            time.sleep(OUTBOX_RETRY_INTERVAL_SECONDS)
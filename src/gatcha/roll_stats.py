@@ -0,0 +1,296 @@
+import os
+import json
+import time
+import uuid
+import socket
+import logging
+import threading
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Any, List, Tuple
+
+from bson import ObjectId
+from pymongo import ASCENDING, UpdateOne
+from pymongo.errors import DuplicateKeyError, BulkWriteError
+
+logger = logging.getLogger(__name__)
+
+# Aggregation of the rolls, out of the request path.
+# /roll does not update the NTot counter of the rolled gatcha any more: it appends a roll event to a Redis stream.
+# An aggregator thread (one consumer of a consumer group for each gatcha replica) reads the events and every
+# ROLL_AGGREGATION_INTERVAL_MS flushes the summed increments with one bulk_write on the gatchas (one update for each
+# distinct gatcha) and one on the roll statistics (one document for each rarity and hour).
+# The events are acknowledged only after the flush, so the events of a crashed replica are not lost:
+# they stay pending in the group and are claimed by the aggregators still alive.
+# If Redis is not reachable (or the stream is full, with the aggregators down) the rolls are applied directly to the database.
+#
+# A flush must not count the same events twice, also if it is interrupted and its events are read again.
+# So the summed increments of a batch are first stored in roll_flushes, with the IDs of its events (unique: an event
+# read again is never stored in a second flush), then the events are acknowledged, then the flush is applied.
+# Each applied document records, in the same update, the last flush of that consumer applied to it (roll_marks):
+# an interrupted flush is applied again (by its consumer, or by any aggregator once it is stale) only where it is missing.
+
+ROLL_EVENTS_STREAM = os.getenv('ROLL_EVENTS_STREAM', 'gatcha_roll_events')
+ROLL_EVENTS_GROUP = os.getenv('ROLL_EVENTS_GROUP', 'roll_aggregators')
+ROLL_EVENTS_STREAM_MAXLEN = int(os.getenv('ROLL_EVENTS_STREAM_MAXLEN', '100000'))
+ROLL_AGGREGATION_INTERVAL_MS = int(os.getenv('ROLL_AGGREGATION_INTERVAL_MS', '500'))
+ROLL_AGGREGATION_BATCH_SIZE = int(os.getenv('ROLL_AGGREGATION_BATCH_SIZE', '1000'))
+# the pending events of a consumer idle for this long are claimed by another one
+ROLL_EVENTS_CLAIM_IDLE_MS = int(os.getenv('ROLL_EVENTS_CLAIM_IDLE_MS', '60000'))
+ROLL_AGGREGATOR_RETRY_SECONDS = 5
+# an interrupted flush of another consumer is applied by this one after this long
+ROLL_FLUSH_STALE_SECONDS = int(os.getenv('ROLL_FLUSH_STALE_SECONDS', '60'))
+# the applied flushes (and their marks on the documents) are kept this long, to recognise the events read again
+ROLL_FLUSH_TTL_SECONDS = int(os.getenv('ROLL_FLUSH_TTL_SECONDS', str(24 * 60 * 60)))
+ROLL_MARKS_CLEANUP_INTERVAL_SECONDS = 60 * 60
+ROLL_MARKS_FIELD = 'roll_marks'
+DUPLICATE_KEY_ERROR_CODE = 11000
+
+# the event is appended only if the stream has room: the events still pending are never trimmed
+XADD_IF_ROOM_SCRIPT = """
+if redis.call('XLEN', KEYS[1]) >= tonumber(ARGV[1]) then
+    return false
+end
+return redis.call('XADD', KEYS[1], '*', 'rolls', ARGV[2], 'timestamp', ARGV[3])
+"""
+
+
+def hour_of(timestamp: float) -> datetime:
+    return datetime.fromtimestamp(timestamp).replace(minute=0, second=0, microsecond=0)
+
+def sum_rolls(events: List[Tuple[float, List[List[str]]]]) -> Tuple[Counter, Counter]:
+    """Sums a list of (timestamp, rolls) events: rolls per gatcha and rolls per (hour, rarity)."""
+    rolls_per_gatcha = Counter()
+    rolls_per_hour = Counter()
+    for timestamp, rolls in events:
+        hour = hour_of(timestamp)
+        for gatcha_id, rarity in rolls:
+            rolls_per_gatcha[gatcha_id] += 1
+            rolls_per_hour[(hour, rarity)] += 1
+    return rolls_per_gatcha, rolls_per_hour
+
+
+class RollStatsAggregator:
+    """
+    Emits the roll events and aggregates them into the NTot counters of the gatchas and into roll_stats:
+    {_id: "<hour>_<rarity>", hour, rarity, rolls}.
+    """
+
+    def __init__(self, gatchas, roll_stats, roll_flushes, get_redis_client: Callable):
+        self.gatchas = gatchas
+        self.roll_stats = roll_stats
+        self.roll_flushes = roll_flushes
+        self.get_redis_client = get_redis_client
+        # also a field name (in roll_marks): no dots
+        self.consumer = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}".replace('.', '_')
+        self._started = False
+        self._lock = threading.Lock()
+        self._marks_cleaned_at = 0
+
+    def create_indexes(self):
+        self.roll_stats.create_index([("hour", ASCENDING), ("rarity", ASCENDING)])
+        # an event is in at most one flush
+        self.roll_flushes.create_index("entry_ids", unique=True)
+        self.roll_flushes.create_index([("consumer", ASCENDING), ("_id", ASCENDING)])
+        # only the applied flushes expire
+        self.roll_flushes.create_index("applied_at", expireAfterSeconds=ROLL_FLUSH_TTL_SECONDS)
+
+    def record_rolls(self, gatchas: List[Dict[str, Any]]):
+        """Records the rolls of a request: a single stream entry, or the direct updates if Redis is not reachable."""
+        rolls = [[gatcha['_id'], gatcha.get('rarity')] for gatcha in gatchas]
+        now = time.time()
+        try:
+            redis_client = self.get_redis_client()
+            added = redis_client.eval(
+                XADD_IF_ROOM_SCRIPT, 1, ROLL_EVENTS_STREAM,
+                ROLL_EVENTS_STREAM_MAXLEN, json.dumps(rolls), now
+            )
+            if added:
+                return
+            logger.warning(f"Roll events stream full ({ROLL_EVENTS_STREAM_MAXLEN} events), updating the counters directly")
+        except Exception as e:
+            logger.warning(f"Roll events stream not available, updating the counters directly: {e}")
+        self.flush([(now, rolls)])
+
+    def flush(self, events: List[Tuple[float, List[List[str]]]]):
+        """Applies a list of (timestamp, rolls) events with one bulk_write for each collection (not through the stream)."""
+        rolls_per_gatcha, rolls_per_hour = sum_rolls(events)
+        self._apply(
+            [(gatcha_id, rolls) for gatcha_id, rolls in rolls_per_gatcha.items()],
+            [(hour, rarity, rolls) for (hour, rarity), rolls in rolls_per_hour.items()]
+        )
+
+    def _apply(self, gatchas, hours, mark=None):
+        """
+        Applies the increments of gatchas [(gatcha ID, rolls)] and hours [(hour, rarity, rolls)].
+        mark is (consumer, flush ID): the documents where that flush (or a later one of the consumer) was applied are skipped.
+        """
+        condition, set_mark = {}, {}
+        if mark is not None:
+            consumer, flush_id = mark
+            condition = {f"{ROLL_MARKS_FIELD}.{consumer}": {'$not': {'$gte': flush_id}}}
+            set_mark = {'$set': {f"{ROLL_MARKS_FIELD}.{consumer}": flush_id}}
+        if gatchas:
+            self.gatchas.bulk_write(
+                [UpdateOne({'_id': gatcha_id, **condition}, {'$inc': {'NTot': rolls}, **set_mark}) for gatcha_id, rolls in gatchas],
+                ordered=False
+            )
+        if hours:
+            try:
+                self.roll_stats.bulk_write(
+                    [UpdateOne(
+                        {'_id': f"{hour.isoformat()}_{rarity}", **condition},
+                        {'$inc': {'rolls': rolls}, '$setOnInsert': {'hour': hour, 'rarity': rarity}, **set_mark},
+                        upsert=True
+                    ) for hour, rarity, rolls in hours],
+                    ordered=False
+                )
+            except BulkWriteError as e:
+                # the upsert of a document where the flush was already applied (its filter does not match) hits the _id
+                if any(error["code"] != DUPLICATE_KEY_ERROR_CODE for error in e.details.get("writeErrors", [])):
+                    raise
+
+    def _record_flush(self, entries):
+        """
+        Stores the summed increments of entries [(entry ID, event)] as a flush of this consumer, leaving out
+        the events already stored in another flush. Returns the flush, or None if all of them were already stored.
+        """
+        while entries:
+            rolls_per_gatcha, rolls_per_hour = sum_rolls([event for _, event in entries])
+            flush = {
+                "_id": ObjectId(),
+                "consumer": self.consumer,
+                "entry_ids": [entry_id for entry_id, _ in entries],
+                "gatchas": [[gatcha_id, rolls] for gatcha_id, rolls in rolls_per_gatcha.items()],
+                "hours": [[hour, rarity, rolls] for (hour, rarity), rolls in rolls_per_hour.items()],
+                "created_at": datetime.now()
+            }
+            try:
+                self.roll_flushes.insert_one(flush)
+                return flush
+            except DuplicateKeyError:
+                # some events were read again (e.g. the acknowledgement failed): they are already counted
+                stored = set()
+                for other in self.roll_flushes.find({"entry_ids": {"$in": flush["entry_ids"]}}, {"entry_ids": 1}):
+                    stored.update(other["entry_ids"])
+                entries = [(entry_id, event) for entry_id, event in entries if entry_id not in stored]
+        return None
+
+    def _apply_flush(self, flush):
+        self._apply(flush["gatchas"], flush["hours"], mark=(flush["consumer"], flush["_id"]))
+        self.roll_flushes.update_one({"_id": flush["_id"]}, {"$set": {"applied_at": datetime.now()}})
+
+    def _apply_interrupted_flushes(self):
+        # the flushes of this consumer come first and in order: a later flush sets a later mark on the same documents
+        stale = datetime.now() - timedelta(seconds=ROLL_FLUSH_STALE_SECONDS)
+        interrupted = self.roll_flushes.find({
+            "applied_at": {"$exists": False},
+            "$or": [{"consumer": self.consumer}, {"created_at": {"$lte": stale}}]
+        }).sort("_id", ASCENDING)
+        for flush in interrupted:
+            self._apply_flush(flush)
+
+    def _clean_marks(self):
+        # the marks of the flushes already expired are not needed any more (e.g. of the consumers that stopped)
+        if time.monotonic() - self._marks_cleaned_at < ROLL_MARKS_CLEANUP_INTERVAL_SECONDS:
+            return
+        self._marks_cleaned_at = time.monotonic()
+        expired = ObjectId.from_datetime(datetime.now() - timedelta(seconds=ROLL_FLUSH_TTL_SECONDS))
+        for collection in (self.gatchas, self.roll_stats):
+            collection.update_many(
+                {ROLL_MARKS_FIELD: {"$exists": True}},
+                [{"$set": {ROLL_MARKS_FIELD: {"$arrayToObject": {"$filter": {
+                    "input": {"$objectToArray": f"${ROLL_MARKS_FIELD}"},
+                    "cond": {"$gt": ["$$this.v", expired]}
+                }}}}}]
+            )
+
+    def stats(self, hours: int) -> Dict[str, Any]:
+        """Rolls of the last hours, in total, per rarity and per hour."""
+        since = datetime.now().replace(minute=0, second=0, microsecond=0) - timedelta(hours=hours - 1)
+        per_rarity = Counter()
+        per_hour = {}
+        for entry in self.roll_stats.find({"hour": {"$gte": since}}, {"_id": 0}).sort("hour", ASCENDING):
+            per_rarity[entry["rarity"]] += entry["rolls"]
+            per_hour.setdefault(entry["hour"].isoformat(), {})[entry["rarity"]] = entry["rolls"]
+        return {
+            "since": since.isoformat(),
+            "total_rolls": sum(per_rarity.values()),
+            "per_rarity": dict(per_rarity),
+            "per_hour": [{"hour": hour, "rolls": rolls} for hour, rolls in per_hour.items()]
+        }
+
+    def start(self):
+        """Starts (only once) the background thread that aggregates the roll events."""
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        threading.Thread(target=self._run, name='roll-stats-aggregator', daemon=True).start()
+
+    def _run(self):
+        try:
+            self.create_indexes()
+        except Exception as e:
+            logger.error(f"Error creating the roll stats index: {e}")
+        while True:
+            try:
+                self._consume()
+            except Exception as e:
+                logger.error(f"Roll events aggregator interrupted: {e}")
+            time.sleep(ROLL_AGGREGATOR_RETRY_SECONDS)
+
+    def _consume(self):
+        redis_client = self.get_redis_client()
+        try:
+            redis_client.xgroup_create(ROLL_EVENTS_STREAM, ROLL_EVENTS_GROUP, id='0', mkstream=True)
+        except Exception as e:
+            if 'BUSYGROUP' not in str(e):
+                raise # the group already exists: every replica tries to create it
+        # first the events this consumer already read and did not acknowledge (e.g. a flush failed before the restart of the loop)
+        next_id = '0'
+        while True:
+            self._apply_interrupted_flushes()
+            self._clean_marks()
+            events, entry_ids = [], []
+            deadline = time.monotonic() + ROLL_AGGREGATION_INTERVAL_MS / 1000
+            while len(entry_ids) < ROLL_AGGREGATION_BATCH_SIZE:
+                block = int((deadline - time.monotonic()) * 1000)
+                if block <= 0:
+                    break
+                response = redis_client.xreadgroup(
+                    ROLL_EVENTS_GROUP, self.consumer, {ROLL_EVENTS_STREAM: next_id},
+                    count=ROLL_AGGREGATION_BATCH_SIZE - len(entry_ids), block=block
+                )
+                entries = response[0][1] if response else []
+                if next_id != '>':
+                    if not entries:
+                        next_id = '>' # no more old events, read the new ones
+                        continue
+                    # the old events are read in pages, starting after the last one returned
+                    next_id = entries[-1][0]
+                for entry_id, fields in entries:
+                    entry_ids.append(entry_id)
+                    events.append((float(fields['timestamp']), json.loads(fields['rolls'])))
+
+            events, entry_ids = self._claim_abandoned(redis_client, events, entry_ids)
+            if entry_ids:
+                # stored before the acknowledgement, applied after it: see the comment at the top
+                flush = self._record_flush(list(zip(entry_ids, events)))
+                redis_client.xack(ROLL_EVENTS_STREAM, ROLL_EVENTS_GROUP, *entry_ids)
+                redis_client.xdel(ROLL_EVENTS_STREAM, *entry_ids)
+                if flush is not None:
+                    self._apply_flush(flush)
+
+    def _claim_abandoned(self, redis_client, events, entry_ids):
+        # the events read and never acknowledged by a consumer that died (e.g. a replica scaled down)
+        _, claimed, *_ = redis_client.xautoclaim(
+            ROLL_EVENTS_STREAM, ROLL_EVENTS_GROUP, self.consumer,
+            min_idle_time=ROLL_EVENTS_CLAIM_IDLE_MS, start_id='0-0', count=ROLL_AGGREGATION_BATCH_SIZE
+        )
+        for entry_id, fields in claimed:
+            if fields is None or entry_id in entry_ids:
+                continue # deleted from the stream meanwhile, or already read
+            entry_ids.append(entry_id)
+            events.append((float(fields['timestamp']), json.loads(fields['rolls'])))
+        return events, entry_ids
@@ -1,12 +1,15 @@
 import os
 import logging
 from typing import Optional, Dict, Any, List
-import requests
+import service_client
 import re
 import bleach
 from flask import Flask, request, jsonify, Response
 from requests.exceptions import ConnectionError, HTTPError, RequestException
 from werkzeug.exceptions import BadRequest, MethodNotAllowed
+from routing import SERVICE_URLS, WHITELIST, VALID_SERVICE_REGEX, VALID_SUBPATH_REGEX, match_rule, validate_input
+from auth_utils import role_required
+import response_cache
 
 import urllib3
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
@@ -18,274 +21,97 @@ app = Flask(__name__)
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Regex per validare service_name e subpath
-VALID_SERVICE_REGEX = r'^[a-zA-Z0-9._-]+$'
-VALID_SUBPATH_REGEX = r'^[a-zA-Z0-9._/-]+$'
+# Streaming proxy: request and response bodies are piped in chunks between the client and the service,
+# so the gateway never holds a whole payload (e.g. a gatcha image) in memory.
+# Set STREAMING_PROXY to False to go back to buffering the whole bodies.
+STREAMING_PROXY = os.getenv('STREAMING_PROXY', 'True') == 'True'
+STREAM_CHUNK_SIZE = int(os.getenv('STREAM_CHUNK_SIZE', str(64 * 1024)))
 
-# Service URLs from environment variables with default values
-SERVICE_URLS = {
-    'user': os.getenv('USER_URL'),
-    'gatcha': os.getenv('GATCHA_URL'),
-    'market': os.getenv('MARKET_URL'),
-    'storage': os.getenv('MINIO_STORAGE_URL'),
-    'auth': os.getenv('AUTH_URL')
-}
-
-# WHITELIST of allowed endpoints
-# if an endpoint is commented out or not present in the whitelist, it will be blocked
-# remember to add comments to explain why an endpoint is allowed or not allowed
-WHITELIST = [
-    # minio storage microservice
-    {
-        'service': 'storage',
-        'method': 'GET',
-        'path': 'gachabucket/images/<file_name>' # accessibile anche a normalUser
-    },
-    
-    # auth microservice
-    {
-        'service': 'auth',
-        'method': 'POST',
-        'path': 'register' # accessibile anche a normalUser
-    },
-    # {
-    #     'service': 'auth',
-    #     'method': 'GET',
-    #     'path': 'debug/users' # accessibile solo a admin
-    # },
-    {
-        'service': 'auth',
-        'method': 'POST',
-        'path': 'login'
-    },
-    {
-        'service': 'auth',
-        'method': 'POST',
-        'path': 'editinfo'
-    },
-    {
-        'service': 'auth',
-        'method': 'POST',
-        'path': 'delete_user' # posso eliminare solo il mio account
-    },
-    {
-        'service': 'auth',
-        'method': 'GET',
-        'path': 'userinfo'
-    },
-    {
-        'service': 'auth',
-        'method': 'POST',
-        'path': 'introspect'
-    },
-    {
-        'service': 'auth',
-        'method': 'POST',
-        'path': 'tokens/revoke'
-    },
-    {
-        'service': 'auth',
-        'method': 'GET',
-        'path': 'test'
-    },
-    {
-        'service': 'auth',
-        'method': 'GET',
-        'path': 'test/normaluseronly'
-    },
-    {
-        'service': 'auth',
-        'method': 'GET',
-        'path': 'test/adminuseronly'
-    },
-    {
-        'service': 'auth',
-        'method': 'GET',
-        'path': 'test/bothroles'
-    },
-    {
-        'service': 'auth',
-        'method': 'GET',
-        'path': 'userid'
-    },
-
-    # gatcha microservice
-    # {
-    #     'service': 'gatcha',
-    #     'method': 'POST',
-    #     'path': 'gatchas' # solo gli admin possono creare gatchas
-    # },
-    # {
-    #     'service': 'gatcha',
-    #     'method': 'DELETE',
-    #     'path': 'gatchas/<gatcha_id>' # solo gli admin possono eliminare gatchas
-    # },
-    {
-        'service': 'gatcha',
-        'method': 'GET',
-        'path': 'roll'
-    },
-    {
-        'service': 'gatcha',
-        'method': 'GET',
-        'path': 'gatchas'
-    },
-    {
-        'service': 'gatcha',
-        'method': 'GET',
-        'path': 'gatchas/<gatcha_id>' 
-    },
-    # {
-    #     'service': 'gatcha',
-    #     'method': 'PUT',
-    #     'path': 'gatchas/<gatcha_id>' # solo gli admin possono modificare gatchas
-    # },
-
-    # market microservice
-    {
-        'service': 'market',
-        'method': 'POST',
-        'path': 'add-auction'
-    },
-    # {
-    #     'service': 'market',
-    #     'method': 'DELETE',
-    #     'path': 'delete-auction' # solo gli admin possono eliminare aste
-    # },
-    {
-        'service': 'market',
-        'method': 'POST',
-        'path': 'bid' # i normalUser possono fare offerte
-    },
-    {
-        'service': 'market',
-        'method': 'GET',
-        'path': 'auction' # chiunque può vedere le aste
-    },
-    {
-        'service': 'market',
-        'method': 'GET',
-        'path': 'auctions' # chiunque può vedere le aste
-    },
-    {
-        'service': 'market',
-        'method': 'GET',
-        'path': 'checkconnection'
-    },
-
-    # user microservice
-    # {
-    #     'service': 'user',
-    #     'method': 'POST',
-    #     'path': 'init-user' # chiamabile solo dal microservizio auth, gli utenti non possono chiamarlo
-    # },
-    # {
-    #     'service': 'user',
-    #     'method': 'POST',
-    #     'path': 'delete_user' # chiamabile solo dal microservizio auth, gli utenti non possono chiamarlo
-    # },
-    {
-        'service': 'user',
-        'method': 'GET',
-        'path': 'users/<userID>' # TODO: questo deve rimanere nella whitelist o va tolto? ogni utente può sapere la balance degli altri?
-    },
-    {
-        'service': 'user',
-        'method': 'GET',
-        'path': 'balance' # gli utenti possono sapere la loro balance
-    },
-    {
-        'service': 'user',
-        'method': 'POST',
-        'path': 'increase_balance' # gli utenti possono aumentare la loro balance (simula l'acquisto di ricarica)
-    },
-    # {
-    #     'service': 'user',
-    #     'method': 'POST',
-    #     'path': 'decrease_balance'
-    # },
-    {
-        'service': 'user',
-        'method': 'GET',
-        'path': 'transactions' # utente1 può vedere le transazioni di utente1
-    },
-    # {
-    #     'service': 'user',
-    #     'method': 'POST',
-    #     'path': 'refund'
-    # },
-    # {
-    #     'service': 'user',
-    #     'method': 'POST',
-    #     'path': 'add_gatcha' # solo gli admin o gli endpoint possono aggiungere gatchas senza fare roll
-    # },
-    # {
-    #     'service': 'user',
-    #     'method': 'POST',
-    #     'path': 'remove_gatcha' # solo gli admin o gli endpoint possono rimuovere gatchas
-    # },
-    {
-        'service': 'user',
-        'method': 'GET',
-        'path': 'collection' # user1 può vedere la sua collezione
-    },
-    {
-        'service': 'user',
-        'method': 'GET',
-        'path': 'collection/<gatcha_ID>' # user1 può vedere un gatcha della sua collezione
-    },
-    {
-        'service': 'user',
-        'method': 'GET',
-        'path': 'checkconnection'
-    },
-    # {
-    #     'service': 'user',
-    #     'method': 'GET',
-    #     'path': 'getAll'
-    # }
-]
-
-def is_request_allowed(service_name: str, method: str, subpath: str) -> bool:
+class RequestBodyStream:
     """
-    Checks if the incoming request is allowed based on the whitelist.
-
-    Args:
-        service_name (str): The name of the target service.
-        method (str): HTTP method of the request.
-        subpath (str): The subpath of the request.
-
-    Returns:
-        bool: True if the request is allowed, False otherwise.
+    Iterable over the body of the incoming request, read in chunks of STREAM_CHUNK_SIZE bytes.
+    It exposes the length of the body, so the request to the service is sent with the same
+    Content-Length of the original one instead of switching to chunked encoding.
     """
-    # Normalize the subpath by removing leading and trailing slashes
-    normalized_subpath = subpath.strip('/')
-    
-    logger.debug(f"Checking if request to {service_name}/{subpath} with method {method} is allowed")
-
-    for rule in WHITELIST:
-        # Check if the service and method match
-        if rule['service'] == service_name and method == rule['method']:
-            # Normalize the rule path by removing leading and trailing slashes
-            normalized_rule_path = rule['path'].strip('/')
-
-            # Split the paths into parts
-            rule_path_parts = normalized_rule_path.split('/')
-            subpath_parts = normalized_subpath.split('/')
-
-            # Check if the number of parts in the rule path and subpath match
-            if len(rule_path_parts) == len(subpath_parts):
-                match = True
-                for rule_part, subpath_part in zip(rule_path_parts, subpath_parts):
-                    # Check if each part matches or is a parameter (e.g., <gatcha_id>)
-                    if rule_part != subpath_part and not (rule_part.startswith('<') and rule_part.endswith('>')):
-                        match = False
-                        break
-
-                if match:
-                    return True
+    def __init__(self, stream, length):
+        self.stream = stream
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        while True:
+            chunk = self.stream.read(STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+def get_request_body():
+    """Return the body of the incoming request, as a stream if STREAMING_PROXY is enabled."""
+    if not STREAMING_PROXY:
+        return request.get_data()
+    if request.content_length:
+        return RequestBodyStream(request.stream, request.content_length)
+    if request.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+        # unknown length: the body is forwarded with chunked encoding
+        return iter(lambda: request.stream.read(STREAM_CHUNK_SIZE), b'')
+    return None
+
+def build_buffered_response(response) -> Response:
+    """Build the response for the client from the whole (already read and decoded) body of the service response."""
+    # Remove unnecessary headers in the response
+    excluded_headers = ['content-encoding', 'transfer-encoding', 'connection']
+    headers = [(name, value) for name, value in response.raw.headers.items()
+               if name.lower() not in excluded_headers]
+    return Response(response.content, response.status_code, headers)
+
+def build_response(response) -> Response:
+    """Build the response for the client from the response of the service."""
+    if not STREAMING_PROXY:
+        return build_buffered_response(response)
+
+    # the body is passed through as it is (not decoded), so content-encoding and content-length stay valid
+    excluded_headers = ['transfer-encoding', 'connection']
+    headers = [(name, value) for name, value in response.raw.headers.items()
+               if name.lower() not in excluded_headers]
+    body = response.raw.stream(STREAM_CHUNK_SIZE, decode_content=False)
+    proxied_response = Response(body, response.status_code, headers, direct_passthrough=True)
+    # give the connection back to the pool once the whole body has been sent to the client
+    proxied_response.call_on_close(response.close)
+    return proxied_response
+
+def serve_cached_response(rule: Dict[str, Any], subpath: str, target_url: str, headers: Dict[str, str]) -> Response:
+    """
+    Serves a GET request of a whitelist rule with a 'cache' entry.
+    On a cache miss the response is requested to the service (buffered, not streamed) and cached if it is a 200.
+    If the client already has the cached response (If-None-Match equal to its ETag) a 304 is returned.
+    """
+    cache = response_cache.get_response_cache(rule)
+    key = response_cache.cache_key(subpath, request.query_string)
+    cached_response = cache.get(key)
+    cache_status = 'HIT'
+    if cached_response is None:
+        cache_status = 'MISS'
+        response = service_client.request(
+            method='GET',
+            url=target_url,
+            params=request.args,
+            headers=headers,
+            cookies=request.cookies,
+            allow_redirects=False,
+            timeout=10,
+            verify=False
+        )
+        if response.status_code != 200:
+            return build_buffered_response(response)
+        cached_response = cache.put(key, response.status_code, list(response.raw.headers.items()), response.content)
 
-    return False
+    logger.debug(f"Cache {cache_status} for {target_url}")
+    cache_headers = [('ETag', cached_response.etag), ('X-Cache', cache_status)]
+    if cached_response.matches_etag(request.headers.get('If-None-Match')):
+        return Response(status=304, headers=cache_headers)
+    return Response(cached_response.body, cached_response.status_code, cached_response.headers + cache_headers)
 
 def forward_request(service_name: str, subpath: str) -> Response:
     """
@@ -318,36 +144,40 @@ def forward_request(service_name: str, subpath: str) -> Response:
         return jsonify({'error': 'Invalid subpath'}), 400
 
     # Check if the request is allowed
-    if not is_request_allowed(service_name, request.method, subpath):
+    rule = match_rule(service_name, request.method, subpath)
+    if rule is None:
         logger.warning(f"Request to {service_name}/{subpath} with method {request.method} is not allowed because is not in the whitelist.")
         return jsonify({'error': 'This endpoint was not found in this user gateway. (debug: it is not in the whitelist)'}), 404 # TODO: remove debug message
 
     # Construct the target URL
     target_url = f"{base_url}/{subpath}"
-    logger.info(f"Forwarding {request.method} request to {target_url} without query parameters")
+    logger.info(f"Forwarding {request.method} request to {target_url}")
 
     try:
         # Prepare headers (excluding 'host' to avoid conflicts)
         headers = {key: value for key, value in request.headers if key.lower() != 'host'}
 
-        # Forward the request without query parameters
-        response = requests.request(
+        if rule.get('cache') and request.method == 'GET':
+            # the cached responses are served without calling the service, so the gateway checks the token itself
+            roles = rule['cache'].get('roles')
+            serve = role_required(*roles)(serve_cached_response) if roles else serve_cached_response
+            return serve(rule, subpath, target_url, headers)
+
+        # Forward the request with its query parameters (e.g. the pagination cursors)
+        response = service_client.request(
             method=request.method,
             url=target_url,
-            data=request.get_data(),
+            params=request.args,
+            data=get_request_body(),
             headers=headers,
             cookies=request.cookies,
             allow_redirects=False,
             timeout=10,
-            verify=False
+            verify=False,
+            stream=STREAMING_PROXY
         )
 
-        # Remove unnecessary headers in the response
-        excluded_headers = ['content-encoding', 'transfer-encoding', 'connection']
-        headers = [(name, value) for name, value in response.raw.headers.items()
-                   if name.lower() not in excluded_headers]
-
-        return Response(response.content, response.status_code, headers)
+        return build_response(response)
 
     except ConnectionError as ce:
         logger.error(f"Connection error while accessing {target_url}: {ce}")
@@ -392,18 +222,3 @@ def gateway_handler(service, subpath):
 def index():
     """Health check route."""
     return jsonify({"message": "API Gateway is running"}), 200
-
-
-
-def validate_input(input_value: str, regex: str) -> bool:
-    """
-    Validates input using a regex pattern.
-
-    Args:
-        input_value (str): The input string to validate.
-        regex (str): The regex pattern to validate against.
-
-    Returns:
-        bool: True if the input matches the regex, False otherwise.
-    """
-    return re.match(regex, input_value) is not None
\ No newline at end of file
@@ -0,0 +1,200 @@
+import os
+import ssl
+import asyncio
+import logging
+import aiohttp
+from aiohttp import web
+from routing import SERVICE_URLS, VALID_SERVICE_REGEX, VALID_SUBPATH_REGEX, is_request_allowed, validate_input
+
+# Asyncio version of the user gateway (app.py).
+# Same WHITELIST, same input validation and same error responses, but every proxied request is a coroutine:
+# a single process keeps thousands of requests in flight while they wait for the services,
+# instead of blocking a worker thread for each one.
+#
+# uso (nel container del gateway):
+# python async_app.py
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# max number of connections open towards all the services, and towards a single service
+ASYNC_GATEWAY_MAX_CONNECTIONS = int(os.getenv('ASYNC_GATEWAY_MAX_CONNECTIONS', '1000'))
+ASYNC_GATEWAY_MAX_CONNECTIONS_PER_SERVICE = int(os.getenv('ASYNC_GATEWAY_MAX_CONNECTIONS_PER_SERVICE', '200'))
+UPSTREAM_TIMEOUT_SECONDS = 10
+STREAM_CHUNK_SIZE = int(os.getenv('STREAM_CHUNK_SIZE', str(64 * 1024)))
+
+GATEWAY_PORT = int(os.getenv('GATEWAY_PORT', '5000'))
+GATEWAY_CERT_FILE = os.getenv('GATEWAY_CERT_FILE', '/run/secrets/gateway_cert')
+GATEWAY_KEY_FILE = os.getenv('GATEWAY_KEY_FILE', '/run/secrets/gateway_key')
+
+# headers that are managed by each connection and must not be copied between the two sides of the proxy
+EXCLUDED_REQUEST_HEADERS = ['host', 'connection', 'keep-alive', 'transfer-encoding', 'content-length']
+EXCLUDED_RESPONSE_HEADERS = ['transfer-encoding', 'connection', 'keep-alive']
+
+HTTP_SESSION = web.AppKey('http_session', aiohttp.ClientSession)
+
+
+def json_error(message: str, status: int) -> web.Response:
+    return web.json_response({'error': message}, status=status)
+
+
+async def create_http_session(app: web.Application):
+    """Create the pooled HTTP client shared by all the proxied requests, and close it at shutdown."""
+    connector = aiohttp.TCPConnector(
+        limit=ASYNC_GATEWAY_MAX_CONNECTIONS,
+        limit_per_host=ASYNC_GATEWAY_MAX_CONNECTIONS_PER_SERVICE,
+        ssl=False # the services use self-signed certificates
+    )
+    app[HTTP_SESSION] = aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=None, connect=UPSTREAM_TIMEOUT_SECONDS, sock_read=UPSTREAM_TIMEOUT_SECONDS),
+        cookie_jar=aiohttp.DummyCookieJar(), # never store the cookies of a response: the session is shared by all users
+        auto_decompress=False # the bodies are passed through as they are
+    )
+    yield
+    await app[HTTP_SESSION].close()
+
+
+async def forward_request(request: web.Request, service_name: str, subpath: str) -> web.StreamResponse:
+    """
+    Forwards the incoming request to the specified service with the given subpath.
+    Request and response bodies are streamed in chunks.
+
+    Args:
+        request (web.Request): The incoming request.
+        service_name (str): The name of the target service.
+        subpath (str): The subpath to append to the service URL.
+
+    Returns:
+        web.StreamResponse: The response of the target service, or an error response.
+    """
+
+    logger.debug(f"Trying to forward the request to {service_name}/{subpath}")
+
+    # Validate the service name
+    if not validate_input(service_name, VALID_SERVICE_REGEX):
+        logger.warning(f"Invalid service name: {service_name}")
+        return json_error('Invalid service name', 400)
+
+    # Retrieve the base URL of the service
+    base_url = SERVICE_URLS.get(service_name)
+    if not base_url:
+        logger.warning(f"Unknown service: {service_name}")
+        return json_error('Service not found', 404)
+
+    # Validate the subpath
+    if not validate_input(subpath, VALID_SUBPATH_REGEX):
+        logger.warning(f"Invalid subpath: {subpath}")
+        return json_error('Invalid subpath', 400)
+
+    # Check if the request is allowed
+    if not is_request_allowed(service_name, request.method, subpath):
+        logger.warning(f"Request to {service_name}/{subpath} with method {request.method} is not allowed because is not in the whitelist.")
+        return json_error('This endpoint was not found in this user gateway. (debug: it is not in the whitelist)', 404) # TODO: remove debug message
+
+    # Construct the target URL
+    target_url = f"{base_url}/{subpath}"
+    logger.info(f"Forwarding {request.method} request to {target_url}")
+
+    headers = {key: value for key, value in request.headers.items() if key.lower() not in EXCLUDED_REQUEST_HEADERS}
+    body = None
+    if request.body_exists:
+        body = request.content.iter_chunked(STREAM_CHUNK_SIZE)
+        if request.content_length is not None:
+            # keep the original length, otherwise the body would be sent with chunked encoding
+            headers['Content-Length'] = str(request.content_length)
+
+    response = None
+    try:
+        async with request.app[HTTP_SESSION].request(
+            request.method,
+            target_url,
+            params=request.query,
+            data=body,
+            headers=headers,
+            allow_redirects=False
+        ) as upstream_response:
+            response = web.StreamResponse(
+                status=upstream_response.status,
+                headers={name: value for name, value in upstream_response.headers.items()
+                         if name.lower() not in EXCLUDED_RESPONSE_HEADERS}
+            )
+            await response.prepare(request)
+            async for chunk in upstream_response.content.iter_chunked(STREAM_CHUNK_SIZE):
+                await response.write(chunk)
+            await response.write_eof()
+            return response
+
+    except Exception as e:
+        if response is not None and response.prepared:
+            # the status line was already sent to the client: the only thing left to do is to drop the connection
+            logger.error(f"Error while streaming the response of {target_url}: {e}")
+            response.force_close()
+            return response
+        return upstream_error_response(target_url, e)
+
+
+def upstream_error_response(target_url: str, error: Exception) -> web.Response:
+    """Maps the errors of the HTTP client to the same responses returned by the Flask gateway."""
+    if isinstance(error, asyncio.TimeoutError):
+        logger.error(f"Timeout while accessing {target_url}: {error}")
+        return json_error('Error forwarding request', 500)
+    if isinstance(error, aiohttp.ClientConnectionError):
+        logger.error(f"Connection error while accessing {target_url}: {error}")
+        return json_error('Service unavailable', 503)
+    if isinstance(error, aiohttp.ClientResponseError):
+        logger.error(f"HTTP error while accessing {target_url}: {error}")
+        return json_error('HTTP error with service', error.status or 500)
+    if isinstance(error, aiohttp.ClientError):
+        logger.error(f"Request exception while accessing {target_url}: {error}")
+        return json_error('Error forwarding request', 500)
+    logger.exception(f"Unexpected error while forwarding to {target_url}: {error}")
+    return json_error('Internal server error', 500)
+
+
+# ERROR HANDLERS ---------------------------------------------------------------
+@web.middleware
+async def error_middleware(request: web.Request, handler):
+    """Returns the same JSON errors of the Flask gateway."""
+    try:
+        return await handler(request)
+    except web.HTTPNotFound:
+        return json_error('Resource not found', 404)
+    except web.HTTPMethodNotAllowed:
+        return json_error('Method not allowed', 405)
+    except web.HTTPBadRequest as e:
+        return json_error(e.text, 400)
+    except web.HTTPException:
+        raise
+    except Exception as e:
+        logger.exception(f"Unexpected error while handling {request.method} {request.path}: {e}")
+        return json_error('Internal server error', 500)
+
+
+# ROUTES -----------------------------------------------------------------------
+async def gateway_handler(request: web.Request) -> web.StreamResponse:
+    """
+    General gateway handler to route requests to appropriate services and subpaths.
+    Forwards the request without modifying the path or body.
+    """
+    return await forward_request(request, request.match_info['service'], request.match_info['subpath'])
+
+async def index(request: web.Request) -> web.Response:
+    """Health check route."""
+    return web.json_response({"message": "API Gateway is running"}, status=200)
+
+
+def create_app() -> web.Application:
+    app = web.Application(middlewares=[error_middleware])
+    app.cleanup_ctx.append(create_http_session)
+    app.router.add_get('/', index)
+    for method in ['GET', 'POST', 'PUT', 'DELETE', 'PATCH', 'OPTIONS', 'HEAD']:
+        app.router.add_route(method, '/{service}/{subpath:.+}', gateway_handler)
+    return app
+
+
+if __name__ == '__main__':
+    ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    ssl_context.load_cert_chain(GATEWAY_CERT_FILE, GATEWAY_KEY_FILE)
+    web.run_app(create_app(), host='0.0.0.0', port=GATEWAY_PORT, ssl_context=ssl_context)
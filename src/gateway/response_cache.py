@@ -0,0 +1,152 @@
+import os
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Optional, Dict, Any, List, Tuple
+
+from auth_utils import get_redis_client
+
+logger = logging.getLogger(__name__)
+
+# Response cache of the user gateway.
+# It is opt-in: only the WHITELIST rules with a 'cache' entry are cached, e.g.
+#   {'service': 'gatcha', 'method': 'GET', 'path': 'gatchas', 'cache': {'ttl': 30, 'max_entries': 16}}
+# Each rule gets its own bounded LRU cache. The services publish on GATEWAY_CACHE_PURGE_CHANNEL
+# the prefix of the paths they changed ("<service>" or "<service>/<subpath prefix>"),
+# and the matching entries are purged from every gateway.
+
+GATEWAY_CACHE_PURGE_CHANNEL = os.getenv('GATEWAY_CACHE_PURGE_CHANNEL', 'gateway_cache_purge')
+DEFAULT_CACHE_MAX_ENTRIES = 256
+PURGE_LISTENER_RETRY_SECONDS = 5
+
+# headers of the cached response that are not stored (they are set again when the response is served)
+EXCLUDED_CACHED_HEADERS = ['content-encoding', 'transfer-encoding', 'connection', 'content-length', 'etag']
+
+
+class CachedResponse:
+    def __init__(self, subpath: str, status_code: int, headers: List[Tuple[str, str]], body: bytes, expires_at: float):
+        self.subpath = subpath
+        self.status_code = status_code
+        self.headers = headers
+        self.body = body
+        self.expires_at = expires_at
+        self.etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+
+    def matches_etag(self, if_none_match: Optional[str]) -> bool:
+        """Returns True if the If-None-Match header of the client contains the ETag of this response."""
+        if not if_none_match:
+            return False
+        etags = [etag.strip() for etag in if_none_match.split(',')]
+        return '*' in etags or any(etag.removeprefix('W/') == self.etag for etag in etags)
+
+
+class ResponseCache:
+    """Bounded LRU cache of the responses of a whitelist rule, each entry lives for ttl seconds."""
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict() # (subpath, query string) -> CachedResponse
+        self._lock = threading.Lock()
+
+    def get(self, key: Tuple[str, bytes]) -> Optional[CachedResponse]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry.expires_at <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key: Tuple[str, bytes], status_code: int, headers: List[Tuple[str, str]], body: bytes) -> CachedResponse:
+        headers = [(name, value) for name, value in headers if name.lower() not in EXCLUDED_CACHED_HEADERS]
+        entry = CachedResponse(key[0], status_code, headers, body, time.time() + self.ttl)
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    def purge(self, subpath_prefix: str = '') -> int:
+        """Removes the entries whose subpath starts with subpath_prefix (all of them if it is empty)."""
+        with self._lock:
+            keys = [key for key, entry in self._entries.items() if entry.subpath.startswith(subpath_prefix)]
+            for key in keys:
+                del self._entries[key]
+        return len(keys)
+
+
+_caches: Dict[Tuple[str, str, str], ResponseCache] = {}
+_caches_lock = threading.Lock()
+_purge_listener_started = False
+
+
+def get_response_cache(rule: Dict[str, Any]) -> ResponseCache:
+    """Returns the cache of a whitelist rule, creating it on first use."""
+    key = (rule['service'], rule['method'], rule['path'])
+    cache = _caches.get(key)
+    if cache is None:
+        with _caches_lock:
+            cache = _caches.get(key)
+            if cache is None:
+                config = rule['cache']
+                cache = ResponseCache(config['ttl'], config.get('max_entries', DEFAULT_CACHE_MAX_ENTRIES))
+                _caches[key] = cache
+    start_purge_listener()
+    return cache
+
+
+def cache_key(subpath: str, query_string: bytes) -> Tuple[str, bytes]:
+    return (subpath.strip('/'), query_string)
+
+
+def purge(service_name: str, subpath_prefix: str = '') -> int:
+    """
+    Purge hook: removes from the cache the responses of a service whose subpath starts with subpath_prefix.
+
+    Returns:
+        int: The number of purged responses.
+    """
+    subpath_prefix = subpath_prefix.strip('/')
+    purged = 0
+    for (service, _, _), cache in list(_caches.items()):
+        if service == service_name:
+            purged += cache.purge(subpath_prefix)
+    logger.info(f"Purged {purged} cached responses of {service_name}/{subpath_prefix}")
+    return purged
+
+
+def purge_all():
+    for cache in list(_caches.values()):
+        cache.purge()
+
+
+def start_purge_listener():
+    """Starts (only once) the background thread that receives the purge messages published by the services."""
+    global _purge_listener_started
+    with _caches_lock:
+        if _purge_listener_started:
+            return
+        _purge_listener_started = True
+    threading.Thread(target=_listen_for_purges, name='gateway-cache-purge-listener', daemon=True).start()
+
+
+def _listen_for_purges():
+    while True:
+        try:
+            pubsub = get_redis_client().pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(GATEWAY_CACHE_PURGE_CHANNEL)
+            logger.info(f"Listening for cache purges on the redis channel {GATEWAY_CACHE_PURGE_CHANNEL}")
+            for message in pubsub.listen():
+                service_name, _, subpath_prefix = message['data'].partition('/')
+                purge(service_name, subpath_prefix)
+        except Exception as e:
+            logger.error('Lost the connection to the cache purge channel: ' + str(e))
+        # some purges could be lost while we are disconnected
+        purge_all()
+        time.sleep(PURGE_LISTENER_RETRY_SECONDS)
@@ -0,0 +1,365 @@
+import os
+import re
+import logging
+from typing import Optional, Dict, Any, List, Tuple, Pattern
+
+logger = logging.getLogger(__name__)
+
+# Routing rules of the user gateway: the services it can reach and the WHITELIST of the endpoints it exposes.
+# They are shared by the Flask gateway (app.py) and the asyncio gateway (async_app.py).
+
+# Regex per validare service_name e subpath (compilate una volta sola all'avvio)
+VALID_SERVICE_REGEX = re.compile(r'^[a-zA-Z0-9._-]+$')
+VALID_SUBPATH_REGEX = re.compile(r'^[a-zA-Z0-9._/-]+$')
+
+# Service URLs from environment variables with default values
+SERVICE_URLS = {
+    'user': os.getenv('USER_URL'),
+    'gatcha': os.getenv('GATCHA_URL'),
+    'market': os.getenv('MARKET_URL'),
+    'storage': os.getenv('MINIO_STORAGE_URL'),
+    'auth': os.getenv('AUTH_URL')
+}
+
+# WHITELIST of allowed endpoints
+# if an endpoint is commented out or not present in the whitelist, it will be blocked
+# remember to add comments to explain why an endpoint is allowed or not allowed
+# a GET endpoint can have a 'cache' entry to cache its responses in the gateway (see response_cache.py):
+#   'ttl': seconds a response is kept, 'max_entries': max number of cached responses,
+#   'roles': roles allowed to read the cached responses (the token is validated by the gateway on a cache hit)
+WHITELIST = [
+    # minio storage microservice
+    {
+        'service': 'storage',
+        'method': 'GET',
+        'path': 'gachabucket/images/<file_name>' # accessibile anche a normalUser
+    },
+    
+    # auth microservice
+    {
+        'service': 'auth',
+        'method': 'POST',
+        'path': 'register' # accessibile anche a normalUser
+    },
+    # {
+    #     'service': 'auth',
+    #     'method': 'GET',
+    #     'path': 'debug/users' # accessibile solo a admin
+    # },
+    {
+        'service': 'auth',
+        'method': 'POST',
+        'path': 'login'
+    },
+    {
+        'service': 'auth',
+        'method': 'POST',
+        'path': 'editinfo'
+    },
+    {
+        'service': 'auth',
+        'method': 'POST',
+        'path': 'delete_user' # posso eliminare solo il mio account
+    },
+    {
+        'service': 'auth',
+        'method': 'GET',
+        'path': 'userinfo'
+    },
+    {
+        'service': 'auth',
+        'method': 'POST',
+        'path': 'introspect'
+    },
+    {
+        'service': 'auth',
+        'method': 'POST',
+        'path': 'tokens/revoke'
+    },
+    {
+        'service': 'auth',
+        'method': 'GET',
+        'path': 'test'
+    },
+    {
+        'service': 'auth',
+        'method': 'GET',
+        'path': 'test/normaluseronly'
+    },
+    {
+        'service': 'auth',
+        'method': 'GET',
+        'path': 'test/adminuseronly'
+    },
+    {
+        'service': 'auth',
+        'method': 'GET',
+        'path': 'test/bothroles'
+    },
+    {
+        'service': 'auth',
+        'method': 'GET',
+        'path': 'userid'
+    },
+
+    # gatcha microservice
+    # {
+    #     'service': 'gatcha',
+    #     'method': 'POST',
+    #     'path': 'gatchas' # solo gli admin possono creare gatchas
+    # },
+    # {
+    #     'service': 'gatcha',
+    #     'method': 'DELETE',
+    #     'path': 'gatchas/<gatcha_id>' # solo gli admin possono eliminare gatchas
+    # },
+    {
+        'service': 'gatcha',
+        'method': 'GET',
+        'path': 'roll'
+    },
+    {
+        'service': 'gatcha',
+        'method': 'POST',
+        'path': 'roll/batch' # multi-roll (es. 10-pull), solo normalUser
+    },
+    {
+        'service': 'gatcha',
+        'method': 'GET',
+        'path': 'gatchas',
+        # il catalogo cambia raramente: le risposte restano in cache nel gateway per 30 secondi
+        'cache': {'ttl': 30, 'max_entries': 64, 'roles': ['adminUser', 'normalUser']}
+    },
+    {
+        'service': 'gatcha',
+        'method': 'GET',
+        'path': 'gatchas/<gatcha_id>',
+        'cache': {'ttl': 30, 'max_entries': 1024, 'roles': ['adminUser', 'normalUser']}
+    },
+    {
+        'service': 'gatcha',
+        'method': 'POST',
+        'path': 'gatchas/batch' # dettagli di molti gatcha con una sola richiesta
+    },
+    # {
+    #     'service': 'gatcha',
+    #     'method': 'PUT',
+    #     'path': 'gatchas/<gatcha_id>' # solo gli admin possono modificare gatchas
+    # },
+
+    # market microservice
+    {
+        'service': 'market',
+        'method': 'POST',
+        'path': 'add-auction'
+    },
+    # {
+    #     'service': 'market',
+    #     'method': 'DELETE',
+    #     'path': 'delete-auction' # solo gli admin possono eliminare aste
+    # },
+    {
+        'service': 'market',
+        'method': 'POST',
+        'path': 'bid' # i normalUser possono fare offerte
+    },
+    {
+        'service': 'market',
+        'method': 'GET',
+        'path': 'auction' # chiunque può vedere le aste
+    },
+    {
+        'service': 'market',
+        'method': 'GET',
+        'path': 'auctions/<auction_id>/bids' # storico delle offerte di un'asta, chiunque può vederlo
+    },
+    {
+        'service': 'market',
+        'method': 'GET',
+        'path': 'auctions', # chiunque può vedere le aste
+        # le aste cambiano a ogni bid: TTL breve, il market purga comunque la cache a ogni modifica
+        'cache': {'ttl': 2, 'max_entries': 256}
+    },
+    {
+        'service': 'market',
+        'method': 'GET',
+        'path': 'checkconnection'
+    },
+
+    # user microservice
+    # {
+    #     'service': 'user',
+    #     'method': 'POST',
+    #     'path': 'init-user' # chiamabile solo dal microservizio auth, gli utenti non possono chiamarlo
+    # },
+    # {
+    #     'service': 'user',
+    #     'method': 'POST',
+    #     'path': 'delete_user' # chiamabile solo dal microservizio auth, gli utenti non possono chiamarlo
+    # },
+    {
+        'service': 'user',
+        'method': 'GET',
+        'path': 'users/<userID>' # TODO: questo deve rimanere nella whitelist o va tolto? ogni utente può sapere la balance degli altri?
+    },
+    {
+        'service': 'user',
+        'method': 'GET',
+        'path': 'balance' # gli utenti possono sapere la loro balance
+    },
+    {
+        'service': 'user',
+        'method': 'POST',
+        'path': 'increase_balance' # gli utenti possono aumentare la loro balance (simula l'acquisto di ricarica)
+    },
+    # {
+    #     'service': 'user',
+    #     'method': 'POST',
+    #     'path': 'decrease_balance'
+    # },
+    {
+        'service': 'user',
+        'method': 'GET',
+        'path': 'transactions' # utente1 può vedere le transazioni di utente1
+    },
+    # {
+    #     'service': 'user',
+    #     'method': 'POST',
+    #     'path': 'refund'
+    # },
+    # {
+    #     'service': 'user',
+    #     'method': 'POST',
+    #     'path': 'add_gatcha' # solo gli admin o gli endpoint possono aggiungere gatchas senza fare roll
+    # },
+    # {
+    #     'service': 'user',
+    #     'method': 'POST',
+    #     'path': 'remove_gatcha' # solo gli admin o gli endpoint possono rimuovere gatchas
+    # },
+    {
+        'service': 'user',
+        'method': 'GET',
+        'path': 'collection' # user1 può vedere la sua collezione
+    },
+    {
+        'service': 'user',
+        'method': 'GET',
+        'path': 'collection/<gatcha_ID>' # user1 può vedere un gatcha della sua collezione
+    },
+    {
+        'service': 'user',
+        'method': 'GET',
+        'path': 'checkconnection'
+    },
+    # {
+    #     'service': 'user',
+    #     'method': 'GET',
+    #     'path': 'getAll'
+    # }
+]
+
+def is_path_parameter(part: str) -> bool:
+    """Returns True if the part of a rule path is a parameter (e.g., <gatcha_id>), that matches any segment."""
+    return part.startswith('<') and part.endswith('>')
+
+
+def _new_node() -> Dict[str, Any]:
+    return {'children': {}, 'parameter': None, 'rule': None}
+
+
+def compile_whitelist(rules: List[Dict[str, Any]]) -> Dict[Tuple[str, str], Dict[str, Any]]:
+    """
+    Compiles the whitelist into one segment trie for each (service, method) pair.
+
+    Every node of a trie has:
+    - 'children': the nodes of the literal segments that can follow (e.g. 'gatchas')
+    - 'parameter': the node of a <parameter> segment, if any rule has one in that position
+    - 'rule': the whitelist rule that ends in that node, if any
+
+    Args:
+        rules (list): The whitelist rules, each with 'service', 'method' and 'path'.
+
+    Returns:
+        dict: The root node of the trie of each (service, method) pair.
+    """
+    index = {}
+    for rule in rules:
+        node = index.setdefault((rule['service'], rule['method']), _new_node())
+        for part in rule['path'].strip('/').split('/'):
+            if is_path_parameter(part):
+                if node['parameter'] is None:
+                    node['parameter'] = _new_node()
+                node = node['parameter']
+            else:
+                node = node['children'].setdefault(part, _new_node())
+        if node['rule'] is None:
+            node['rule'] = rule
+    return index
+
+
+def _match_node(node: Dict[str, Any], parts: List[str], position: int) -> Optional[Dict[str, Any]]:
+    if position == len(parts):
+        return node['rule']
+    # literal segments have precedence over parameters
+    child = node['children'].get(parts[position])
+    if child is not None:
+        rule = _match_node(child, parts, position + 1)
+        if rule is not None:
+            return rule
+    if node['parameter'] is not None:
+        return _match_node(node['parameter'], parts, position + 1)
+    return None
+
+
+# the whitelist is compiled once at startup: edit WHITELIST above, not this index
+COMPILED_WHITELIST = compile_whitelist(WHITELIST)
+
+
+def match_rule(service_name: str, method: str, subpath: str) -> Optional[Dict[str, Any]]:
+    """
+    Finds the whitelist rule that matches the request, walking the compiled trie one segment at a time.
+
+    Args:
+        service_name (str): The name of the target service.
+        method (str): HTTP method of the request.
+        subpath (str): The subpath of the request.
+
+    Returns:
+        dict: The matching whitelist rule, or None if the request is not in the whitelist.
+    """
+    root = COMPILED_WHITELIST.get((service_name, method))
+    if root is None:
+        return None
+    # Normalize the subpath by removing leading and trailing slashes, then split it into parts
+    return _match_node(root, subpath.strip('/').split('/'), 0)
+
+
+def is_request_allowed(service_name: str, method: str, subpath: str) -> bool:
+    """
+    Checks if the incoming request is allowed based on the whitelist.
+
+    Args:
+        service_name (str): The name of the target service.
+        method (str): HTTP method of the request.
+        subpath (str): The subpath of the request.
+
+    Returns:
+        bool: True if the request is allowed, False otherwise.
+    """
+    logger.debug(f"Checking if request to {service_name}/{subpath} with method {method} is allowed")
+    return match_rule(service_name, method, subpath) is not None
+
+
+def validate_input(input_value: str, regex: Pattern[str]) -> bool:
+    """
+    Validates input using a regex pattern.
+
+    Args:
+        input_value (str): The input string to validate.
+        regex (Pattern): The compiled regex pattern to validate against.
+
+    Returns:
+        bool: True if the input matches the regex, False otherwise.
+    """
+    return regex.match(input_value) is not None
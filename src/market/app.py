@@ -1,13 +1,15 @@
 import os
-from apscheduler.schedulers.background import BackgroundScheduler
-from apscheduler.triggers.date import DateTrigger
 from flask import Flask, request, make_response, jsonify
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument, ASCENDING, DESCENDING, UpdateOne
 import bson.json_util as json_util
 from pymongo.errors import ServerSelectionTimeoutError
-import requests
-from auth_utils import role_required, get_userID_from_jwt
+import service_client
+from outbox import Outbox, post_idempotent, new_idempotency_key, OUTBOX_CALL_TIMEOUT
+from finalization import AuctionFinalizer, AUCTION_STATUS_ACTIVE, AUCTION_STATUS_FINALIZING
+from bid_history import BidHistory, PENDING_HISTORY_FIELD
+from auth_utils import role_required, get_userID_from_jwt, get_introspection_cache_stats, get_redis_client
 import time
+import requests
 from datetime import datetime, timedelta
 import logging
 
@@ -18,17 +20,124 @@ logging.basicConfig(level=logging.DEBUG)
 
 USER_URL = os.getenv('USER_URL')
 
+# canale redis su cui chiediamo ai gateway di svuotare la cache delle risposte (vedi gateway/response_cache.py)
+GATEWAY_CACHE_PURGE_CHANNEL = os.getenv('GATEWAY_CACHE_PURGE_CHANNEL', 'gateway_cache_purge')
+
 client_market = MongoClient("db-market", 27017, maxPoolSize=50)
 db_market = client_market["db_market"]
 Bids = db_market["Bids"]
 Auctions = db_market["Auctions"]
+Counters = db_market["Counters"] # un documento per ogni sequenza di ID: {"_id": "Auction_ID", "value": <ultimo ID assegnato>}
+# chiamate al user service che devono andare a buon fine prima o poi (rimborsi, gatcha da restituire), vedi outbox.py
+outbox = Outbox(db_market["outbox"])
+# errori definitivi della finalizzazione delle aste (es. un utente cancellato prima della consegna), da controllare a mano
+SettlementErrors = db_market["SettlementErrors"]
+
+# Lo storico completo delle offerte è nella collection Bids, il documento dell'asta tiene solo le AUCTION_TOP_BIDS più alte
+AUCTION_TOP_BIDS = int(os.getenv('AUCTION_TOP_BIDS', '5'))
+BIDS_DEFAULT_PAGE_SIZE = int(os.getenv('BIDS_DEFAULT_PAGE_SIZE', '50'))
+BIDS_MAX_PAGE_SIZE = int(os.getenv('BIDS_MAX_PAGE_SIZE', '500'))
+
+AUCTIONS_DEFAULT_PAGE_SIZE = int(os.getenv('AUCTIONS_DEFAULT_PAGE_SIZE', '50'))
+AUCTIONS_MAX_PAGE_SIZE = int(os.getenv('AUCTIONS_MAX_PAGE_SIZE', '500'))
+# campi delle aste restituiti da /auctions (senza le offerte)
+AUCTION_LISTING_PROJECTION = {
+    "_id": 0, "Auction_ID": 1, "Gatcha_ID": 1, "Auctioner_ID": 1, "Winner_ID": 1,
+    "starting_price": 1, "current_price": 1, "creation_time": 1, "end_time": 1
+}
+
+
+def next_id(sequence):
+    # Allocates the next ID of the sequence with an atomic $inc: no duplicates under concurrency or after deletions,
+    # and a constant cost instead of counting the whole collection.
+    counter = Counters.find_one_and_update(
+        {"_id": sequence},
+        {"$inc": {"value": 1}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    return counter["value"]
+
+# le offerte accettate arrivano nello storico (Bids) anche se il primo inserimento fallisce, vedi bid_history.py
+bid_history = BidHistory(Auctions, Bids, next_id)
+
+def seed_id_counters():
+    """Moves the counters past the IDs already used."""
+    last_auction = Auctions.find_one({}, {"Auction_ID": 1}, sort=[("Auction_ID", DESCENDING)])
+    last_bid = Bids.find_one({}, {"Bid_ID": 1}, sort=[("Bid_ID", DESCENDING)])
+    # the bids are also stored inside their auction
+    embedded_bids = list(Auctions.aggregate([
+        {"$unwind": "$bids"},
+        {"$group": {"_id": None, "Bid_ID": {"$max": "$bids.Bid_ID"}}}
+    ]))
+    last_IDs = {
+        "Auction_ID": last_auction["Auction_ID"] if last_auction else 0,
+        "Bid_ID": max(last_bid["Bid_ID"] if last_bid else 0, embedded_bids[0]["Bid_ID"] or 0 if embedded_bids else 0)
+    }
+    for sequence, last_ID in last_IDs.items():
+        # $max never moves a counter back
+        Counters.update_one({"_id": sequence}, {"$max": {"value": last_ID}}, upsert=True)
+
+def duplicate_ids(collection, field):
+    # the documents sharing an ID with an older one (allocated with count_documents()+1 before the counters), oldest excluded
+    groups = collection.aggregate([
+        {"$match": {field: {"$exists": True}}},
+        {"$group": {"_id": f"${field}", "documents": {"$push": "$_id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}}
+    ])
+    return [(group["_id"], document_id) for group in groups for document_id in sorted(group["documents"])[1:]]
 
-scheduler = BackgroundScheduler()
-scheduler.start()
+def deduplicate_ids():
+    """Gives a new ID to the auctions and bids that share their ID with an older one, so the unique indexes can be created."""
+    for old_ID, document_id in duplicate_ids(Auctions, "Auction_ID"):
+        auction = Auctions.find_one({"_id": document_id}, {"bids": 1})
+        new_ID = next_id("Auction_ID")
+        Auctions.update_one({"_id": document_id}, {"$set": {"Auction_ID": new_ID}})
+        # the history of the bids follows the auction, as far as its bids are known (only the top ones are embedded)
+        bid_IDs = [bid["Bid_ID"] for bid in auction.get("bids") or [] if "Bid_ID" in bid]
+        if bid_IDs:
+            Bids.update_many({"Auction_ID": old_ID, "Bid_ID": {"$in": bid_IDs}}, {"$set": {"Auction_ID": new_ID}})
+        logging.warning(f"Duplicate Auction_ID {old_ID}: auction {document_id} renumbered to {new_ID}")
+    for old_ID, document_id in duplicate_ids(Bids, "Bid_ID"):
+        bid = Bids.find_one({"_id": document_id})
+        new_ID = next_id("Bid_ID")
+        Bids.update_one({"_id": document_id}, {"$set": {"Bid_ID": new_ID}})
+        # and its copy inside the auction, if it is one of the top bids
+        Auctions.update_one(
+            {"Auction_ID": bid["Auction_ID"]},
+            {"$set": {"bids.$[bid].Bid_ID": new_ID}},
+            array_filters=[{"bid.Bid_ID": old_ID, "bid.User_ID": bid.get("User_ID"), "bid.timestamp": bid.get("timestamp")}]
+        )
+        logging.warning(f"Duplicate Bid_ID {old_ID}: bid {document_id} renumbered to {new_ID}")
+
+def create_indexes():
+    Auctions.create_index("Auction_ID", unique=True)
+    Bids.create_index("Bid_ID", unique=True)
+    # bid history of an auction, from the highest bid
+    Bids.create_index([("Auction_ID", ASCENDING), ("amount", DESCENDING)])
+    # /auctions listing: sorted by end_time (and Auction_ID for the ties), optionally filtered by Gatcha_ID
+    Auctions.create_index([("end_time", ASCENDING), ("Auction_ID", ASCENDING)])
+    Auctions.create_index([("Gatcha_ID", ASCENDING), ("end_time", ASCENDING), ("Auction_ID", ASCENDING)])
+
+# each step runs even if the previous one failed: the counters are seeded first, so next_id never reissues an ID in use
+for init_step in (seed_id_counters, deduplicate_ids, create_indexes):
+    try:
+        init_step()
+    except Exception as e:
+        logging.error(f"Error initializing the IDs ({init_step.__name__}): {e}")
 
 app = Flask(__name__, instance_relative_config=True)
 
 
+def purge_gateway_cache():
+    # Asks the gateways to drop their cached auction listings, after an auction was added, changed or removed.
+    # A failure is only logged: the cached responses expire anyway after their TTL.
+    try:
+        get_redis_client().publish(GATEWAY_CACHE_PURGE_CHANNEL, "market/auctions")
+    except Exception as e:
+        logging.error(f"Failed to purge the gateway cache: {e}")
+
+
 UNIT_TEST_MODE = os.getenv('UNIT_TEST_MODE', 'False') == 'True'
 
 if UNIT_TEST_MODE:
@@ -53,37 +162,38 @@ def add_auction():
         return make_response(jsonify({"error": "Gatcha_ID and starting_price are required"}), 400)
     
     auction = {
-        "Auction_ID": Auctions.count_documents({}) + 1,
         "Gatcha_ID": data.get("Gatcha_ID"),
         "Auctioner_ID": userID,
         "Winner_ID": "",
         "starting_price": data.get("starting_price"),
         "current_price": data.get("starting_price"), # current highest bid value, to be refounded if another higher bid is placed
         "creation_time": datetime.now(),
-        "end_time": datetime.now() + timedelta(minutes=1)
+        "end_time": datetime.now() + timedelta(minutes=1), # after the end_time the auction is finalized by the finalizer
+        "status": AUCTION_STATUS_ACTIVE
     }
+    auction_key = new_idempotency_key()
     try:
-        response = requests.post(
+        response = post_idempotent(
             USER_URL + "/remove_gatcha",
-            json={"userID": auction["Auctioner_ID"], "gatcha_ID": auction["Gatcha_ID"]},
-            verify=False,
-            timeout=10
+            {"userID": auction["Auctioner_ID"], "gatcha_ID": auction["Gatcha_ID"]},
+            f"{auction_key}-remove"
         )
+        if response is None:
+            return make_response(jsonify({"error": "User service unavailable"}), 503)
         if response.status_code != 200:
             return make_response(jsonify({"error": "Gatcha not owned"}), 400)
         
-        Auctions.insert_one(auction)
+        try:
+            # the ID is allocated only for the auctions actually created
+            auction["Auction_ID"] = next_id("Auction_ID")
+            Auctions.insert_one(auction)
+        except Exception:
+            # compensation: the auction was not created, give the gatcha back to the auctioner
+            outbox.deliver(USER_URL + "/add_gatcha", {"userID": auction["Auctioner_ID"], "gatcha_ID": auction["Gatcha_ID"]}, f"{auction_key}-return")
+            raise
+        purge_gateway_cache()
 
         logging.debug(f"End time: {auction['end_time']}")
-        # adding a job to finalize the auction
-        scheduler.add_job(
-            finalize_auction,
-            trigger=DateTrigger(run_date=auction["end_time"]),
-            args=[auction["Auction_ID"], auction["Gatcha_ID"]],
-            id=f"finalize_auction_{auction['Auction_ID']}",
-            replace_existing=True
-        )
-
         return make_response(jsonify({"message": "Auction added successfully"}), 201)
     except Exception as e:
         return make_response(jsonify({"error": str(e)}), 500)
@@ -100,85 +210,168 @@ def delete_auction():
         if not auction:
             return make_response(jsonify({"error": "Auction not found"}), 404)
         
-        # if the auction has a winner, his bid needs to be refounded
-        if auction["Winner_ID"]:
-            previous_winner = auction["Winner_ID"]
-            previous_bid_amount = auction["current_price"]
-            response = requests.post(
-                USER_URL + "/refund",
-                json={"userID": previous_winner, "amount": previous_bid_amount},
-                verify=False,
-                timeout=10
-            )
-            if response.status_code != 200:
-                return make_response(jsonify({"error": "Failed to refund previous winner"}), 500)
+        if auction.get("status") == AUCTION_STATUS_FINALIZING:
+            return make_response(jsonify({"error": "Auction is being finalized"}), 409)
         
-        result = Auctions.delete_one({"Auction_ID": auction_id})
-        if result.deleted_count == 1:
-            return make_response(jsonify({"message": "Auction deleted successfully"}), 200)
-        else:
-            return make_response(jsonify({"error": "Auction not found"}), 404)
+        # the auction is deleted only as it was read: still active (not claimed by the finalizer)
+        # and with the same winner and price (no bid placed in the meantime)
+        deleted = Auctions.find_one_and_delete(
+            {
+                "Auction_ID": auction_id,
+                "status": AUCTION_STATUS_ACTIVE,
+                "Winner_ID": auction["Winner_ID"],
+                "current_price": auction["current_price"]
+            },
+            projection={"Auction_ID": 1, "Winner_ID": 1, "current_price": 1, PENDING_HISTORY_FIELD: 1}
+        )
+        if deleted is None:
+            return make_response(jsonify({"error": "Auction changed while deleting it, try again"}), 409)
+        purge_gateway_cache()
+        try:
+            # the bids of the auction not yet in the history are stored from the deleted document
+            bid_history.flush(deleted)
+        except Exception as e:
+            logging.error(f"Failed to store the pending bids of the deleted auction {auction_id} in the bid history: {e}")
+        
+        # if the auction has a winner, his bid needs to be refounded: the auction is gone, so the refund
+        # goes through the outbox and is retried until it is delivered
+        if deleted["Winner_ID"]:
+            refund_user(deleted["Winner_ID"], deleted["current_price"], f"auction-{auction_id}-delete-refund")
+        return make_response(jsonify({"message": "Auction deleted successfully"}), 200)
     except Exception as e:
         return make_response(jsonify({"error": str(e)}), 500)
     
 
-# Thread function to delete an auction after a delay.
-def finalize_auction(auction_id, gatcha_id):
-    try:
-        logging.debug(f"------------------------------------------ Finalizing auction {auction_id}------------------------------------------")
-        auction = Auctions.find_one({"Auction_ID": auction_id})
-        if not auction:
-            logging.debug(f"Auction {auction_id} not found")
-            return
-
-        # Handle the winner or refund
-        if auction["Winner_ID"] != "":
-            response = requests.post(USER_URL + "/add_gatcha", json={
-                "userID": auction["Winner_ID"],
-                "gatcha_ID": gatcha_id},
-                 verify=False,
-                 timeout=10
-            )
-            
-            if response.status_code != 200:
-                print(f"Failed to add gatcha to winner for auction {auction_id}")
-                return
-
-            response = requests.post(USER_URL + "/increase_balance", json={
-                "userID": auction["Auctioner_ID"],
-                "amount": auction["current_price"]},
-                verify=False,
-                timeout=10
-            )
-            
-            if response.status_code != 200:
-                print(f"Failed to increase balance for auctioner {auction_id}")
-                return
-        else:
-            # Refund the gatcha to the auctioner if no bids were placed
-            response = requests.post(USER_URL + "/add_gatcha", json={
-                "userID": auction["Auctioner_ID"],
-                "gatcha_ID": gatcha_id},
-                verify=False,
-                timeout=10
+# region auction finalization
+def settlement_operations(auction):
+    # the operations on the user service still needed to finalize an auction, with the step each one completes
+    if auction["Winner_ID"] != "":
+        operations = []
+        if not auction.get("gatcha_delivered"):
+            operations.append(("gatcha_delivered", {"type": "add_gatcha", "userID": auction["Winner_ID"], "gatcha_ID": auction["Gatcha_ID"]}))
+        if not auction.get("payment_delivered"):
+            operations.append(("payment_delivered", {"type": "increase_balance", "userID": auction["Auctioner_ID"], "amount": auction["current_price"]}))
+        return operations
+    if not auction.get("gatcha_delivered"):
+        # Refund the gatcha to the auctioner if no bids were placed
+        return [("gatcha_delivered", {"type": "add_gatcha", "userID": auction["Auctioner_ID"], "gatcha_ID": auction["Gatcha_ID"]})]
+    return []
+
+# le operazioni di un batch vanno al user service a pezzi di SETTLEMENT_CHUNK_SIZE, ognuno con un timeout proporzionale
+SETTLEMENT_CHUNK_SIZE = int(os.getenv('SETTLEMENT_CHUNK_SIZE', '100'))
+SETTLEMENT_TIMEOUT_PER_OPERATION = float(os.getenv('SETTLEMENT_TIMEOUT_PER_OPERATION', '0.05'))
+
+def is_terminal_settlement_error(status):
+    # the 4xx of /settle are definitive, apart from 409 (the same key still in progress)
+    return 400 <= status < 500 and status != 409
+
+def finalize_auctions(auctions, lease_owner):
+    """
+    Finalizes a batch of expired auctions, claimed by the AuctionFinalizer (see finalization.py) with lease_owner:
+    the gatcha goes to the winner and the price to the auctioner, or the gatcha goes back to the auctioner
+    if nobody placed a bid. Then the auctions are deleted.
+    The transfers of the batch are applied with /settle calls to the user service, SETTLEMENT_CHUNK_SIZE operations each.
+    If a transfer fails temporarily (timeout, 409, 5xx) its auction is left in the "finalizing" state,
+    and retried after FINALIZATION_RETRY_SECONDS.
+    A transfer rejected for good (e.g. 404: the user was deleted meanwhile) will never succeed: it is recorded
+    in SettlementErrors and its step is closed, like the collection and the balance of a deleted user are.
+    """
+    logging.debug(f"Finalizing auctions {[auction['Auction_ID'] for auction in auctions]}")
+    pending = [] # (auction, step) of each operation sent to the user service
+    operations = []
+    for auction in auctions:
+        for step, operation in settlement_operations(auction):
+            pending.append((auction, step))
+            # the same key at every retry of the auction: a step settled before a timeout or a crash is not applied twice
+            operation["idempotency_key"] = f"auction-{auction['Auction_ID']}-{step}"
+            operations.append(operation)
+
+    failed = set()
+    completed_steps = []
+    errors = []
+    for offset in range(0, len(operations), SETTLEMENT_CHUNK_SIZE):
+        chunk = operations[offset:offset + SETTLEMENT_CHUNK_SIZE]
+        chunk_pending = pending[offset:offset + SETTLEMENT_CHUNK_SIZE]
+        response = None
+        try:
+            response = service_client.post(
+                USER_URL + "/settle", json={"operations": chunk}, verify=False,
+                timeout=OUTBOX_CALL_TIMEOUT + SETTLEMENT_TIMEOUT_PER_OPERATION * len(chunk)
             )
-            if response.status_code != 200:
-                print(f"Failed to return gatcha to auctioner for auction {auction_id}")
-                return
-
-        # Delete the auction
-        result = Auctions.delete_one({"Auction_ID": auction_id})
-        if result.deleted_count == 1:
-            print(f"Auction {auction_id} finalized.")
-        else:
-            print(f"Failed to delete auction {auction_id}")
-    except Exception as e:
-        print(f"Error finalizing auction {auction_id}: {e}")
+            results = response.json()["results"] if response.status_code == 200 else None
+        except (requests.RequestException, ValueError, KeyError) as e:
+            print(f"Failed to settle {len(chunk)} operations: {e}")
+            results = None
+        if results is None:
+            # outcome unknown: the same keys are sent again at the retry
+            if response is not None and response.status_code != 200:
+                print(f"Failed to settle {len(chunk)} operations: {response.status_code}")
+            failed.update(auction["Auction_ID"] for auction, _ in chunk_pending)
+            continue
+
+        # records the completed steps on the auctions, so a retry (after a crash or a failure) does not repeat them
+        for (auction, step), operation, result in zip(chunk_pending, chunk, results):
+            if result["status"] == 200 or is_terminal_settlement_error(result["status"]):
+                completed_steps.append(UpdateOne({"Auction_ID": auction["Auction_ID"], "lease_owner": lease_owner}, {"$set": {step: True}}))
+            else:
+                failed.add(auction["Auction_ID"])
+            if result["status"] != 200:
+                print(f"Failed to settle {step} for auction {auction['Auction_ID']}: {result['status']} {result.get('error')}")
+            if is_terminal_settlement_error(result["status"]):
+                errors.append({
+                    "Auction_ID": auction["Auction_ID"],
+                    "step": step,
+                    "operation": operation,
+                    "status": result["status"],
+                    "error": result.get("error"),
+                    "timestamp": datetime.now()
+                })
+    if errors:
+        # recorded before closing the steps: a crash in between retries them and records them again at worst
+        SettlementErrors.insert_many(errors, ordered=False)
+    if completed_steps:
+        Auctions.bulk_write(completed_steps, ordered=False)
+
+    # Delete the finalized auctions, only if this process still holds their lease
+    # and after their bids are in the bid history (the auctions claimed do not get new bids: they ended)
+    finalized = []
+    for auction in auctions:
+        if auction["Auction_ID"] in failed:
+            continue
+        try:
+            bid_history.flush(auction)
+            finalized.append(auction["Auction_ID"])
+        except Exception as e:
+            print(f"Failed to store the pending bids of auction {auction['Auction_ID']}: {e}")
+            failed.add(auction["Auction_ID"])
+    if failed:
+        # retried soon by any replica, not at the end of the lease
+        finalizer.release(failed)
+    if not finalized:
+        return
+    result = Auctions.delete_many({"Auction_ID": {"$in": finalized}, "lease_owner": lease_owner})
+    if result.deleted_count > 0:
+        purge_gateway_cache()
+    print(f"{result.deleted_count} of {len(auctions)} auctions finalized.")
 
+# le aste scadute vengono finalizzate da un thread in background, che le cerca nel database (niente job in memoria)
+finalizer = AuctionFinalizer(Auctions, finalize_auctions)
+finalizer.start()
+bid_history.start()
+outbox.start()
+# endregion auction finalization
 
 
 @app.route('/bid', methods=['POST'])
 def bid():
+    """
+    Places a bid on an auction.
+
+    The bidder is charged first, then the bid is applied with a single conditional update (compare-and-set):
+    it succeeds only if the amount is still higher than the current price and the auction has not ended.
+    Of two concurrent bids only one can win: the loser gets its money back.
+    The previous winner is refunded only after the new bid is secured.
+    """
     data = request.json
     try: 
         userID = get_userID_from_jwt()
@@ -191,56 +384,90 @@ def bid():
         return make_response(jsonify({"error": "Bid amount must be positive"}), 400)
     
     bid = {
-        "Bid_ID": Bids.count_documents({}) + 1,
         "Auction_ID": data.get("Auction_ID"),
         "User_ID": userID,
         "amount": data.get("amount"),
         "timestamp": datetime.now()
     }
     try:
-        auction = Auctions.find_one({"Auction_ID": bid["Auction_ID"]})
+        # the checks on a first read give the precise errors without charging the bidder,
+        # the conditional update below is what actually guarantees them
+        auction = Auctions.find_one(
+            {"Auction_ID": bid["Auction_ID"]},
+            {"Auctioner_ID": 1, "Winner_ID": 1, "current_price": 1, "end_time": 1}
+        )
         if not auction:
             return make_response(jsonify({"error": "Auction not found"}), 404)
         
         if auction["Auctioner_ID"] == userID:
             return make_response(jsonify({"error": "You cannot bid on your own auction"}), 400)
         
+        if auction["end_time"] <= bid["timestamp"]:
+            return make_response(jsonify({"error": "Auction has already ended"}), 400)
+        
         if int(bid["amount"]) <= int(auction["current_price"]):
             return make_response(jsonify({"error": "Bid amount must be higher than current price"}), 400)
         
-        # if the auction has a winner, his bid needs to be refounded
-        if auction["Winner_ID"] != "":
-            if auction["Winner_ID"] == userID:
-                return make_response(jsonify({"error": "You are already the winner of this auction"}), 400)
-            previous_winner = auction["Winner_ID"]
-            previous_bid_amount = auction["current_price"]
-            response = requests.post(
-                USER_URL + "/refund",
-                json={"userID": previous_winner, "amount": previous_bid_amount},
-                verify=False,
-                timeout=10
-            )
-            if response.status_code != 200:
-                return make_response(jsonify({"error": "Failed to refund previous winner"}), 500)
+        if auction["Winner_ID"] == userID:
+            return make_response(jsonify({"error": "You are already the winner of this auction"}), 400)
         
         # decrease the bidder's balance
-        response = requests.post(
-            USER_URL + "/decrease_balance",
-            json={"userID": userID, "amount": bid["amount"]},
-            verify=False,
-            timeout=10
-        )
+        bid_key = new_idempotency_key()
+        response = post_idempotent(USER_URL + "/decrease_balance", {"userID": userID, "amount": bid["amount"]}, f"{bid_key}-charge")
+        if response is None:
+            return make_response(jsonify({"error": "User service unavailable"}), 503)
         if response.status_code != 200:
             return make_response(jsonify({"error": "Failed to decrease balance to bidder"}), 500)
         
-        Auctions.update_one(
-            {"Auction_ID": bid["Auction_ID"]},
-            {"$set": {"current_price": bid["amount"], "Winner_ID": userID}, "$push": {"bids": bid}}
+        # compare-and-set: returns the auction as it was before this bid, or None if another bid got there first
+        previous = Auctions.find_one_and_update(
+            {
+                "Auction_ID": bid["Auction_ID"],
+                "current_price": {"$lt": bid["amount"]},
+                "end_time": {"$gt": datetime.now()},
+                "Winner_ID": {"$ne": userID}
+            },
+            # only the top AUCTION_TOP_BIDS bids stay in the auction document,
+            # and the bid is also pending for the history until it is stored there
+            {
+                "$set": {"current_price": bid["amount"], "Winner_ID": userID},
+                "$push": {
+                    "bids": {"$each": [bid], "$sort": {"amount": -1}, "$slice": AUCTION_TOP_BIDS},
+                    PENDING_HISTORY_FIELD: bid
+                }
+            },
+            projection={"Winner_ID": 1, "current_price": 1},
+            return_document=ReturnDocument.BEFORE
         )
+        if previous is None:
+            # compensation: the bid was not applied, give the money back to the bidder
+            refund_user(userID, bid["amount"], f"{bid_key}-refund")
+            return make_response(jsonify({"error": "Bid amount must be higher than current price"}), 400)
+        
+        purge_gateway_cache()
+        # if the auction had a winner, his bid needs to be refounded
+        if previous["Winner_ID"] != "":
+            refund_user(previous["Winner_ID"], previous["current_price"], f"{bid_key}-outbid-refund")
+        
+        try:
+            # the ID is allocated only for the bids actually accepted, then written on the bid stored in the auction
+            # (unless it is already out of the top bids) and on the bid history
+            bid_history.store(bid["Auction_ID"], bid)
+        except Exception as e:
+            # the bid is already applied to the auction, and pending there: the bid history worker stores it later
+            logging.error(f"Failed to store the bid of {userID} on auction {bid['Auction_ID']} in the bid history, it will be retried: {e}")
         return make_response(jsonify({"message": "Bid placed successfully"}), 200)
     except Exception as e:
         return make_response(jsonify({"error": str(e)}), 500)
 
+def refund_user(userID, amount, idempotency_key):
+    # a failed refund does not undo the bid that caused it: it stays in the outbox, and it is retried until it is delivered
+    try:
+        return outbox.deliver(USER_URL + "/refund", {"userID": userID, "amount": amount}, idempotency_key)
+    except Exception as e:
+        logging.error(f"Failed to refund {amount} to {userID}: {e}")
+    return False
+
 @app.route('/auction', methods=['GET'])
 def get_auction():
     data = request.json
@@ -248,23 +475,99 @@ def get_auction():
     if not auction_id:
         return make_response(jsonify({"error": "AuctionID is required"}), 400)
     try:
-        auction = Auctions.find_one({"Auction_ID": auction_id})
+        auction = Auctions.find_one({"Auction_ID": auction_id}, {PENDING_HISTORY_FIELD: 0})
         if not auction:
             return make_response(jsonify({"error": "Auction not found"}), 404)
         return make_response(json_util.dumps(auction), 200)
     except Exception as e:
         return make_response(jsonify({"error": str(e)}), 500)
 
-# Endpoint per ottenere tutte le aste attive
+# Endpoint per ottenere lo storico delle offerte di un'asta, dalla più alta, una pagina alla volta
+# query parameters: limit (page size) and after (the cursor of the previous page)
+# the cursor of the next page is in the X-Next-Cursor header, missing on the last page
+@app.route('/auctions/<auction_id>/bids', methods=['GET'])
+def get_auction_bids(auction_id):
+    try:
+        auction_id = int(auction_id)
+        limit = int(request.args.get("limit", BIDS_DEFAULT_PAGE_SIZE))
+    except ValueError:
+        return make_response(jsonify({"error": "Auction_ID and limit must be integers"}), 400)
+    if limit < 1 or limit > BIDS_MAX_PAGE_SIZE:
+        return make_response(jsonify({"error": f"limit must be between 1 and {BIDS_MAX_PAGE_SIZE}"}), 400)
+
+    query = {"Auction_ID": auction_id}
+    after = request.args.get("after")
+    if after:
+        # the accepted bids of an auction have strictly increasing amounts: the amount of the last bid is the cursor
+        try:
+            query["amount"] = {"$lt": float(after)}
+        except ValueError:
+            return make_response(jsonify({"error": "Invalid cursor"}), 400)
+    try:
+        bids = list(Bids.find(query, {"_id": 0}).sort("amount", DESCENDING).limit(limit + 1))
+        response = make_response(json_util.dumps(bids[:limit]), 200)
+        response.headers['Content-Type'] = 'application/json'
+        if len(bids) > limit:
+            response.headers["X-Next-Cursor"] = str(bids[limit - 1]["amount"])
+        return response
+    except Exception as e:
+        return make_response(jsonify({"error": str(e)}), 500)
+
+# Endpoint per ottenere le aste attive, dalla prossima a terminare, una pagina alla volta
+# query parameters:
+# - limit (page size) and after (the cursor of the previous page, from the X-Next-Cursor header)
+# - Gatcha_ID, min_price and max_price (on the current price), ending_within (seconds)
 @app.route('/auctions', methods=['GET'])
 def get_all_auctions():
+    now = datetime.now()
+    # the expired auctions not finalized yet are not listed
+    end_time_filter = {"$gt": now}
+    query = {"end_time": end_time_filter}
+    try:
+        limit = int(request.args.get("limit", AUCTIONS_DEFAULT_PAGE_SIZE))
+        if request.args.get("ending_within"):
+            end_time_filter["$lte"] = now + timedelta(seconds=float(request.args["ending_within"]))
+        price_filter = {}
+        if request.args.get("min_price"):
+            price_filter["$gte"] = float(request.args["min_price"])
+        if request.args.get("max_price"):
+            price_filter["$lte"] = float(request.args["max_price"])
+        if price_filter:
+            query["current_price"] = price_filter
+    except ValueError:
+        return make_response(jsonify({"error": "limit, min_price, max_price and ending_within must be numbers"}), 400)
+    if limit < 1 or limit > AUCTIONS_MAX_PAGE_SIZE:
+        return make_response(jsonify({"error": f"limit must be between 1 and {AUCTIONS_MAX_PAGE_SIZE}"}), 400)
+    if request.args.get("Gatcha_ID"):
+        query["Gatcha_ID"] = request.args["Gatcha_ID"]
+
+    after = request.args.get("after")
+    if after:
+        # the cursor is the end_time and the Auction_ID of the last auction of the previous page
+        try:
+            end_time, _, auction_id = after.rpartition("_")
+            end_time, auction_id = datetime.fromisoformat(end_time), int(auction_id)
+        except ValueError:
+            return make_response(jsonify({"error": "Invalid cursor"}), 400)
+        query["$or"] = [
+            {"end_time": {"$gt": end_time}},
+            {"end_time": end_time, "Auction_ID": {"$gt": auction_id}}
+        ]
     try:
-        auctions = list(Auctions.find({}))
-        response = make_response(json_util.dumps(auctions), 200)
+        # one more auction than the page size, to know if there is a next page
+        auctions = list(Auctions.find(query, AUCTION_LISTING_PROJECTION)
+                        .sort([("end_time", ASCENDING), ("Auction_ID", ASCENDING)])
+                        .limit(limit + 1))
+        response = make_response(json_util.dumps(auctions[:limit]), 200)
         response.headers['Content-Type'] = 'application/json'
+        if len(auctions) > limit:
+            last = auctions[limit - 1]
+            response.headers["X-Next-Cursor"] = f"{last['end_time'].isoformat()}_{last['Auction_ID']}"
         return response
     except ServerSelectionTimeoutError:
         return make_response(jsonify({"error": "Could not connect to MongoDB server."}), 500)
+    except Exception as e:
+        return make_response(jsonify({"error": str(e)}), 500)
 
 # Endpoint per verificare la connessione al database
 @app.route('/checkconnection', methods=['GET'])
@@ -276,3 +579,9 @@ def check_connection():
     except ServerSelectionTimeoutError:
         return make_response(jsonify({"error": "Failed to connect to db-gatcha"}), 500)
 
+
+# Endpoint to check the counters of the token introspection cache (see auth_utils.py)
+@app.route('/introspection-cache/stats', methods=['GET'])
+@role_required('adminUser')
+def introspection_cache_stats():
+    return make_response(jsonify(get_introspection_cache_stats()), 200)
@@ -0,0 +1,106 @@
+import os
+import time
+import logging
+import threading
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Any
+
+from pymongo import ASCENDING
+
+logger = logging.getLogger(__name__)
+
+# Storico completo delle offerte (collection Bids), che non perde le offerte accettate se l'inserimento fallisce.
+# The compare-and-set that accepts a bid also pushes it to the pending_history of its auction, in the same update.
+# Then the bid gets its Bid_ID and is copied to Bids (an upsert by Bid_ID, so never twice) and removed from pending_history.
+# If the copy fails, a background worker retries the bids pending for more than BID_HISTORY_RETRY_SECONDS,
+# and the auctions are flushed before being deleted (finalization and /delete-auction).
+
+PENDING_HISTORY_FIELD = 'pending_history'
+BID_HISTORY_FIELDS = ["Auction_ID", "User_ID", "amount", "timestamp"]
+BID_HISTORY_RETRY_SECONDS = float(os.getenv('BID_HISTORY_RETRY_SECONDS', '30'))
+BID_HISTORY_BATCH_SIZE = int(os.getenv('BID_HISTORY_BATCH_SIZE', '100'))
+
+
+class BidHistory:
+    """Copies the accepted bids from the pending_history of their auction to the bid history, with their Bid_ID."""
+
+    def __init__(self, auctions, bids, next_id: Callable[[str], int]):
+        self.auctions = auctions
+        self.bids = bids
+        self.next_id = next_id
+        self._started = False
+        self._lock = threading.Lock()
+
+    def create_indexes(self):
+        self.auctions.create_index([(f"{PENDING_HISTORY_FIELD}.timestamp", ASCENDING)], sparse=True)
+
+    def store(self, auction_id, bid: Dict[str, Any]) -> int:
+        """Stores a pending bid of an auction in the history (also if the auction was deleted meanwhile). Returns its Bid_ID."""
+        bid_id = bid.get("Bid_ID")
+        same_bid = {"User_ID": bid["User_ID"], "timestamp": bid["timestamp"]}
+        if bid_id is None:
+            # the ID is written only if no other worker gave one to the bid in the meantime
+            bid_id = self.next_id("Bid_ID")
+            result = self.auctions.update_one(
+                {"Auction_ID": auction_id},
+                {"$set": {f"{PENDING_HISTORY_FIELD}.$[pending].Bid_ID": bid_id, "bids.$[top].Bid_ID": bid_id}},
+                array_filters=[
+                    {**{f"pending.{field}": value for field, value in same_bid.items()}, "pending.Bid_ID": {"$exists": False}},
+                    {**{f"top.{field}": value for field, value in same_bid.items()}, "top.Bid_ID": {"$exists": False}}
+                ]
+            )
+            if result.modified_count == 0:
+                auction = self.auctions.find_one({"Auction_ID": auction_id}, {PENDING_HISTORY_FIELD: {"$elemMatch": same_bid}})
+                pending = (auction or {}).get(PENDING_HISTORY_FIELD) or []
+                if pending and pending[0].get("Bid_ID") is not None:
+                    bid_id = pending[0]["Bid_ID"]
+
+        record = {field: bid[field] for field in BID_HISTORY_FIELDS}
+        record["Auction_ID"] = auction_id
+        record["Bid_ID"] = bid_id
+        self.bids.update_one({"Bid_ID": bid_id}, {"$setOnInsert": record}, upsert=True)
+        self.auctions.update_one({"Auction_ID": auction_id}, {"$pull": {PENDING_HISTORY_FIELD: same_bid}})
+        return bid_id
+
+    def flush(self, auction: Dict[str, Any]):
+        """Stores all the pending bids of an auction document, e.g. before deleting it."""
+        for bid in auction.get(PENDING_HISTORY_FIELD) or []:
+            self.store(auction["Auction_ID"], bid)
+
+    def retry_due(self) -> int:
+        """Stores the bids pending for more than BID_HISTORY_RETRY_SECONDS, of up to BID_HISTORY_BATCH_SIZE auctions. Returns how many."""
+        cutoff = datetime.now() - timedelta(seconds=BID_HISTORY_RETRY_SECONDS)
+        stored = 0
+        auctions = self.auctions.find(
+            {f"{PENDING_HISTORY_FIELD}.timestamp": {"$lte": cutoff}},
+            {"Auction_ID": 1, PENDING_HISTORY_FIELD: 1}
+        ).limit(BID_HISTORY_BATCH_SIZE)
+        for auction in auctions:
+            for bid in auction[PENDING_HISTORY_FIELD]:
+                # the recent ones are still being stored by the request that placed them
+                if bid["timestamp"] <= cutoff:
+                    self.store(auction["Auction_ID"], bid)
+                    stored += 1
+        return stored
+
+    def start(self):
+        """Starts (only once) the background thread that retries the pending bids."""
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        threading.Thread(target=self._run, name='bid-history-worker', daemon=True).start()
+
+    def _run(self):
+        try:
+            self.create_indexes()
+        except Exception as e:
+            logger.error(f"Error creating the pending bid history index: {e}")
+        while True:
+            try:
+                stored = self.retry_due()
+                if stored:
+                    logger.info(f"Stored {stored} pending bids in the bid history")
+            except Exception as e:
+                logger.error(f"Error storing the pending bids in the bid history: {e}")
+            time.sleep(BID_HISTORY_RETRY_SECONDS)
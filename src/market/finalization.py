@@ -0,0 +1,132 @@
+import os
+import time
+import uuid
+import socket
+import logging
+import threading
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Any, List
+
+from pymongo import ASCENDING, ReturnDocument
+
+logger = logging.getLogger(__name__)
+
+# Finalizzazione delle aste scadute, persistente e sicura con più repliche del market.
+# Ogni replica controlla periodicamente le aste con end_time passato e le "prenota" (claim) una alla volta
+# con un find_one_and_update atomico, che le mette nello stato "finalizing" con un lease:
+# una sola replica può prenotare un'asta, e se la replica muore prima di finire il lease scade
+# e l'asta viene ripresa da un'altra. Le aste prenotate vengono finalizzate a batch da un pool di thread:
+# ogni batch viene passato intero a finalize, che può così chiudere tutte le sue aste con poche chiamate.
+
+AUCTION_STATUS_ACTIVE = 'active'
+AUCTION_STATUS_FINALIZING = 'finalizing'
+
+FINALIZATION_SWEEP_INTERVAL_SECONDS = float(os.getenv('FINALIZATION_SWEEP_INTERVAL_SECONDS', '1'))
+FINALIZATION_BATCH_SIZE = int(os.getenv('FINALIZATION_BATCH_SIZE', '50'))
+FINALIZATION_WORKERS = int(os.getenv('FINALIZATION_WORKERS', '8'))
+FINALIZATION_LEASE_SECONDS = int(os.getenv('FINALIZATION_LEASE_SECONDS', '60'))
+# an auction whose finalization failed is retried after this delay, without waiting for the end of its lease
+FINALIZATION_RETRY_SECONDS = float(os.getenv('FINALIZATION_RETRY_SECONDS', '5'))
+
+
+class AuctionFinalizer:
+    """
+    Sweeps the due auctions of a collection and finalizes them, in batches, with finalize(auctions, lease_owner).
+    finalize must delete (or otherwise take out of the "finalizing" state) the auctions it completes;
+    if it fails or raises, the auctions left are retried by any replica once their lease expires.
+    """
+
+    def __init__(self, auctions, finalize: Callable[[List[Dict[str, Any]], str], Any]):
+        self.auctions = auctions
+        self.finalize = finalize
+        # unique for each process: it tells which replica holds the lease of an auction
+        self.owner = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._executor = ThreadPoolExecutor(max_workers=FINALIZATION_WORKERS, thread_name_prefix='auction-finalizer')
+        self._started = False
+        self._lock = threading.Lock()
+
+    def create_indexes(self):
+        # due active auctions, and finalizing auctions with an expired lease
+        self.auctions.create_index([("status", ASCENDING), ("end_time", ASCENDING)])
+        self.auctions.create_index([("status", ASCENDING), ("lease_expires", ASCENDING)])
+        # the auctions created before the finalizer have no status
+        self.auctions.update_many({"status": {"$exists": False}}, {"$set": {"status": AUCTION_STATUS_ACTIVE}})
+
+    def claim(self) -> Dict[str, Any]:
+        """Atomically takes the lease of the first due auction. Returns None if there are none."""
+        now = datetime.now()
+        return self.auctions.find_one_and_update(
+            {"$or": [
+                {"status": AUCTION_STATUS_ACTIVE, "end_time": {"$lte": now}},
+                {"status": AUCTION_STATUS_FINALIZING, "lease_expires": {"$lte": now}}
+            ]},
+            {"$set": {
+                "status": AUCTION_STATUS_FINALIZING,
+                "lease_owner": self.owner,
+                "lease_expires": now + timedelta(seconds=FINALIZATION_LEASE_SECONDS)
+            }},
+            sort=[("end_time", ASCENDING)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    def release(self, auction_ids: List[Any]):
+        """Shortens the lease of auctions that could not be finalized, so they are retried after FINALIZATION_RETRY_SECONDS."""
+        if not auction_ids:
+            return
+        self.auctions.update_many(
+            {"Auction_ID": {"$in": list(auction_ids)}, "status": AUCTION_STATUS_FINALIZING, "lease_owner": self.owner},
+            {"$set": {"lease_expires": datetime.now() + timedelta(seconds=FINALIZATION_RETRY_SECONDS)}}
+        )
+
+    def claim_batch(self) -> List[Dict[str, Any]]:
+        batch = []
+        while len(batch) < FINALIZATION_BATCH_SIZE:
+            auction = self.claim()
+            if auction is None:
+                break
+            batch.append(auction)
+        return batch
+
+    def sweep(self) -> int:
+        """Claims up to a batch of due auctions for each worker and finalizes the batches in the worker pool. Returns the number of claimed auctions."""
+        batches = []
+        while len(batches) < FINALIZATION_WORKERS:
+            batch = self.claim_batch()
+            if batch:
+                batches.append(batch)
+            if len(batch) < FINALIZATION_BATCH_SIZE:
+                break
+        futures = [self._executor.submit(self.finalize, batch, self.owner) for batch in batches]
+        for batch, future in zip(batches, futures):
+            try:
+                future.result()
+            except Exception as e:
+                logger.error(f"Error finalizing auctions {[auction['Auction_ID'] for auction in batch]}, they will be retried: {e}")
+                try:
+                    self.release([auction["Auction_ID"] for auction in batch])
+                except Exception as release_error:
+                    logger.error(f"Error releasing the auctions, they will be retried after the lease: {release_error}")
+        return sum(len(batch) for batch in batches)
+
+    def start(self):
+        """Starts (only once) the background thread that sweeps the due auctions."""
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        threading.Thread(target=self._run, name='auction-finalizer-sweeper', daemon=True).start()
+
+    def _run(self):
+        try:
+            self.create_indexes()
+        except Exception as e:
+            logger.error(f"Error creating the finalization indexes: {e}")
+        while True:
+            try:
+                # a full batch means that there can be more due auctions: sweep again right away
+                if self.sweep() == FINALIZATION_BATCH_SIZE * FINALIZATION_WORKERS:
+                    continue
+            except Exception as e:
+                logger.error(f"Error sweeping the due auctions: {e}")
+            time.sleep(FINALIZATION_SWEEP_INTERVAL_SECONDS)
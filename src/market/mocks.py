@@ -38,6 +38,10 @@ def mock_request(method, url, *args, **kwargs):
     if url.endswith("/decrease_balance"):
         return MockResponse({"message": "balance decreased successfully"}, 200)
     
+    if url.endswith("/settle"):
+        operations = (kwargs.get('json') or {}).get("operations", [])
+        return MockResponse({"results": [{"status": 200} for _ in operations]}, 200)
+    
     # According to the method, call the appropriate function to handle the request
     if method == 'POST':
         json_body = kwargs.get('json')
@@ -64,6 +68,8 @@ def start_mocking_http_requests():
     
     methods_to_patch = ['get', 'post', 'put', 'delete', 'patch', 'head', 'options']
     patchers = [patch(f'requests.{method}', lambda url, **kwargs: mock_request(method.upper(), url, **kwargs)) for method in methods_to_patch]
+    # the calls made with service_client.py go through a pooled requests.Session
+    patchers.append(patch('requests.Session.request', lambda self, method, url, **kwargs: mock_request(method.upper(), url, **kwargs)))
     
     for patcher in patchers:
         patcher.start()
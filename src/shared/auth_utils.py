@@ -1,9 +1,16 @@
-from flask import request, jsonify
+from flask import request, jsonify, g
 from functools import wraps
 from os import getenv
 import requests
+import service_client
 import json
 import logging
+import jwt
+import redis
+import hashlib
+import threading
+import time
+from collections import OrderedDict
 
 logging.getLogger('pymongo').setLevel(logging.WARNING)
 logging.basicConfig(level=logging.DEBUG)
@@ -18,14 +25,239 @@ logger = logging.getLogger(__name__)
 
 AUTH_URL = getenv("AUTH_URL")
 
+# Token verification mode:
+# - "remote": every token is sent to the /introspect endpoint of the auth microservice (default)
+# - "local": signature, expiration and issuer are checked here with the shared JWT secret,
+#            and only the revocation check is done against Redis (no HTTP call to auth)
+AUTH_VERIFICATION_MODE = getenv("AUTH_VERIFICATION_MODE", "remote").lower()
+JWT_SECRET_FILE = getenv("JWT_SECRET_FILE", "/run/secrets/JWT_SECRET")
+JWT_ISSUER = getenv("JWT_ISSUER", "https://auth.ladygatcha.com")
+REDIS_HOST = getenv("REDIS_HOST", "redis")
+REDIS_PORT = int(getenv("REDIS_PORT", "6379"))
+
+# In-process cache of the introspected claims, keyed by the token jti.
+# An entry lives at most INTROSPECTION_CACHE_MAX_TTL_SECONDS, and never longer than the token itself.
+# The auth microservice publishes the jti of every revoked token on TOKEN_REVOCATION_CHANNEL,
+# so revoked tokens are removed from the cache as soon as they are revoked.
+INTROSPECTION_CACHE_ENABLED = getenv("INTROSPECTION_CACHE_ENABLED", "True") == "True"
+INTROSPECTION_CACHE_MAX_SIZE = int(getenv("INTROSPECTION_CACHE_MAX_SIZE", "10000"))
+INTROSPECTION_CACHE_MAX_TTL_SECONDS = int(getenv("INTROSPECTION_CACHE_MAX_TTL_SECONDS", "300"))
+TOKEN_REVOCATION_CHANNEL = getenv("TOKEN_REVOCATION_CHANNEL", "revoked_tokens")
+REVOCATION_LISTENER_RETRY_SECONDS = 5
+
 import urllib3
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+_jwt_secret = None
+_redis_client = None
+
+def get_jwt_secret():
+    """Read the shared JWT secret (mounted as a docker secret) only once."""
+    global _jwt_secret
+    if _jwt_secret is None:
+        with open(JWT_SECRET_FILE) as f:
+            _jwt_secret = f.read().strip()
+    return _jwt_secret
+
+def get_redis_client():
+    """Return the Redis client used for the revocation checks, creating it on first use."""
+    global _redis_client
+    if _redis_client is None:
+        _redis_client = redis.StrictRedis(host=REDIS_HOST, port=REDIS_PORT, db=0, decode_responses=True)
+    return _redis_client
+
+class IntrospectionCache:
+    """
+    Bounded LRU cache of token claims, keyed by the token jti.
+    Every entry expires at min(token exp, now + max_ttl). The hash of the whole token is stored
+    with the claims, so a different token carrying the same jti never matches a cached entry.
+    """
+
+    def __init__(self, max_size, max_ttl):
+        self.max_size = max_size
+        self.max_ttl = max_ttl
+        self._entries = OrderedDict() # jti -> (token hash, claims, expiration timestamp)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        # incremented by every revocation (and clear): a token validated before a revocation is not cached after it
+        self._generation = 0
+
+    def generation(self):
+        with self._lock:
+            return self._generation
+
+    def get(self, jti, token_hash):
+        with self._lock:
+            entry = self._entries.get(jti)
+            if entry is None:
+                self.misses += 1
+                return None
+            cached_hash, claims, expires_at = entry
+            if cached_hash != token_hash or expires_at <= time.time():
+                del self._entries[jti]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(jti)
+            self.hits += 1
+            return claims
+
+    def put(self, jti, token_hash, claims, generation=None):
+        # generation: the one read before validating the token, the entry is dropped if a revocation came in between
+        expires_at = time.time() + self.max_ttl
+        if isinstance(claims.get("exp"), (int, float)):
+            expires_at = min(expires_at, claims["exp"])
+        if expires_at <= time.time():
+            return
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            self._entries[jti] = (token_hash, claims, expires_at)
+            self._entries.move_to_end(jti)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, jti):
+        with self._lock:
+            self._generation += 1
+            if self._entries.pop(jti, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "max_ttl_seconds": self.max_ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations
+            }
+
+_introspection_cache = IntrospectionCache(INTROSPECTION_CACHE_MAX_SIZE, INTROSPECTION_CACHE_MAX_TTL_SECONDS)
+_revocation_listener_lock = threading.Lock()
+_revocation_listener_started = False
+_revocation_listener_connected = False
+
+def start_revocation_listener():
+    """Start (only once) the background thread that removes the revoked tokens from the cache."""
+    global _revocation_listener_started
+    with _revocation_listener_lock:
+        if _revocation_listener_started:
+            return
+        _revocation_listener_started = True
+    threading.Thread(target=_listen_for_revocations, name="token-revocation-listener", daemon=True).start()
+
+def _listen_for_revocations():
+    global _revocation_listener_connected
+    while True:
+        try:
+            pubsub = get_redis_client().pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(TOKEN_REVOCATION_CHANNEL)
+            _revocation_listener_connected = True
+            logger.info(f"Listening for revoked tokens on the redis channel {TOKEN_REVOCATION_CHANNEL}")
+            for message in pubsub.listen():
+                _introspection_cache.invalidate(message["data"])
+        except Exception as e:
+            logger.error("Lost the connection to the token revocation channel: " + str(e))
+        # while we are disconnected we could miss some revocations: the cache is not used until we reconnect
+        _revocation_listener_connected = False
+        _introspection_cache.clear()
+        time.sleep(REVOCATION_LISTENER_RETRY_SECONDS)
+
+def get_introspection_cache_stats():
+    """Return the counters of the introspection cache, useful to size it."""
+    stats = _introspection_cache.stats()
+    stats["enabled"] = INTROSPECTION_CACHE_ENABLED
+    stats["revocation_listener_connected"] = _revocation_listener_connected
+    return stats
+
 def introspect_token(token):
+    """
+    Return the claims of the token, validating it according to AUTH_VERIFICATION_MODE.
+    Valid tokens are cached (see IntrospectionCache) while the revocation listener is connected.
+    """
+    if not INTROSPECTION_CACHE_ENABLED:
+        return validate_token(token)
+
+    try:
+        # the jti is only used as the cache key: the token is validated before being cached
+        jti = jwt.decode(token, options={"verify_signature": False}).get("jti")
+    except jwt.InvalidTokenError:
+        jti = None
+    if not jti:
+        return validate_token(token)
+
+    start_revocation_listener()
+    if not _revocation_listener_connected:
+        return validate_token(token)
+
+    token_hash = hashlib.sha256(token.encode()).hexdigest()
+    claims = _introspection_cache.get(jti, token_hash)
+    if claims is not None:
+        return claims
+
+    # a revocation published while the token is validated would find nothing to remove from the cache
+    generation = _introspection_cache.generation()
+    claims = validate_token(token)
+    _introspection_cache.put(jti, token_hash, claims, generation)
+    return claims
+
+def validate_token(token):
+    """Validate the token without using the cache."""
+    if AUTH_VERIFICATION_MODE == "local":
+        return verify_token_locally(token)
+    return introspect_token_remotely(token)
+
+def verify_token_locally(token):
+    """
+    Validate the token without calling the auth microservice.
+    Checks the HS256 signature, the expiration and the issuer, then asks Redis if the token was revoked
+    (the auth microservice stores the jti of revoked tokens in Redis, see /tokens/revoke).
+    The error messages are the same returned by the /introspect endpoint.
+    """
+    try:
+        claims = jwt.decode(
+            token,
+            get_jwt_secret(),
+            algorithms=["HS256"],
+            issuer=JWT_ISSUER,
+            options={"require": ["exp", "iss", "jti"]}
+        )
+    except jwt.ExpiredSignatureError:
+        logger.warning("Token expired")
+        raise ValueError("Invalid token: Token expired")
+    except jwt.InvalidTokenError as e:
+        logger.warning("Invalid token: " + str(e))
+        raise ValueError("Invalid token: Invalid token")
+
+    try:
+        revoked = get_redis_client().exists(claims["jti"]) == 1
+    except redis.exceptions.RedisError as e:
+        # if we cannot check the revocation list, we refuse the token
+        logger.error("Could not check the token revocation list: " + str(e))
+        raise ValueError("Error while introspecting token: revocation list unavailable")
+    if revoked:
+        logger.info(f"Token revoked: {claims['jti']}")
+        raise ValueError("Invalid token: Token revoked")
+
+    logger.debug("Verified token locally: " + str(claims))
+    return claims
+
+def introspect_token_remotely(token):
     """Introspect the token using the /auth/introspect endpoint."""
 
     try:
-        response = requests.post(f"{AUTH_URL}/introspect", data={"token": token}, timeout=10, verify=False)
+        response = service_client.post(f"{AUTH_URL}/introspect", data={"token": token}, timeout=10)
         if response.status_code == 200:
             claims = json.loads(response.text)
             logger.debug("Introspected token: " + str(claims))
@@ -40,18 +272,32 @@ def introspect_token(token):
         logger.error("Request to introspect token timed out")
         raise ValueError("Request to introspect token timed out")
 
+def get_claims():
+    """
+    Return the claims of the token sent with the current request.
+    The token is introspected only once per request: the claims are stored in flask.g
+    and reused by role_required, get_userID_from_jwt and every other call during the same request.
+    Raises ValueError if the authorization header is missing or the token is not valid.
+    """
+    if "auth_claims" in g:
+        return g.auth_claims
+
+    auth_header = request.headers.get('Authorization')
+    if not auth_header or not auth_header.startswith("Bearer "):
+        raise ValueError("Missing or invalid authorization header")
+
+    token = auth_header.split(" ")[1]
+    claims = introspect_token(token)
+    g.auth_claims = claims
+    return claims
+
 def role_required(*required_roles):
     """Decorator to check if the user has the required roles."""
     def decorator(f):
         @wraps(f)
         def decorated_function(*args, **kwargs):
-            auth_header = request.headers.get('Authorization')
-            if not auth_header or not auth_header.startswith("Bearer "):
-                return jsonify({"error": "Missing or invalid authorization header"}), 401
-            
-            token = auth_header.split(" ")[1]
             try:
-                claims = introspect_token(token)
+                claims = get_claims()
             except Exception as e:
                 logger.error("Error while getting the claims from the token: " + str(e))
                 return jsonify({"error": str(e)}), 401
@@ -72,20 +318,18 @@ def role_required(*required_roles):
 
 
 def get_userID_from_jwt():
-    """Extract user ID from JWT token."""
-    auth_header = request.headers.get('Authorization')
-    if not auth_header or not auth_header.startswith("Bearer "):
-        return None, "Missing or invalid authorization header"
-    
-    token = auth_header.split(" ")[1]
-    
+    """
+    Extract user ID from JWT token.
+    Uses the claims already introspected during this request, if any.
+    Raises ValueError if the user ID cannot be extracted.
+    """
     try:
-        claims = introspect_token(token)
+        claims = get_claims()
         userID = claims["sub"] # the user ID is stored in the "sub" field
         if not userID:
             raise ValueError("User ID not found in the token")
         logger.debug(f"Found user ID inside get_userID_from_jwt(): {userID}")
     except Exception as e:
         logger.error("Error while getting the userID. " + str(e))
-        return jsonify({"error": "Error while getting the userID. " + e}), 401
+        raise ValueError("Error while getting the userID. " + str(e))
     return userID
\ No newline at end of file
@@ -0,0 +1,82 @@
+from os import getenv
+from urllib.parse import urlsplit
+from http.cookiejar import DefaultCookiePolicy
+import threading
+import logging
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+# SHARED FILE
+# This file contains the HTTP client used for every call from a microservice to another one.
+# Instead of opening a new TCP+TLS connection for every requests.post(...), each upstream
+# (scheme + host + port) gets its own requests.Session with a pool of keep-alive connections,
+# so the TLS handshake is done once per pooled connection and then reused.
+
+# ATTENZIONE: OGNI VOLTA CHE SI MODIFICA, LA NUOVA VERSIONE VA COPIATA IN TUTTI I MICROSERVIZI
+# per farlo, usare il file /shared/sync.py
+
+# max number of keep-alive connections kept open towards each upstream
+SERVICE_CLIENT_POOL_SIZE = int(getenv("SERVICE_CLIENT_POOL_SIZE", "50"))
+# if True, when the pool is full the threads wait for a free connection instead of opening a new one
+SERVICE_CLIENT_POOL_BLOCK = getenv("SERVICE_CLIENT_POOL_BLOCK", "False") == "True"
+SERVICE_CLIENT_TIMEOUT = float(getenv("SERVICE_CLIENT_TIMEOUT", "10"))
+
+import urllib3
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def _upstream_key(url):
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+def _create_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=1, # one pool per session: each session talks with a single upstream
+        pool_maxsize=SERVICE_CLIENT_POOL_SIZE,
+        pool_block=SERVICE_CLIENT_POOL_BLOCK
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    # the microservices use self-signed certificates
+    session.verify = False
+    # the session is shared by all the requests of the service: never store the cookies of a response,
+    # otherwise they would be sent with the requests of other users
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    return session
+
+def get_session(url):
+    """Return the pooled session used for the upstream of the given URL, creating it on first use."""
+    key = _upstream_key(url)
+    session = _sessions.get(key)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(key)
+            if session is None:
+                logger.info(f"Creating a pooled HTTP session for {key} (pool size {SERVICE_CLIENT_POOL_SIZE})")
+                session = _create_session()
+                _sessions[key] = session
+    return session
+
+def request(method, url, **kwargs):
+    """Same as requests.request, but reusing the keep-alive connections towards the upstream."""
+    kwargs.setdefault("timeout", SERVICE_CLIENT_TIMEOUT)
+    kwargs.setdefault("verify", False)
+    return get_session(url).request(method.upper(), url, **kwargs)
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
+
+def put(url, **kwargs):
+    return request("PUT", url, **kwargs)
+
+def delete(url, **kwargs):
+    return request("DELETE", url, **kwargs)
@@ -1,17 +1,19 @@
 import os
 import shutil
 
-# USARE QUESTO FILE PER SINCRONIZZARE LE MODIFICHE FATTE AL FILE auth_utils.py IN TUTTI I MICROSERVIZI
+# USARE QUESTO FILE PER SINCRONIZZARE LE MODIFICHE FATTE AI FILE CONDIVISI (auth_utils.py, service_client.py, outbox.py) IN TUTTI I MICROSERVIZI
 
 # uso:
 # cd src/shared
 # python sync.py
 
-# Path to the shared file
-shared_file_path = './auth_utils.py'
+# Shared files, copied in every microservice that contains auth_utils.py
+shared_files = ['./auth_utils.py', './service_client.py']
+# Shared files used only by some microservices, copied only in their folders
+service_files = {'./outbox.py': ['gatcha', 'market']}
 
 # Function to copy the shared file to the target path
-def copy_shared_file(target_path):
+def copy_shared_file(shared_file_path, target_path):
     shutil.copy2(shared_file_path, target_path)
     print(f'Copied {shared_file_path} to {target_path}')
 
@@ -19,11 +21,15 @@ def copy_shared_file(target_path):
 
 # Walk through all directories and subdirectories
 for root, dirs, files in os.walk('../'):
-    
+
     # Skip the 'shared' directory
     dirs[:] = [d for d in dirs if d != 'shared']
-    
-    for file in files:
-        if file == 'auth_utils.py':
-            target_file_path = os.path.join(root, file)
-            copy_shared_file(target_file_path)
\ No newline at end of file
+
+    if 'auth_utils.py' in files:
+        for shared_file_path in shared_files:
+            target_file_path = os.path.join(root, os.path.basename(shared_file_path))
+            copy_shared_file(shared_file_path, target_file_path)
+        for shared_file_path, services in service_files.items():
+            if os.path.basename(os.path.normpath(root)) in services:
+                target_file_path = os.path.join(root, os.path.basename(shared_file_path))
+                copy_shared_file(shared_file_path, target_file_path)
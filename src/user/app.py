@@ -1,10 +1,17 @@
 import os
+import re
+import hashlib
 import uuid
+from collections import Counter
 from flask import Flask, request, make_response, jsonify
-from pymongo import MongoClient
-from pymongo.errors import ServerSelectionTimeoutError
-import requests
-from auth_utils import role_required, get_userID_from_jwt
+from pymongo import MongoClient, ASCENDING, UpdateOne, ReturnDocument
+from pymongo.errors import ServerSelectionTimeoutError, CollectionInvalid, DuplicateKeyError, BulkWriteError
+from bson import ObjectId
+from bson.errors import InvalidId
+from email.utils import parsedate_to_datetime
+import service_client
+from auth_utils import role_required, get_userID_from_jwt, get_introspection_cache_stats
+from idempotency import IdempotencyStore, STATUS_COMPLETED, DUPLICATE_KEY_ERROR_CODE, APPLIED_KEYS_FIELD, current_key, guard_write, was_applied
 from datetime import datetime
 import json
 import logging
@@ -25,6 +32,21 @@ MARKET_URL = os.getenv('MARKET_URL')
 client_user = MongoClient("db-user", 27017, maxPoolSize=50)
 db_user= client_user["db_users"]
 
+# Ledger: lo storico delle transazioni è in una collection separata, non più nel documento dell'utente.
+# Di default è una collection normale: lo storico resta completo e viene cancellato con l'utente.
+# Con LEDGER_CAPPED_SIZE_BYTES > 0 diventa una capped collection: le transazioni più vecchie (di tutti gli utenti)
+# vengono scartate oltre quella dimensione, e quelle di un utente cancellato non si possono più eliminare
+# (MongoDB non permette delete su una capped collection), restano finché non vengono scartate.
+LEDGER_COLLECTION_NAME = "ledger"
+LEDGER_CAPPED_SIZE_BYTES = int(os.getenv('LEDGER_CAPPED_SIZE_BYTES', '0'))
+TRANSACTIONS_DEFAULT_PAGE_SIZE = int(os.getenv('TRANSACTIONS_DEFAULT_PAGE_SIZE', '100'))
+TRANSACTIONS_MAX_PAGE_SIZE = int(os.getenv('TRANSACTIONS_MAX_PAGE_SIZE', '500'))
+ledger = db_user[LEDGER_COLLECTION_NAME]
+ledger_capped = LEDGER_CAPPED_SIZE_BYTES > 0 # updated by init_ledger with the actual collection (it can be capped by an older deployment)
+
+# fields of a ledger entry returned to the clients
+TRANSACTION_PROJECTION = {"_id": 1, "amount": 1, "type": 1, "timestamp": 1}
+
 UNIT_TEST_MODE = os.getenv('UNIT_TEST_MODE', 'False') == 'True'
 
 if UNIT_TEST_MODE:
@@ -67,17 +89,154 @@ if UNIT_TEST_MODE:
 
     # Insert the test user into the database
     try:
-        if not db_user.collection.find_one({"userID": test_user["userID"]}):
+        if not db_user.collection.find_one({"userID": test_user["userID"]}, {"_id": 1}):
             db_user.collection.insert_one(test_user)
             logging.info("Inserted test user into the database")
     except ServerSelectionTimeoutError:
         print("Could not connect to MongoDB server.")
 else :
     app.logger.info("Running in normal mode!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
+
+
+# region ledger
+def init_ledger():
+    """Creates the ledger collection and its index, then moves there the transactions still embedded in the user documents."""
+    global ledger_capped
+    if LEDGER_CAPPED_SIZE_BYTES > 0:
+        try:
+            db_user.create_collection(LEDGER_COLLECTION_NAME, capped=True, size=LEDGER_CAPPED_SIZE_BYTES)
+        except CollectionInvalid:
+            pass # already created
+    ledger.create_index([("userID", ASCENDING), ("timestamp", ASCENDING), ("_id", ASCENDING)])
+    # the transactions of /settle carry the idempotency key of their operation: a retry does not record them twice
+    ledger.create_index("settlement_key", unique=True, partialFilterExpression={"settlement_key": {"$exists": True}})
+    ledger_capped = ledger.options().get("capped", False)
+    if ledger_capped and LEDGER_CAPPED_SIZE_BYTES == 0:
+        logger.warning("The ledger is a capped collection: old transactions are discarded and deleted users keep their history until then")
+
+    migrated = 0
+    for user in db_user.collection.find({"transactions": {"$exists": True}}, {"userID": 1, "transactions": 1}):
+        entries = []
+        for index, transaction in enumerate(user.get("transactions") or []):
+            timestamp = parse_timestamp(transaction.get("timestamp"))
+            entries.append({
+                "_id": migrated_transaction_id(user["_id"], index, timestamp),
+                "userID": user["userID"],
+                "amount": transaction.get("amount"),
+                "type": transaction.get("type"),
+                "timestamp": timestamp
+            })
+        if entries:
+            try:
+                ledger.insert_many(entries, ordered=False)
+            except BulkWriteError as e:
+                # the entries already copied by a migration interrupted before the $unset (or by another replica)
+                if any(error["code"] != DUPLICATE_KEY_ERROR_CODE for error in e.details.get("writeErrors", [])):
+                    raise
+        # the embedded array is removed only once all its transactions are in the ledger
+        db_user.collection.update_one({"_id": user["_id"]}, {"$unset": {"transactions": ""}})
+        migrated += len(entries)
+    if migrated:
+        logger.info(f"Migrated {migrated} embedded transactions to the ledger")
+
+def migrated_transaction_id(user_id, index, timestamp):
+    # the same _id every time an embedded transaction is migrated: its time, then a hash of its user and position
+    digest = hashlib.sha256(f"{user_id}:{index}".encode()).digest()
+    return ObjectId(max(int(timestamp.timestamp()), 0).to_bytes(4, "big") + digest[:8])
+
+def parse_timestamp(timestamp):
+    # the old embedded transactions can have the timestamp as a string (e.g. "Fri, 06 Dec 2024 10:55:18 GMT")
+    if isinstance(timestamp, str):
+        try:
+            return parsedate_to_datetime(timestamp).replace(tzinfo=None)
+        except (TypeError, ValueError):
+            return datetime.now()
+    return timestamp or datetime.now()
+
+def new_transaction(userID, amount, transaction_type):
+    return {
+        "userID": userID,
+        "amount": amount,
+        "type": transaction_type,
+        "timestamp": datetime.now()
+    }
+
+def record_transaction(userID, amount, transaction_type):
+    # the change of the balance is already applied: a failure here only loses its history entry,
+    # it must not turn the request into an error (its caller would retry the change)
+    try:
+        ledger.insert_one(new_transaction(userID, amount, transaction_type))
+    except Exception as e:
+        logger.error(f"Error recording the {transaction_type} of {amount} for {userID} in the ledger: {str(e)}")
+
+def format_transaction(entry):
+    return {"amount": entry["amount"], "type": entry["type"], "timestamp": entry["timestamp"]}
+
+def encode_cursor(entry):
+    # the cursor is the position of the last returned entry: timestamp plus _id to break the ties
+    return f"{entry['timestamp'].isoformat()}_{entry['_id']}"
+
+def decode_cursor(cursor):
+    timestamp, _, entry_id = cursor.rpartition('_')
+    return datetime.fromisoformat(timestamp), ObjectId(entry_id)
+
+try:
+    init_ledger()
+except Exception as e:
+    logger.error(f"Error initializing the ledger: {str(e)}")
+# endregion ledger
+
+# Idempotency-Key degli endpoint che modificano saldo e collezione (vedi idempotency.py):
+# gatcha e market possono ripetere una chiamata andata in timeout senza applicarla due volte
+idempotency_store = IdempotencyStore(db_user["idempotency_keys"])
+idempotent = idempotency_store.idempotent
+try:
+    idempotency_store.create_indexes()
+except Exception as e:
+    logger.error(f"Error creating the idempotency keys index: {str(e)}")
+
+# every lookup of the service is by userID: one user per userID, found through the index
+try:
+    db_user.collection.create_index("userID", unique=True)
+except Exception as e:
+    logger.error(f"Error creating the userID index: {str(e)}")
+
+
+# region collection
+# La collezione di un utente è una mappa {gatcha_ID: numero di copie}, non più una lista di ID con duplicati.
+# Gli ID diventano nomi di campi: non possono contenere '.' o '$'
+VALID_GATCHA_ID_REGEX = re.compile(r'^[a-zA-Z0-9_-]+$')
+
+def is_valid_gatcha_ID(gatcha_ID):
+    return isinstance(gatcha_ID, str) and VALID_GATCHA_ID_REGEX.match(gatcha_ID) is not None
+
+def expand_collection(collection):
+    # {gatcha_ID: count} -> list of gatcha IDs, one for each copy (the format returned before the counts)
+    return [gatcha_ID for gatcha_ID, count in collection.items() for _ in range(count)]
+
+def migrate_collections():
+    """Converts the collections still stored as lists of gatcha IDs into maps of counts."""
+    operations = []
+    for user in db_user.collection.find({"collection": {"$type": "array"}}, {"collection": 1}):
+        counts = Counter(gatcha_ID for gatcha_ID in user["collection"] if is_valid_gatcha_ID(gatcha_ID))
+        # the filter on the type skips the users already migrated by another process in the meantime
+        operations.append(UpdateOne(
+            {"_id": user["_id"], "collection": {"$type": "array"}},
+            {"$set": {"collection": dict(counts)}}
+        ))
+    if operations:
+        db_user.collection.bulk_write(operations, ordered=False)
+        logger.info(f"Migrated the collections of {len(operations)} users to counts")
+
+try:
+    migrate_collections()
+except Exception as e:
+    logger.error(f"Error migrating the collections: {str(e)}")
+# endregion collection
     
 
 def userExists(userID):
-    return db_user.collection.find_one({"userID": userID}) is not None
+    return db_user.collection.find_one({"userID": userID}, {"_id": 1}) is not None
 
 # Endpoint per registrare un utente passando i dati nel body della richiesta
 # questo endpoint dovrebbe essere chiamabile solo dal microservizio 'auth'
@@ -96,17 +255,17 @@ def init_user():
             logger.debug("No userID provided in payload")
             return make_response(jsonify({"error": "No userID provided"}), 400)
         
-        if userExists(userID):
-            logger.debug(f"User with userID {userID} already exists")
-            return make_response(jsonify({"error": "User already exists"}), 409)
-        
         user = {
             "userID": userID,
             "balance": 0,
-            "collection": [],
-            "transactions": []
+            "collection": {}
         }
-        db_user.collection.insert_one(user)
+        try:
+            # the unique index on userID rejects a second user with the same userID
+            db_user.collection.insert_one(user)
+        except DuplicateKeyError:
+            logger.debug(f"User with userID {userID} already exists")
+            return make_response(jsonify({"error": "User already exists"}), 409)
         logger.debug(f"User with userID {userID} initialized successfully")
         return make_response(jsonify({"message": "User initialized successfully"}), 201)
     except Exception as e:
@@ -120,6 +279,9 @@ def delete_user():
     userID = data['userID']
     try:
         db_user.collection.delete_one({"userID": userID})
+        # a capped ledger does not allow deletes: the transactions stay there until they are discarded
+        if not ledger_capped:
+            ledger.delete_many({"userID": userID})
         return make_response(jsonify({"message": "User deleted successfully"}), 200)
     except Exception as e:
         return make_response(jsonify({"error": str(e)}), 500)
@@ -130,14 +292,15 @@ def delete_user():
 @role_required('adminUser')
 def get_user_by_id(userID):
     try:
-        user = db_user.collection.find_one({'userID': userID})
+        user = db_user.collection.find_one({'userID': userID}, {"_id": 0, "userID": 1, "balance": 1, "collection": 1})
         if user is None:
             return make_response(jsonify({"error": "User not found"}), 404)
+        transactions = ledger.find({"userID": userID}, TRANSACTION_PROJECTION).sort([("timestamp", ASCENDING), ("_id", ASCENDING)])
         user_data = {
             'userID': user["userID"],
             'balance': user["balance"],
-            'collection': user["collection"],
-            'transactions': user["transactions"]
+            'collection': expand_collection(user["collection"]),
+            'transactions': [format_transaction(entry) for entry in transactions]
         }
         return make_response(jsonify(user_data), 200)
     except Exception as e:
@@ -151,7 +314,7 @@ def get_balance():
     except Exception as e:
         return make_response(jsonify({"error": "Error decoding token"}), 401)
     try:
-        user = db_user.collection.find_one({"userID": userID})
+        user = db_user.collection.find_one({"userID": userID}, {"_id": 0, "balance": 1})
         if user is None:
             return make_response(jsonify({"error": "User not found"}), 404)
         return make_response(jsonify({"balance": user["balance"]}), 200)
@@ -160,22 +323,19 @@ def get_balance():
 
 # endpoint to increase the balance of a user
 @app.route('/increase_balance', methods=['POST'])
+@idempotent
 def increase_balance():
     data = request.json
     userID = data.get("userID")
     amount = data.get("amount")
     try:
-        logger.debug("Searching for user with userID: " + str(userID))
-        user = db_user.collection.find_one({"userID": userID})
-        if user is None:
+        key = current_key()
+        result = db_user.collection.update_one(*guard_write({"userID": userID}, {"$inc": {"balance": amount}}, key))
+        if result.matched_count == 0:
+            if was_applied(db_user.collection, {"userID": userID}, key):
+                return make_response(jsonify({"message": "Balance updated successfully"}), 200)
             return make_response(jsonify({"error": "User not found"}), 404)
-        db_user.collection.update_one({"userID": userID}, {"$inc": {"balance": amount}})
-        transaction = {
-            "amount": amount,
-            "type": "increase",
-            "timestamp": datetime.now()
-        }
-        db_user.collection.update_one({"userID": userID}, {"$push": {"transactions": transaction}})
+        record_transaction(userID, amount, "increase")
         return make_response(jsonify({"message": "Balance updated successfully"}), 200)
     except Exception as e:
         logger.warning("Error increasing balance: " + str(e))
@@ -184,33 +344,39 @@ def increase_balance():
 # endpoint to decrease the balance of a user
 # must be usable only by roll and after an auction win
 @app.route('/decrease_balance', methods=['POST'])
+@idempotent
 def decrease_balance():  
     data = request.json
     userID = data.get("userID")
     amount = data.get("amount")
     try:
         logger.debug(f"Attempting to decrease balance for userID: {userID} by amount: {amount}")
-        user = db_user.collection.find_one({"userID": userID})
-        if user is None:
-            logger.debug(f"User with userID {userID} not found")
-            return make_response(jsonify({"error": "User not found"}), 404)
-        if user["balance"] < amount:
-            logger.debug(f"Insufficient funds for userID {userID}. Current balance: {user['balance']}, requested amount: {amount}")
+        # the balance check is part of the filter: check and debit are atomic, concurrent debits cannot overdraw
+        key = current_key()
+        result = db_user.collection.update_one(*guard_write(
+            {"userID": userID, "balance": {"$gte": amount}},
+            {"$inc": {"balance": -amount}},
+            key
+        ))
+        if result.matched_count == 0:
+            # nothing was debited: the debit was already applied, or the user is missing or has not enough credit
+            if was_applied(db_user.collection, {"userID": userID}, key):
+                return make_response(jsonify({"message": "Balance updated successfully"}), 200)
+            if not userExists(userID):
+                logger.debug(f"User with userID {userID} not found")
+                return make_response(jsonify({"error": "User not found"}), 404)
+            logger.debug(f"Insufficient funds for userID {userID}, requested amount: {amount}")
             return make_response(jsonify({"error": "Insufficient funds"}), 400)
-        db_user.collection.update_one({"userID": userID}, {"$inc": {"balance": -amount}})
-        transaction = {
-            "amount": amount,
-            "type": "decrease",
-            "timestamp": datetime.now()
-        }
-        db_user.collection.update_one({"userID": userID}, {"$push": {"transactions": transaction}})
-        logger.debug(f"Balance decreased successfully for userID {userID}. New balance: {user['balance'] - amount}")
+        record_transaction(userID, amount, "decrease")
+        logger.debug(f"Balance decreased successfully for userID {userID}")
         return make_response(jsonify({"message": "Balance updated successfully"}), 200)
     except Exception as e:
         logger.error(f"Error decreasing balance for userID {userID}: {str(e)}")
         return make_response(jsonify({"error": str(e)}), 500)
     
-# endpoint to get the full list of transactions of a user
+# endpoint to get the list of transactions of a user, from the oldest, one page at a time
+# query parameters: limit (page size) and after (the cursor of the previous page)
+# the cursor of the next page is in the X-Next-Cursor header, missing on the last page
 @app.route('/transactions', methods=['GET'])
 def get_transactions():
     try: 
@@ -218,75 +384,298 @@ def get_transactions():
     except Exception as e:
         return make_response(jsonify({"error": "Error decoding token"}), 401)
     try:
-        user = db_user.collection.find_one({"userID": userID})
-        if user is None:
+        limit = int(request.args.get("limit", TRANSACTIONS_DEFAULT_PAGE_SIZE))
+    except ValueError:
+        return make_response(jsonify({"error": "limit must be an integer"}), 400)
+    if limit < 1 or limit > TRANSACTIONS_MAX_PAGE_SIZE:
+        return make_response(jsonify({"error": f"limit must be between 1 and {TRANSACTIONS_MAX_PAGE_SIZE}"}), 400)
+
+    query = {"userID": userID}
+    after = request.args.get("after")
+    if after:
+        try:
+            timestamp, entry_id = decode_cursor(after)
+        except (ValueError, InvalidId):
+            return make_response(jsonify({"error": "Invalid cursor"}), 400)
+        # no skip: the page starts right after the last entry of the previous one, using the (userID, timestamp, _id) index
+        query["$or"] = [
+            {"timestamp": {"$gt": timestamp}},
+            {"timestamp": timestamp, "_id": {"$gt": entry_id}}
+        ]
+    try:
+        if not after and not userExists(userID):
             return make_response(jsonify({"error": "User not found"}), 404)
-        return make_response(jsonify(user["transactions"]), 200)
+        # one more entry than the page size, to know if there is a next page
+        entries = list(ledger.find(query, TRANSACTION_PROJECTION).sort([("timestamp", ASCENDING), ("_id", ASCENDING)]).limit(limit + 1))
+        response = make_response(jsonify([format_transaction(entry) for entry in entries[:limit]]), 200)
+        if len(entries) > limit:
+            response.headers["X-Next-Cursor"] = encode_cursor(entries[limit - 1])
+        return response
     except Exception as e:
         return make_response(jsonify({"error": str(e)}), 500)
 
 
 # endpoint per fare i refund di una bid
 @app.route('/refund', methods=['POST'])
+@idempotent
 def refund():
     data = request.json
     userID = data.get("userID")
     amount = data.get("amount")
     try:
-        user = db_user.collection.find_one({"userID": userID})
-        if user is None:
+        key = current_key()
+        result = db_user.collection.update_one(*guard_write({"userID": userID}, {"$inc": {"balance": amount}}, key))
+        if result.matched_count == 0:
+            if was_applied(db_user.collection, {"userID": userID}, key):
+                return make_response(jsonify({"message": "Refund successful"}), 200)
             return make_response(jsonify({"error": "User not found"}), 404)
-        db_user.collection.update_one({"userID": userID}, {"$inc": {"balance": amount}})
-        transaction = {
-            "amount": amount,
-            "type": "refund",
-            "timestamp": datetime.now()
-        }
-        db_user.collection.update_one({"userID": userID}, {"$push": {"transactions": transaction}})
+        record_transaction(userID, amount, "refund")
         return make_response(jsonify({"message": "Refund successful"}), 200)
     except Exception as e:
         return make_response(jsonify({"error": str(e)}), 500)
 
 # Endpoint per aggiungere un gatcha alla collezione di un utente
+# accetta un solo "gatcha_ID" oppure una lista "gatcha_IDs" (usata da /roll/batch del gatcha service)
 @app.route('/add_gatcha', methods=['POST'])
+@idempotent
 def add_gatcha():
     data = request.json
     userID = data.get("userID")
     gatcha = data.get("gatcha_ID")
+    gatchas = data.get("gatcha_IDs")
+    if gatchas is not None and not isinstance(gatchas, list):
+        return make_response(jsonify({"error": "gatcha_IDs must be a list"}), 400)
+    if gatchas is None:
+        gatchas = [gatcha]
+    if not gatchas or not all(is_valid_gatcha_ID(gatcha_ID) for gatcha_ID in gatchas):
+        return make_response(jsonify({"error": "Invalid gatcha ID"}), 400)
     try:
-        user = db_user.collection.find_one({"userID": userID})
-        if user is None:
+        # one $inc for each distinct gatcha, all in the same update
+        increments = {f"collection.{gatcha_ID}": count for gatcha_ID, count in Counter(gatchas).items()}
+        key = current_key()
+        result = db_user.collection.update_one(*guard_write({"userID": userID}, {"$inc": increments}, key))
+        if result.matched_count == 0:
+            if was_applied(db_user.collection, {"userID": userID}, key):
+                return make_response(jsonify({"message": "Gatcha added successfully"}), 200)
             return make_response(jsonify({"error": "User not found"}), 404)
-        db_user.collection.update_one({"userID": userID}, {"$push": {"collection": gatcha}})
         return make_response(jsonify({"message": "Gatcha added successfully"}), 200)
     except Exception as e:
         return make_response(jsonify({"error": str(e)}), 500)
     
 # Endpoint per eliminare un gatcha dalla collezione di un utente
 @app.route('/remove_gatcha', methods=['POST'])
+@idempotent
 def remove_gatcha():
     data = request.json
     userID = data.get("userID")
     gatcha = data.get("gatcha_ID")
+    if not is_valid_gatcha_ID(gatcha):
+        return make_response(jsonify({"error": "Invalid gatcha ID"}), 400)
+    field = f"collection.{gatcha}"
     try:
-        user = db_user.collection.find_one({"userID": userID})
+        # removes one copy of the gatcha: the filter guarantees that the count never goes below zero
+        key = current_key()
+        query, update = guard_write({"userID": userID, field: {"$gte": 1}}, {"$inc": {field: -1}}, key)
+        user = db_user.collection.find_one_and_update(
+            query,
+            update,
+            projection={"_id": 0, field: 1},
+            return_document=ReturnDocument.AFTER
+        )
         if user is None:
-            return make_response(jsonify({"error": "User not found"}), 404)
-        if gatcha not in user["collection"]:
+            # nothing was removed: the removal was already applied, or the user is missing or does not own the gatcha
+            if was_applied(db_user.collection, {"userID": userID}, key):
+                return make_response(jsonify({"message": "Gatcha removed successfully"}), 200)
+            if not userExists(userID):
+                return make_response(jsonify({"error": "User not found"}), 404)
             return make_response(jsonify({"error": "Gatcha not found in collection"}), 404)
-        db_user.collection.update_one(
-            {"userID": userID, "collection": gatcha},
-            {"$set": {"collection.$": None}}
-        )
-        db_user.collection.update_one(
-            {"userID": userID},
-            {"$pull": {"collection": None}}
-        )
+        if user["collection"][gatcha] == 0:
+            # that was the last copy: drop the key, unless a copy was added in the meantime
+            db_user.collection.update_one({"userID": userID, field: 0}, {"$unset": {field: ""}})
         return make_response(jsonify({"message": "Gatcha removed successfully"}), 200)
     except Exception as e:
         return make_response(jsonify({"error": str(e)}), 500)
 
+def hydrate_collection(collection):
+    """
+    Joins the collection {gatcha_ID: count} with the catalogue, with a single batch request to the gatcha service.
+    The token of the user is forwarded, since the gatcha endpoint checks the role.
+    The gatchas no longer in the catalogue are returned with their ID and count only.
+    """
+    if not collection:
+        return make_response(jsonify([]), 200)
+    response = service_client.post(
+        GATCHA_URL + "/gatchas/batch",
+        json={"gatcha_IDs": list(collection.keys())},
+        headers={"Authorization": request.headers.get("Authorization")},
+        verify=False,
+        timeout=10
+    )
+    if response.status_code != 200:
+        logger.error(f"Error getting the gatchas of the collection: {response.status_code} {response.text}")
+        return make_response(jsonify({"error": "Failed to get the gatchas of the collection"}), 502)
+    gatchas = {gatcha["_id"]: gatcha for gatcha in response.json()}
+    hydrated = [{**gatchas.get(gatcha_ID, {"_id": gatcha_ID}), "count": count} for gatcha_ID, count in collection.items()]
+    return make_response(jsonify(hydrated), 200)
+
+# region settlement
+# operazioni accettate da /settle, con il tipo di transazione registrato nel ledger per quelle sul saldo
+SETTLEMENT_BALANCE_OPERATIONS = {"increase_balance": "increase", "refund": "refund"}
+SETTLEMENT_MAX_OPERATIONS = int(os.getenv('SETTLEMENT_MAX_OPERATIONS', '1000'))
+
+def validate_settlement_operation(operation):
+    # Returns the error of an operation of /settle, or None if it is valid.
+    if not isinstance(operation, dict) or not operation.get("userID"):
+        return "Each operation needs a type and a userID"
+    if "idempotency_key" in operation and not isinstance(operation["idempotency_key"], str):
+        return "Invalid idempotency key"
+    if operation.get("type") == "add_gatcha":
+        return None if is_valid_gatcha_ID(operation.get("gatcha_ID")) else "Invalid gatcha ID"
+    if operation.get("type") in SETTLEMENT_BALANCE_OPERATIONS:
+        amount = operation.get("amount")
+        return None if isinstance(amount, (int, float)) and not isinstance(amount, bool) else "Invalid amount"
+    return "Unknown operation type"
+
+# Endpoint per applicare tante operazioni su saldi e collezioni con un solo bulk_write
+# usato dal market per chiudere in un colpo solo un batch di aste scadute
+@app.route('/settle', methods=['POST'])
+def settle():
+    """
+    Applies a list of balance and collection mutations.
+
+    Request format. JSON payload: {"operations": [<operation>, ...]}, where each operation is one of
+    - {"type": "add_gatcha", "userID": ..., "gatcha_ID": ...}
+    - {"type": "increase_balance", "userID": ..., "amount": ...}
+    - {"type": "refund", "userID": ..., "amount": ...}
+    Each operation can have an "idempotency_key": an operation whose key was already settled is not applied again
+    (its result is {"status": 200, "replayed": true}).
+
+    The response has one result for each operation, in the same order: {"status": 200} or {"status": 4xx/5xx, "error": ...}.
+    - 400/404/422: the operation is invalid, its user does not exist or its key was used for a different operation
+    - 409: an operation with the same key is still in progress, it can be retried
+    - 500: the operation was not applied, or its outcome is unknown: it can be retried with the same key
+    """
+    data = request.get_json(silent=True) or {}
+    operations = data.get("operations")
+    if not isinstance(operations, list):
+        return make_response(jsonify({"error": "operations must be a list"}), 400)
+    if len(operations) > SETTLEMENT_MAX_OPERATIONS:
+        return make_response(jsonify({"error": f"At most {SETTLEMENT_MAX_OPERATIONS} operations can be settled at once"}), 400)
+
+    results = []
+    for operation in operations:
+        error = validate_settlement_operation(operation)
+        results.append({"status": 400, "error": error} if error else None)
+    valid = [i for i, result in enumerate(results) if result is None]
+    try:
+        # a single read tells which users exist: the operations of the missing ones fail, the others are applied
+        userIDs = list({operations[i]["userID"] for i in valid})
+        existing = {user["userID"] for user in db_user.collection.find({"userID": {"$in": userIDs}}, {"_id": 0, "userID": 1})}
+
+        for i in valid:
+            if operations[i]["userID"] not in existing:
+                results[i] = {"status": 404, "error": "User not found"}
+        applicable = [i for i in valid if results[i] is None]
+
+        # the keys are reserved as pending, and completed only once their operation is applied
+        keys = {}
+        fingerprints = {}
+        for i in applicable:
+            if "idempotency_key" not in operations[i]:
+                continue
+            key = f"{request.path}:{operations[i]['idempotency_key']}"
+            fingerprint = hashlib.sha256(json.dumps(operations[i], sort_keys=True).encode()).hexdigest()
+            if key in fingerprints:
+                # a key repeated in the same request is applied once
+                results[i] = {"status": 200, "replayed": True} if fingerprints[key] == fingerprint else \
+                    {"status": 422, "error": "Idempotency key already used for a different operation"}
+                continue
+            keys[i] = key
+            fingerprints[key] = fingerprint
+        used = idempotency_store.begin_many(fingerprints)
+        for i, key in keys.items():
+            record = used.get(key)
+            if record is None:
+                continue
+            if record.get("fingerprint") != fingerprints[key]:
+                results[i] = {"status": 422, "error": "Idempotency key already used for a different operation"}
+            elif record["status"] == STATUS_COMPLETED:
+                results[i] = {"status": 200, "replayed": True}
+            elif not idempotency_store.take_over(key):
+                results[i] = {"status": 409, "error": "An operation with this idempotency key is in progress"}
+        to_apply = [i for i in applicable if results[i] is None]
+        reserved_keys = {keys[i] for i in to_apply if i in keys}
+
+        writes = []
+        transactions = {}
+        for i in to_apply:
+            operation = operations[i]
+            userID = operation["userID"]
+            # the key is part of the write (see guard_write): an operation already applied is not applied again
+            if operation["type"] == "add_gatcha":
+                writes.append(UpdateOne(*guard_write({"userID": userID}, {"$inc": {f"collection.{operation['gatcha_ID']}": 1}}, keys.get(i))))
+            else:
+                writes.append(UpdateOne(*guard_write({"userID": userID}, {"$inc": {"balance": operation["amount"]}}, keys.get(i))))
+                transaction = new_transaction(userID, operation["amount"], SETTLEMENT_BALANCE_OPERATIONS[operation["type"]])
+                transaction["_id"] = ObjectId()
+                if i in keys:
+                    transaction["settlement_key"] = keys[i]
+                transactions[i] = transaction
+
+        # the transactions are recorded first: if this fails nothing was applied
+        try:
+            if transactions:
+                ledger.insert_many(list(transactions.values()), ordered=False)
+        except BulkWriteError as e:
+            # the transactions of an operation taken over after a crash are already in the ledger
+            if any(error["code"] != DUPLICATE_KEY_ERROR_CODE for error in e.details.get("writeErrors", [])):
+                idempotency_store.abandon_many(reserved_keys)
+                raise
+        except Exception:
+            idempotency_store.abandon_many(reserved_keys)
+            raise
+
+        failed = {}
+        try:
+            if writes:
+                db_user.collection.bulk_write(writes, ordered=False)
+        except BulkWriteError as e:
+            # the other writes were applied: only the failed operations are rolled back
+            failed = {to_apply[error["index"]]: error.get("errmsg", "Write failed") for error in e.details.get("writeErrors", [])}
+        except Exception as e:
+            # the writes may or may not have been applied: the keys are released, the retries apply only
+            # the writes still missing (the applied ones are guarded by their key)
+            logger.error(f"Unknown outcome settling {len(writes)} operations: {str(e)}")
+            idempotency_store.abandon_many(reserved_keys)
+            for i in to_apply:
+                results[i] = {"status": 500, "error": str(e)}
+            return make_response(jsonify({"results": results}), 200)
+
+        if failed:
+            logger.error(f"{len(failed)} of {len(writes)} settlement operations failed")
+            idempotency_store.abandon_many({keys[i] for i in failed if i in keys})
+            failed_transactions = [transactions[i]["_id"] for i in failed if i in transactions]
+            if failed_transactions:
+                try:
+                    ledger.delete_many({"_id": {"$in": failed_transactions}})
+                except Exception as e:
+                    logger.error(f"Error removing the transactions of the failed settlement operations: {str(e)}")
+        for i in to_apply:
+            results[i] = {"status": 500, "error": failed[i]} if i in failed else {"status": 200}
+        try:
+            idempotency_store.complete_many({keys[i] for i in to_apply if i in keys and i not in failed})
+        except Exception as e:
+            # the operations were applied: the keys expire as pending
+            logger.error(f"Error completing the settlement idempotency keys: {str(e)}")
+        return make_response(jsonify({"results": results}), 200)
+    except Exception as e:
+        logger.error(f"Error settling {len(operations)} operations: {str(e)}")
+        return make_response(jsonify({"error": str(e)}), 500)
+# endregion settlement
+
 # Endpoint per restituire la collezione di un utente
+# di default è la lista degli ID (un elemento per ogni copia), con ?format=counts è la mappa {gatcha_ID: numero di copie},
+# con ?format=hydrated è la lista dei gatcha posseduti con tutti i loro dati e il numero di copie (un'unica chiamata al gatcha service)
 @app.route('/collection', methods=['GET'])
 def get_collection():
     try: 
@@ -294,10 +683,17 @@ def get_collection():
     except Exception as e:
         return make_response(jsonify({"error": "Error decoding token"}), 401)
     try:
-        user = db_user.collection.find_one({"userID": userID})
+        collection_format = request.args.get("format", "ids")
+        if collection_format not in ("ids", "counts", "hydrated"):
+            return make_response(jsonify({"error": "format must be ids, counts or hydrated"}), 400)
+        user = db_user.collection.find_one({"userID": userID}, {"_id": 0, "collection": 1})
         if user is None:
             return make_response(jsonify({"error": "User not found"}), 404)
-        return make_response(jsonify(user["collection"]), 200)
+        if collection_format == "counts":
+            return make_response(jsonify(user["collection"]), 200)
+        if collection_format == "hydrated":
+            return hydrate_collection(user["collection"])
+        return make_response(jsonify(expand_collection(user["collection"])), 200)
     except Exception as e:
         return make_response(jsonify({"error": str(e)}), 500)
 
@@ -317,14 +713,24 @@ def check_connection():
 def get_all_logs():
     try:
         res = []
-        all = list(db_user.collection.find({}))
+        transactions = {}
+        for entry in ledger.find({}, {**TRANSACTION_PROJECTION, "userID": 1}).sort([("timestamp", ASCENDING), ("_id", ASCENDING)]):
+            transactions.setdefault(entry["userID"], []).append(format_transaction(entry))
+        all = list(db_user.collection.find({}, {APPLIED_KEYS_FIELD: 0}))
         for element in all:
             res.append({
                 'userID': element["userID"],
                 'balance': element["balance"],
-                'collection': element["collection"],
-                'transactions': element["transactions"]})
+                'collection': expand_collection(element["collection"]),
+                'transactions': transactions.get(element["userID"], [])})
         return make_response(jsonify(res), 200)
     except Exception as e:
         print("DEBUG: Error fetching logs:", str(e))
         return make_response(str(e), 500)
+
+
+# Endpoint to check the counters of the token introspection cache (see auth_utils.py)
+@app.route('/introspection-cache/stats', methods=['GET'])
+@role_required('adminUser')
+def introspection_cache_stats():
+    return make_response(jsonify(get_introspection_cache_stats()), 200)
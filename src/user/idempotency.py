@@ -0,0 +1,179 @@
+import os
+import hashlib
+import logging
+from datetime import datetime, timedelta
+from functools import wraps
+
+from flask import request, make_response, jsonify, g
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError, BulkWriteError, PyMongoError
+
+logger = logging.getLogger(__name__)
+
+# Idempotency keys for the mutating endpoints of the user service.
+# A caller (gatcha, market) sends the same Idempotency-Key header every time it retries a call:
+# the first request is executed and its response is stored, the retries get the stored response back
+# without applying the change again. So a call that timed out can be retried safely.
+#
+# The keys are stored in a MongoDB collection with a TTL index: they are forgotten after IDEMPOTENCY_KEY_TTL_SECONDS.
+# A key whose request is still running (or whose process died while running it) is "pending":
+# the retries get 409 until IDEMPOTENCY_PENDING_TIMEOUT_SECONDS, then one of them runs the request again.
+#
+# A request can fail after its write (e.g. the connection drops before MongoDB answers): its key is released and a
+# retry runs it again. So the key is also part of the write itself (guard_write): it is pushed to the applied_keys of
+# the user document in the same update, filtered on its absence, and a write already applied matches nothing.
+
+IDEMPOTENCY_KEY_HEADER = 'Idempotency-Key'
+IDEMPOTENCY_KEY_MAX_LENGTH = 128
+IDEMPOTENCY_KEY_TTL_SECONDS = int(os.getenv('IDEMPOTENCY_KEY_TTL_SECONDS', str(24 * 60 * 60)))
+IDEMPOTENCY_PENDING_TIMEOUT_SECONDS = int(os.getenv('IDEMPOTENCY_PENDING_TIMEOUT_SECONDS', '30'))
+
+# the last keys applied to each user document, kept with it (a bounded list, at least as long as the retries of a call)
+IDEMPOTENCY_APPLIED_KEYS_MAX = int(os.getenv('IDEMPOTENCY_APPLIED_KEYS_MAX', '1000'))
+APPLIED_KEYS_FIELD = 'applied_keys'
+
+DUPLICATE_KEY_ERROR_CODE = 11000
+
+STATUS_PENDING = 'pending'
+STATUS_COMPLETED = 'completed'
+
+
+def current_key():
+    """The idempotency key of the request being executed by an idempotent endpoint, or None."""
+    return g.get('idempotency_key')
+
+def guard_write(query, update, key):
+    """
+    Makes a write on a user document applicable only once for the key: returns the query and the update
+    that also record the key in the document. Without a key they are returned unchanged.
+    """
+    if key is None:
+        return query, update
+    query = dict(query, **{APPLIED_KEYS_FIELD: {"$ne": key}})
+    update = dict(update, **{"$push": {APPLIED_KEYS_FIELD: {"$each": [key], "$slice": -IDEMPOTENCY_APPLIED_KEYS_MAX}}})
+    return query, update
+
+def was_applied(collection, query, key):
+    # True if the write of the key was already applied to the document of query (e.g. by a request that failed afterwards)
+    return key is not None and collection.find_one(dict(query, **{APPLIED_KEYS_FIELD: key}), {"_id": 1}) is not None
+
+
+class IdempotencyStore:
+    """Dedupe store of the idempotency keys, one document for each key: {_id, fingerprint, status, response, created_at}."""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def create_indexes(self):
+        self.collection.create_index([("created_at", ASCENDING)], expireAfterSeconds=IDEMPOTENCY_KEY_TTL_SECONDS)
+
+    def begin(self, key, fingerprint):
+        """Reserves the key for a new request. Returns None if it was reserved, or the existing record of the key."""
+        try:
+            self.collection.insert_one({"_id": key, "fingerprint": fingerprint, "status": STATUS_PENDING, "created_at": datetime.now()})
+            return None
+        except DuplicateKeyError:
+            record = self.collection.find_one({"_id": key})
+            if record is None:
+                # expired in the meantime
+                return self.begin(key, fingerprint)
+            return record
+
+    def take_over(self, key):
+        """Takes a pending key whose request has been running for too long. Returns True if this request got it."""
+        now = datetime.now()
+        record = self.collection.find_one_and_update(
+            {"_id": key, "status": STATUS_PENDING, "created_at": {"$lte": now - timedelta(seconds=IDEMPOTENCY_PENDING_TIMEOUT_SECONDS)}},
+            {"$set": {"created_at": now}},
+            return_document=ReturnDocument.AFTER
+        )
+        return record is not None
+
+    def complete(self, key, status_code, body):
+        self.collection.update_one({"_id": key}, {"$set": {"status": STATUS_COMPLETED, "response": {"status_code": status_code, "body": body}}})
+
+    def abandon(self, key):
+        # the request failed without a definitive answer: the next retry runs it again
+        self.collection.delete_one({"_id": key, "status": STATUS_PENDING})
+
+    def begin_many(self, fingerprints):
+        """
+        Reserves many keys at once, as pending (used by /settle, which applies all its operations together).
+        fingerprints is {key: fingerprint of its request}. Returns the existing records of the keys already used.
+        """
+        if not fingerprints:
+            return {}
+        keys = list(fingerprints)
+        now = datetime.now()
+        try:
+            self.collection.insert_many(
+                [{"_id": key, "fingerprint": fingerprints[key], "status": STATUS_PENDING, "created_at": now} for key in keys],
+                ordered=False
+            )
+            return {}
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            if any(error["code"] != DUPLICATE_KEY_ERROR_CODE for error in errors):
+                raise
+            used = [keys[error["index"]] for error in errors]
+        records = {record["_id"]: record for record in self.collection.find({"_id": {"$in": used}})}
+        # a key expired in the meantime is reported as still pending: it is free again at the next retry
+        return {key: records.get(key, {"_id": key, "fingerprint": fingerprints[key], "status": STATUS_PENDING}) for key in used}
+
+    def complete_many(self, keys):
+        if keys:
+            self.collection.update_many({"_id": {"$in": list(keys)}}, {"$set": {"status": STATUS_COMPLETED}})
+
+    def abandon_many(self, keys):
+        if keys:
+            self.collection.delete_many({"_id": {"$in": list(keys)}, "status": STATUS_PENDING})
+
+    def idempotent(self, view):
+        """
+        Decorator of a Flask endpoint: the requests with an Idempotency-Key header are executed only once.
+        The requests without the header are executed as before.
+        """
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            idempotency_key = request.headers.get(IDEMPOTENCY_KEY_HEADER)
+            if not idempotency_key:
+                return view(*args, **kwargs)
+            if len(idempotency_key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+                return make_response(jsonify({"error": f"{IDEMPOTENCY_KEY_HEADER} is too long"}), 400)
+
+            # the same key used on two endpoints is two different keys
+            key = f"{request.path}:{idempotency_key}"
+            fingerprint = hashlib.sha256(request.get_data()).hexdigest()
+            try:
+                record = self.begin(key, fingerprint)
+                if record is not None:
+                    if record.get("fingerprint") != fingerprint:
+                        return make_response(jsonify({"error": f"{IDEMPOTENCY_KEY_HEADER} already used for a different request"}), 422)
+                    if record["status"] == STATUS_COMPLETED:
+                        response = make_response(record["response"]["body"], record["response"]["status_code"])
+                        response.headers['Content-Type'] = 'application/json'
+                        response.headers['Idempotent-Replayed'] = 'true'
+                        return response
+                    if not self.take_over(key):
+                        return make_response(jsonify({"error": f"A request with this {IDEMPOTENCY_KEY_HEADER} is in progress"}), 409)
+            except PyMongoError as e:
+                logger.error(f"Error reading the idempotency key {key}: {str(e)}")
+                return make_response(jsonify({"error": str(e)}), 500)
+
+            g.idempotency_key = key
+            try:
+                response = make_response(view(*args, **kwargs))
+            except Exception:
+                self.abandon(key)
+                raise
+            try:
+                if response.status_code >= 500:
+                    # the writes of the view are guarded by the key (guard_write): a retry does not apply them twice
+                    self.abandon(key)
+                else:
+                    self.complete(key, response.status_code, response.get_data(as_text=True))
+            except PyMongoError as e:
+                # the request was executed: its response is returned anyway, the key expires as pending
+                logger.error(f"Error storing the response of the idempotency key {key}: {str(e)}")
+            return response
+        return wrapper
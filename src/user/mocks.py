@@ -21,6 +21,10 @@ logger = logging.getLogger(__name__)
 # questa funzione verrà chiamata al posto di requests.get(), requests.post(), ecc., ritornando la risposta definita qui
 def mock_request(method, url, *args, **kwargs):
     logger.info(f"Intercepted {method} request to URL: {url}")
+    if method == 'POST' and url.endswith("/gatchas/batch"):
+        # the gatcha service returns the details of the requested gatchas
+        gatcha_IDs = (kwargs.get('json') or {}).get("gatcha_IDs", [])
+        return MockResponse([{"_id": gatcha_ID, "name": "Mock gatcha", "rarity": "comune", "image": "", "NTot": 0} for gatcha_ID in gatcha_IDs], 200)
     logger.warning("Returning 404 Not Found for " + method + " request " + url)
     return MockResponse({"error": "Not Found"}, 404)
 
@@ -34,6 +38,8 @@ def start_mocking_http_requests():
     
     methods_to_patch = ['get', 'post', 'put', 'delete', 'patch', 'head', 'options']
     patchers = [patch(f'requests.{method}', lambda url, **kwargs: mock_request(method.upper(), url, **kwargs)) for method in methods_to_patch]
+    # the calls made with service_client.py go through a pooled requests.Session
+    patchers.append(patch('requests.Session.request', lambda self, method, url, **kwargs: mock_request(method.upper(), url, **kwargs)))
     
     for patcher in patchers:
         patcher.start()